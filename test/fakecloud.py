@@ -0,0 +1,222 @@
+"""
+In-process stand-in for the subset of openstacksdk connection API used
+by wasser equipment, so the equipment code can be tested without cloud.
+"""
+
+import itertools
+import random
+import re
+import threading
+import time
+
+import openstack
+
+
+class FakeResource(dict):
+    """Dictionary with attribute access, like openstacksdk resources"""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeCompute():
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def servers(self, **kwargs):
+        self.cloud.count('servers')
+        with self.cloud.lock:
+            self.cloud.refresh()
+            servers = [FakeResource(_) for _ in self.cloud.servers.values()]
+        if 'name' in kwargs:
+            servers = [_ for _ in servers if re.search(kwargs['name'], _.name)]
+        return servers
+
+    def get_server(self, server_id):
+        self.cloud.count('get_server')
+        with self.cloud.lock:
+            self.cloud.refresh()
+            if server_id not in self.cloud.servers:
+                raise openstack.exceptions.NotFoundException(f'No Server found for {server_id}')
+            return FakeResource(self.cloud.servers[server_id])
+
+    def delete_server(self, server_id, ignore_missing=True):
+        self.cloud.count('delete_server')
+        with self.cloud.lock:
+            if server_id not in self.cloud.servers:
+                if ignore_missing:
+                    return
+                raise openstack.exceptions.NotFoundException(f'No Server found for {server_id}')
+            del self.cloud.servers[server_id]
+
+    def create_server(self, name, image_id, flavor_id, min_count=1, max_count=1, metadata=None, **kwargs):
+        """Nova style multi-create, servers are named '<name>-<count>'"""
+        self.cloud.count('compute.create_server')
+        if max_count == 1:
+            return self.cloud.add_server(name, image=image_id, flavor=flavor_id, metadata=dict(metadata or {}))
+        servers = [self.cloud.add_server(f'{name}-{_ + 1}', image=image_id, flavor=flavor_id,
+                                         metadata=dict(metadata or {}))
+                        for _ in range(max_count)]
+        return servers[0]
+
+    def update_server(self, server_id, **kwargs):
+        self.cloud.count('update_server')
+        if 'name' in kwargs:
+            self.cloud.maybe_conflict(kwargs['name'])
+        with self.cloud.lock:
+            self.cloud.servers[server_id].update(kwargs)
+            return FakeResource(self.cloud.servers[server_id])
+
+    def set_server_metadata(self, server_id, **metadata):
+        self.cloud.count('set_server_metadata')
+        if 'wasser_name' in metadata:
+            self.cloud.maybe_conflict(metadata['wasser_name'])
+        with self.cloud.lock:
+            self.cloud.servers[server_id]['metadata'].update(metadata)
+            return FakeResource(self.cloud.servers[server_id])
+
+    def find_keypair(self, name):
+        self.cloud.count('find_keypair')
+        return FakeResource(id=name, name=name) if name in self.cloud.keypairs else None
+
+
+class FakeNetwork():
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def find_network(self, name):
+        self.cloud.count('find_network')
+        return self.cloud.networks.get(name)
+
+
+class FakeCloud():
+    """
+    Fake cloud connection, returned by the patched get_connect.
+
+    All API calls are counted in 'calls' dictionary and take 'api_latency'
+    seconds. New servers are in BUILD status for 'boot_time' seconds,
+    servers with names listed in 'broken' and 'error_rate' part of all
+    servers go to ERROR status. With 'conflict_rate' probability another
+    server with the same name appears, when a server gets its name.
+    Floating ips take 'fip_latency' seconds to create and 'fip_error_rate'
+    part of them fail. Random failures are reproducible with the 'seed'.
+    """
+    def __init__(self, images=('image',), flavors=('flavor',), keypairs=('wasser',), networks=('net',),
+                 boot_time=0, broken=(), api_latency=0, error_rate=0, conflict_rate=0,
+                 fip_latency=0, fip_error_rate=0, seed=0):
+        self.boot_time = boot_time
+        self.broken = list(broken)
+        self.api_latency = api_latency
+        self.error_rate = error_rate
+        self.conflict_rate = conflict_rate
+        self.fip_latency = fip_latency
+        self.fip_error_rate = fip_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.calls = {}
+        self.servers = {}
+        self.floating_ips = {}
+        self.images = {_: FakeResource(id=f'image-{_}', name=_) for _ in images}
+        self.flavors = {_: FakeResource(id=f'flavor-{_}', name=_) for _ in flavors}
+        self.keypairs = list(keypairs)
+        self.networks = {_: FakeResource(id=f'network-{_}', name=_) for _ in networks}
+        self.compute = FakeCompute(self)
+        self.network = FakeNetwork(self)
+
+    def count(self, name):
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def chance(self, rate):
+        with self.lock:
+            return rate and self.random.random() < rate
+
+    def maybe_conflict(self, name):
+        """Add foreign server, which takes the name first"""
+        if self.chance(self.conflict_rate):
+            self.add_server(name, foreign=True)
+
+    def refresh(self):
+        with self.lock:
+            now = time.time()
+            for server in self.servers.values():
+                if server['status'] == 'BUILD' and server['ready_at'] <= now:
+                    if server['name'] in self.broken or server.get('will_fail'):
+                        server['status'] = 'ERROR'
+                        server['fault'] = dict(message='No valid host was found')
+                    else:
+                        server['status'] = 'ACTIVE'
+
+    def add_server(self, name, status=None, **kwargs):
+        with self.lock:
+            server_id = f'server-{next(self.ids)}'
+            if not kwargs.get('foreign') and self.chance(self.error_rate):
+                kwargs['will_fail'] = True
+            if not status:
+                status = 'BUILD' if self.boot_time or name in self.broken or kwargs.get('will_fail') else 'ACTIVE'
+            kwargs.setdefault('metadata', {})
+            self.servers[server_id] = dict(
+                id=server_id,
+                name=name,
+                status=status,
+                ready_at=time.time() + self.boot_time,
+                addresses={'net': [{'addr': f'10.0.0.{len(self.servers) + 1}', 'version': 4}]},
+                **kwargs,
+            )
+            return FakeResource(self.servers[server_id])
+
+    def get_image(self, name_or_id):
+        self.count('get_image')
+        with self.lock:
+            return self.images.get(name_or_id) or next(
+                (_ for _ in self.images.values() if _.id == name_or_id), None)
+
+    def create_image_snapshot(self, name, server, wait=False, timeout=3600, **metadata):
+        self.count('create_image_snapshot')
+        with self.lock:
+            image = FakeResource(id=f'image-{next(self.ids)}', name=name, server=server, metadata=metadata)
+            self.images[image.id] = image
+            return image
+
+    def delete_image(self, name_or_id, wait=False):
+        self.count('delete_image')
+        with self.lock:
+            image = self.get_image(name_or_id)
+            if not image:
+                return False
+            del self.images[next(k for k, v in self.images.items() if v is image)]
+            return True
+
+    def get_flavor(self, name):
+        self.count('get_flavor')
+        return self.flavors.get(name)
+
+    def create_server(self, name, image, flavor, key_name=None, userdata=None, meta=None, **kwargs):
+        self.count('create_server')
+        self.maybe_conflict(name)
+        return self.add_server(name, image=image, flavor=flavor, key_name=key_name, metadata=dict(meta or {}))
+
+    def get_server_by_id(self, server_id):
+        self.count('get_server_by_id')
+        return self.compute.get_server(server_id)
+
+    def create_floating_ip(self, network, server, fixed_address, wait=False):
+        self.count('create_floating_ip')
+        if self.fip_latency:
+            time.sleep(self.fip_latency)
+        if self.chance(self.fip_error_rate):
+            raise openstack.exceptions.SDKException('Quota exceeded for resources: floatingip')
+        with self.lock:
+            fip_id = f'fip-{next(self.ids)}'
+            self.floating_ips[fip_id] = dict(id=fip_id, floating_ip_address=f'172.16.0.{len(self.floating_ips) + 1}')
+            return FakeResource(self.floating_ips[fip_id])
+
+    def delete_floating_ip(self, fip_id):
+        self.count('delete_floating_ip')
+        with self.lock:
+            return self.floating_ips.pop(fip_id, None) is not None
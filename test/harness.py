@@ -0,0 +1,167 @@
+"""
+Scale and load harness, which runs whole 'wa run' workflows in process
+against the fake cloud and the fake remote shell, and reports how
+wasser behaves with many nodes:
+
+    cloud = FakeCloud(boot_time=1, error_rate=0.01)
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch)
+    print(format_report(report))
+"""
+
+import asyncio
+import logging
+import resource
+import threading
+import time
+import tracemalloc
+
+import yaml
+
+import wasser
+from wasser.equip import OpenStackEquipment
+from wasser.shell import Shell
+
+
+class FakeRemoteShell(Shell):
+    """
+    Remote shell stand-in, commands take 'latency' seconds
+    and always succeed, uploads are skipped.
+    """
+    latency = 0.01
+    lock = threading.Lock()
+    commands = 0
+    uploads = 0
+
+    def __init__(self, name='localhost', user='root', identity=None):
+        self.hostname = name
+        self.username = user
+        self.identity = identity
+
+    def get_client(self):
+        return None
+
+    def connect_client(self):
+        return None
+
+    async def arun(self, command: str, name: str = None, timeout: int = None) -> None:
+        self.log_cmd(command, name)
+        await asyncio.sleep(self.latency)
+        with self.lock:
+            FakeRemoteShell.commands += 1
+
+    def copy_files(self, copy_spec, bulk=None):
+        with self.lock:
+            FakeRemoteShell.uploads += 1
+        return dict(sent_files=0, sent_bytes=0, skipped_files=0, skipped_bytes=0)
+
+
+class Sampler():
+    """Records peak number of threads while running"""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def make_args(spec_path, state_path, **kwargs):
+    """
+    Return arguments of 'wa run' command parsed by the wasser parser,
+    with the options overridden by the keyword arguments, 'resume'
+    stands for --continue.
+    """
+    args = wasser.get_parser().parse_args(['run', str(spec_path), '--state-path', str(state_path)])
+    if 'resume' in kwargs:
+        kwargs['continue'] = kwargs.pop('resume')
+    for k, v in kwargs.items():
+        if not hasattr(args, k):
+            raise Exception(f"Unknown 'wa run' option {k}")
+        setattr(args, k, v)
+    return args
+
+
+def run_workflow(spec, cloud, tmp_path, monkeypatch, shell_latency=0.01, log_level=logging.WARNING,
+                 trace_memory=False, **kwargs):
+    """
+    Run 'wa run' for the spec against the fake cloud and return report
+    with wall time, exit code, API call counts, peak thread count,
+    peak process memory, number of commands run and servers left.
+
+    If 'trace_memory' is True, peak memory allocated by the run is traced
+    as well, which makes the run a few times slower.
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    # the parser defaults are taken from the environment
+    for name in ['OS_CLOUD', 'TARGET_IMAGE', 'TARGET_FLAVOR', 'TARGET_FLOATING', 'TARGET_NETWORK',
+                 'TARGET_NAME', 'TARGET_KEYNAME', 'TARGET_KEYFILE', 'TARGET_USERNAME']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(OpenStackEquipment, 'get_connect', lambda self: cloud)
+    monkeypatch.setattr(wasser, 'RemoteShell', FakeRemoteShell)
+    monkeypatch.setattr(FakeRemoteShell, 'latency', shell_latency)
+    monkeypatch.setattr(FakeRemoteShell, 'commands', 0)
+    monkeypatch.setattr(FakeRemoteShell, 'uploads', 0)
+    spec_path = tmp_path / 'spec.yaml'
+    text = yaml.safe_dump(spec)
+    # unchanged spec file is not rewritten, so repeated runs hit the spec cache
+    if not spec_path.exists() or spec_path.read_text() != text:
+        spec_path.write_text(text)
+    args = make_args(spec_path, tmp_path / '.wasser_state', **kwargs)
+
+    exit_code = 0
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(log_level)
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.time()
+    try:
+        with Sampler() as sampler:
+            try:
+                wasser.do_run(args)
+            except SystemExit as e:
+                exit_code = e.code
+    finally:
+        wall_time = time.time() - start_time
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        tracemalloc.stop()
+        logger.setLevel(level)
+    return dict(
+        exit_code=exit_code,
+        wall_time=wall_time,
+        api_calls=dict(cloud.calls),
+        peak_threads=sampler.peak_threads,
+        peak_memory=peak_memory,
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        commands=FakeRemoteShell.commands,
+        uploads=FakeRemoteShell.uploads,
+        servers_left=len([_ for _ in cloud.servers.values() if not _.get('foreign')]),
+        floating_ips_left=len(cloud.floating_ips),
+    )
+
+
+def format_report(report):
+    calls = ', '.join(f'{k}={v}' for k, v in sorted(report['api_calls'].items()))
+    return '\n'.join([
+        f"exit code:    {report['exit_code']}",
+        f"wall time:    {report['wall_time']:.2f}s",
+        f"api calls:    {sum(report['api_calls'].values())} ({calls})",
+        f"peak threads: {report['peak_threads']}",
+        f"peak rss:     {report['peak_rss'] / 1024 / 1024:.1f}MiB",
+        f"peak memory:  {report['peak_memory'] / 1024 / 1024:.1f}MiB" if report['peak_memory'] is not None
+            else "peak memory:  not traced",
+        f"commands:     {report['commands']}, uploads: {report['uploads']}",
+        f"left:         {report['servers_left']} servers, {report['floating_ips_left']} floating ips",
+    ])
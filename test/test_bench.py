@@ -0,0 +1,140 @@
+"""
+Micro-benchmarks of wasser in-process hot paths, run with:
+
+    pytest test/test_bench.py --benchmark-only
+
+The benchmarks do not need a cloud, nodes are created with openstack
+equipment objects only, and commands are run with the local shell.
+"""
+
+import argparse
+import io
+import logging
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from wasser import state
+from wasser import Workflow, render_command
+from wasser.shell import LocalShell, StepOutput, read_file
+
+
+def make_spec(depth, width):
+    """Return dict of given depth with 'width' keys on each level"""
+    if depth == 0:
+        return {f'key{i}': f'value{i}' for i in range(width)}
+    return {f'key{i}': make_spec(depth - 1, width) for i in range(width)}
+
+
+@pytest.fixture
+def info_logging():
+    """Let info messages through to a handler which drops them"""
+    root = logging.getLogger()
+    level = root.level
+    handler = logging.NullHandler()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    yield
+    root.removeHandler(handler)
+    root.setLevel(level)
+
+
+@pytest.mark.parametrize(['depth', 'width'], [[6, 3], [2, 40]], ids=['deep', 'wide'])
+def test_bench_override(benchmark, depth, width):
+    src = make_spec(depth, width)
+    data = make_spec(depth, width // 2 + 1)
+    res = benchmark(state.override, src, data)
+    assert res.keys() == src.keys()
+
+
+def write_spec_files(tmp_path, monkeypatch):
+    """Write the user config, the directory config and the spec with 50 routines"""
+    import yaml
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.wasser').mkdir()
+    (tmp_path / '.wasser' / 'config.yaml').write_text(yaml.safe_dump(dict(
+        openstack=dict(cloud='mycloud', keyname='wasser', keyfile='~/.ssh/id_rsa'))))
+    (tmp_path / '.wasser.yaml').write_text(yaml.safe_dump(dict(openstack=dict(flavor='m1.small'))))
+    (tmp_path / 'spec.yaml').write_text(yaml.safe_dump(dict(
+        openstack=dict(image='image', name='node%02d'),
+        routines={f'routine{i}': dict(steps=[f'echo {_}' for _ in range(20)]) for i in range(50)},
+    )))
+
+
+def test_bench_load_spec(benchmark, tmp_path, monkeypatch):
+    write_spec_files(tmp_path, monkeypatch)
+    s = state.State()
+
+    def load():
+        # measure reading and merging the files, not the spec cache
+        s.get_spec_cache().data.clear()
+        s.load_spec('spec.yaml')
+    benchmark(load)
+    assert len(s.status['spec']['routines']) == 50
+
+
+def test_bench_load_spec_cached(benchmark, tmp_path, monkeypatch):
+    write_spec_files(tmp_path, monkeypatch)
+    s = state.State()
+    s.load_spec('spec.yaml')
+    benchmark(s.load_spec, 'spec.yaml')
+    assert len(s.status['spec']['routines']) == 50
+
+
+def test_bench_render_command(benchmark):
+    env = {f'var{i}': f'value{i}' for i in range(100)}
+    command = '\n'.join(f'echo {{{{ var{i} }}}}' for i in range(100))
+    res = benchmark(render_command, command, env)
+    assert res.endswith('echo value99')
+
+
+@pytest.mark.parametrize('nodes', [10, 100, 1000])
+def test_bench_node_state_update(benchmark, tmp_path, nodes):
+    s = state.State()
+    s.args = argparse.Namespace(state_path=str(tmp_path / 'wasser_state'))
+    s.status['nodes'] = [[dict(name=f'node{i}', id=f'server-{i}', ip='10.0.0.1') for i in range(nodes)]]
+    node_states = [state.NodeState(s, _) for _ in s.status['nodes'][0]]
+
+    def update():
+        for n in node_states:
+            n.update(status='ACTIVE')
+        s.flush()
+    benchmark(update)
+
+
+@pytest.mark.parametrize('nodes', [10, 100, 1000])
+def test_bench_state_save(benchmark, tmp_path, nodes):
+    s = state.State()
+    s.args = argparse.Namespace(state_path=str(tmp_path / 'wasser_state'))
+    s.status['nodes'] = [[dict(name=f'node{i}', id=f'server-{i}', ip='10.0.0.1') for i in range(nodes)]]
+    benchmark(s.save, flush=True)
+
+
+def test_bench_step_output(benchmark, info_logging, tmp_path):
+    data = b''.join(b'line %d of the command output\n' % i for i in range(10000))
+
+    def run():
+        output = StepOutput('>>> ', 'EEE ', str(tmp_path / 'step.log'))
+        read_file(io.BytesIO(data), output.stdout)
+        output.close()
+        return output
+    output = benchmark(run)
+    assert output.tail[-1] == 'line 9999 of the command output'
+
+
+def test_bench_local_shell(benchmark, info_logging):
+    shell = LocalShell(None)
+    benchmark(shell.run, 'seq 10000')
+
+
+def test_bench_get_equipment(benchmark):
+    s = state.State()
+    s.override_status_specs([dict(
+        openstack=dict(image='image', flavor='flavor', name='node%03d'),
+        routines={f'routine{r}': dict(nodes=[dict(openstack={}) for _ in range(50)]) for r in range(10)},
+    )])
+    w = Workflow(s)
+    equipment = benchmark(w.get_equipment)
+    assert len(equipment) == 500
@@ -0,0 +1,422 @@
+import argparse
+
+import pytest
+
+from wasser import state
+from wasser import Workflow
+
+from fakecloud import FakeCloud, FakeResource
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    from wasser.equip import OpenStackEquipment
+    c = FakeCloud()
+    monkeypatch.setattr(OpenStackEquipment, 'get_connect', lambda self: c)
+    return c
+
+
+def make_state(tmp_path, conf):
+    s = state.State()
+    s.args = argparse.Namespace(state_path=str(tmp_path / 'wasser_state'))
+    s.override_status_specs([conf])
+    return s
+
+
+def test_delete_nodes(cloud, tmp_path):
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor'),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+    servers = [cloud.add_server(f'wa{_:02d}') for _ in range(3)]
+    fip = cloud.create_floating_ip('ext', servers[0], '10.0.0.1')
+    s.status['nodes'] = [[dict(id=_.id, name=_.name) for _ in servers]]
+    s.status['nodes'][0][0]['fip_id'] = fip.id
+    w = Workflow(s)
+    w.delete_nodes()
+    assert cloud.servers == {}
+    assert cloud.floating_ips == {}
+    assert [_['status'] for _ in s.status['nodes'][0]] == ['deleted'] * 3
+    assert s.status['nodes'][0][0]['fip_id'] is None
+
+
+def test_delete_nodes_no_wait(cloud, tmp_path):
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor'),
+        routines=dict(a=dict()),
+    ))
+    server = cloud.add_server('wa00')
+    s.status['nodes'] = [[dict(id=server.id, name=server.name)]]
+    Workflow(s).delete_nodes(wait=False)
+    assert cloud.servers == {}
+    assert s.status['nodes'][0][0]['status'] == 'deleting'
+    assert 'get_server' not in cloud.calls
+
+
+def test_delete_nodes_errors(cloud, tmp_path, monkeypatch):
+    import threading
+    import time
+    import openstack
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor'),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(6)])),
+        workflow=dict(node_threads=2),
+    ))
+    servers = [cloud.add_server(f'wa{_:02d}') for _ in range(6)]
+    fip = cloud.create_floating_ip('ext', servers[0], '10.0.0.1')
+    s.status['nodes'] = [[dict(id=_.id, name=_.name) for _ in servers]]
+    s.status['nodes'][0][0]['fip_id'] = fip.id
+    delete_server = cloud.compute.delete_server
+    threads = set()
+
+    def failing_delete(server_id, **kwargs):
+        threads.add(threading.current_thread().name)
+        if server_id == servers[0].id:
+            raise openstack.exceptions.SDKException('Service unavailable')
+        return delete_server(server_id, **kwargs)
+    monkeypatch.setattr(cloud.compute, 'delete_server', failing_delete)
+    start = time.time()
+    with pytest.raises(Exception, match='Failed to delete 1 of 6 nodes'):
+        Workflow(s).delete_nodes()
+    # the failed node is not waited for, and the pool is bounded by node threads
+    assert time.time() - start < 5
+    assert len(threads) <= 2
+    assert list(cloud.servers) == [servers[0].id]
+    assert cloud.floating_ips == {}
+
+def test_create_nodes_lookup_cache(cloud, tmp_path):
+    from wasser import cache
+    conf = dict(
+        openstack=dict(image='image', flavor='flavor', name='node', network='net', multi_create=True),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    )
+    s = make_state(tmp_path, conf)
+    Workflow(s).create_nodes()
+    assert len(cloud.servers) == 3
+    assert cloud.calls['get_image'] == 1
+    assert cloud.calls['get_flavor'] == 1
+    assert cloud.calls['find_keypair'] == 1
+    assert cloud.calls['find_network'] == 1
+    assert (tmp_path / '.wasser_cache').exists()
+
+    # the next run reads the lookups from the cache file
+    cache._caches.clear()
+    s = make_state(tmp_path, conf)
+    Workflow(s).create_nodes()
+    assert len(cloud.servers) == 6
+    assert cloud.calls['get_image'] == 1
+    assert cloud.calls['find_network'] == 1
+
+    # the ttl of one spec does not change the ttl of other users
+    shared = cache.get_lookup_cache(str(tmp_path / '.wasser_cache'))
+    conf['openstack']['cache_ttl'] = 0
+    Workflow(make_state(tmp_path, conf)).create_nodes()
+    assert cloud.calls['get_image'] == 2
+    assert shared.ttl == 3600
+    assert shared.get(None, 'image', 'image')['name'] == 'image'
+
+
+def test_server_watcher(tmp_path):
+    from wasser.equip import ServerWatcher
+    cloud = FakeCloud(boot_time=0.3, broken=['bad'])
+    watcher = ServerWatcher(cloud, min_wait=0.05, max_wait=0.1)
+    servers = [cloud.add_server(f'wa{_:02d}') for _ in range(5)]
+    bad = cloud.add_server('bad')
+    import threading
+    errors = []
+    def wait_bad():
+        try:
+            watcher.wait(bad.id, timeout=5)
+        except Exception as e:
+            errors.append(e)
+    t = threading.Thread(target=wait_bad)
+    t.start()
+    for _ in servers:
+        assert watcher.wait(_.id, timeout=5).status == 'ACTIVE'
+    t.join()
+    assert 'No valid host was found' in str(errors[0])
+    # single listing per tick for all servers, no per server polling
+    assert 'get_server' not in cloud.calls
+    assert cloud.calls['servers'] < 20
+    # the configured timeout is reported, not the time left
+    with pytest.raises(Exception, match='Timeout.* in 0.2 seconds'):
+        watcher.wait(cloud.add_server('slow', status='BUILD').id, timeout=0.2)
+
+
+def test_create_nodes_name_template(cloud, tmp_path):
+    cloud.add_server('wa00')
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor'),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+    Workflow(s).create_nodes()
+    assert sorted(_['name'] for _ in s.status['nodes'][0]) == ['wa01', 'wa02', 'wa03']
+    assert 'update_server' not in cloud.calls
+    # multi-create is opt-in, so the servers get the templated names
+    assert 'compute.create_server' not in cloud.calls
+    assert sorted(_['name'] for _ in cloud.servers.values()) == ['wa00', 'wa01', 'wa02', 'wa03']
+
+
+def test_name_allocator_conflict():
+    from wasser.equip import NameAllocator
+    cloud = FakeCloud()
+    # two processes listed the servers at the same time
+    first = NameAllocator(cloud, 'wa%02d')
+    second = NameAllocator(cloud, 'wa%02d')
+    names = [first.allocate(), second.allocate()]
+    servers = []
+    for allocator, name in zip([first, second], names):
+        claim = allocator.make_claim()
+        servers.append((allocator, claim, cloud.create_server(
+            name, 'image', 'flavor', meta={NameAllocator.claim_key: claim})))
+    assert servers[0][2].name == servers[1][2].name == 'wa00'
+    names = [a.claim(server, claim) for a, claim, server in reversed(servers)]
+    assert names == ['wa01', 'wa00']
+    assert sorted(_['name'] for _ in cloud.servers.values()) == ['wa00', 'wa01']
+
+
+def test_create_nodes_multi_create(cloud, tmp_path, monkeypatch):
+    import threading
+    cloud.add_server('wa00')
+    s = make_state(tmp_path, dict(
+        workflow=dict(node_threads=3),
+        openstack=dict(image='image', flavor='flavor', multi_create=True),
+        routines=dict(
+            a=dict(nodes=[dict(openstack={}) for _ in range(10)]),
+            b=dict(nodes=[dict(openstack=dict(flavor='big'))]),
+        ),
+    ))
+    cloud.flavors['big'] = FakeResource(id='flavor-big', name='big')
+    cloud.api_latency = 0.01
+    setup_threads = set()
+    set_server_metadata = cloud.compute.set_server_metadata
+
+    def record_thread(*args, **kwargs):
+        setup_threads.add(threading.current_thread().name)
+        return set_server_metadata(*args, **kwargs)
+    monkeypatch.setattr(cloud.compute, 'set_server_metadata', record_thread)
+    Workflow(s).create_nodes()
+    # batch servers are set up by 'node_threads' workers
+    assert 1 < len(setup_threads) <= 3
+    assert cloud.calls['compute.create_server'] == 1
+    assert cloud.calls['create_server'] == 1
+    nodes = s.status['nodes']
+    assert sorted(_['name'] for _ in nodes[0] + nodes[1]) == [f'wa{_:02d}' for _ in range(1, 12)]
+    # batch servers are not renamed, the node names are claimed with metadata
+    assert 'update_server' not in cloud.calls
+    assert all(cloud.servers[_['id']]['metadata']['wasser_name'] == _['name'] for _ in nodes[0])
+    assert len(set(_['ip'] for _ in nodes[0])) == 10
+    assert cloud.servers[nodes[1][0]['id']]['flavor'] == 'flavor-big'
+
+
+def test_snapshot_cache(cloud, tmp_path):
+    from test_workflow import RecordingHost
+
+    class BakingWorkflow(Workflow):
+        def get_routine_hosts(self, index):
+            self.hosts = [RecordingHost(_['name'], [], delay=0) for _ in self.state.status['nodes'][index]]
+            return self.hosts
+
+    def run(bake_command):
+        s = make_state(tmp_path, dict(
+            openstack=dict(image='image', flavor='flavor', name='node', snapshot_cache=dict(max_count=1)),
+            vars=dict(dependencies=['git']),
+            routines=dict(a=dict(steps=[
+                dict(name='bake', command=bake_command, bake=True),
+                'echo test',
+            ])),
+        ))
+        w = BakingWorkflow(s)
+        w.create_nodes()
+        w.run_routine(0, 'a')
+        return w, s.status['nodes'][0][0]
+
+    w, node = run('install')
+    assert w.hosts[0].commands == ['install', 'echo test']
+    assert 'snapshot' not in node
+    snapshot = next(_ for _ in cloud.images.values() if _.name.startswith('wasser-bake-'))
+    assert snapshot.server == node['id']
+    assert snapshot.metadata == dict(wasser_fingerprint=node['fingerprint'])
+
+    # same fingerprint, the node is booted from the snapshot
+    w, node = run('install')
+    assert w.hosts[0].commands == ['echo test']
+    assert node['snapshot'] == snapshot.id
+    assert cloud.servers[node['id']]['image'] == snapshot.id
+    assert cloud.calls['create_image_snapshot'] == 1
+
+    # changed bake steps make new snapshot, the old one is evicted
+    w, node = run('install more')
+    assert w.hosts[0].commands == ['install more', 'echo test']
+    assert cloud.calls['create_image_snapshot'] == 2
+    assert snapshot.id not in cloud.images
+
+    # snapshot deleted in the cloud is forgotten
+    cloud.delete_image(next(_.id for _ in cloud.images.values() if _.name.startswith('wasser-bake-')))
+    w, node = run('install more')
+    assert w.hosts[0].commands == ['install more', 'echo test']
+    assert cloud.calls['create_image_snapshot'] == 3
+
+
+def test_bake_fingerprint(tmp_path):
+    import os
+    s = make_state(tmp_path, dict(openstack=dict(image='image'), routines=dict(a=dict(steps=[]))))
+    steps = ['reboot', dict(name='bake', command='install {{ version }}', bake=True)]
+    s.status['env'] = dict(version='1')
+    first = Workflow(s).bake_fingerprint(s.status['spec'], steps)
+    s.status['env'] = dict(version='1', unused='x')
+    assert Workflow(s).bake_fingerprint(s.status['spec'], steps) == first
+    # the rendered commands are changed by the environment
+    s.status['env'] = dict(version='2')
+    assert Workflow(s).bake_fingerprint(s.status['spec'], steps) != first
+
+    copied = tmp_path / 'copied.sh'
+    copied.write_text('echo first')
+    s.status['spec']['copy'] = [{'from': [str(copied)], 'into': '/opt'}]
+    first = Workflow(s).bake_fingerprint(s.status['spec'], steps)
+    os.utime(copied, (0, 0))
+    assert Workflow(s).bake_fingerprint(s.status['spec'], steps) == first
+    # editing the copied file makes the baked snapshots stale
+    copied.write_text('echo second')
+    assert Workflow(s).bake_fingerprint(s.status['spec'], steps) != first
+
+
+def test_node_pool(cloud, tmp_path, monkeypatch):
+    import wasser
+    from wasser.equip import OpenStackEquipment
+    from test_workflow import RecordingHost
+    hosts = []
+
+    def get_host(server, labels=None):
+        hosts.append(RecordingHost(server['name'], [], delay=0))
+        return hosts[-1]
+    monkeypatch.setattr(wasser, 'get_host', get_host)
+
+    def create():
+        s = make_state(tmp_path, dict(
+            openstack=dict(image='image', flavor='flavor', name='node%02d', multi_create=True),
+            workflow=dict(node_pool=dict(ttl=60, reset='cleanup')),
+            routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(2)])),
+        ))
+        w = Workflow(s)
+        w.create_nodes()
+        w.errors = {}
+        return w, s.status['nodes'][0]
+
+    w, nodes = create()
+    ids = sorted(_['id'] for _ in nodes)
+    w.release_nodes()
+    drop = 'rm -f /opt/wasser/.manifest.json'
+    assert [_.commands for _ in hosts] == [['cleanup', drop], ['cleanup', drop]]
+    assert sorted(cloud.servers) == ids
+    assert [_['status'] for _ in nodes] == ['released'] * 2
+    pool = w.get_node_pool()
+    assert sorted(pool.load()) == ids
+
+    # idle nodes are leased instead of creating new ones
+    w, nodes = create()
+    assert cloud.calls['compute.create_server'] == 1
+    assert sorted(_['id'] for _ in nodes) == ids
+    assert all(_['pooled'] for _ in nodes)
+    assert set(_['status'] for _ in pool.load().values()) == {'leased'}
+
+    # nodes of failed routines are deleted
+    w.errors = {0: Exception('failed')}
+    w.release_nodes()
+    assert cloud.servers == {}
+    assert pool.load() == {}
+
+    # gone and expired nodes are removed from the pool
+    w, nodes = create()
+    w.release_nodes()
+    first, second = sorted(pool.load())
+    cloud.compute.delete_server(first)
+    data = pool.load()
+    data[second]['time'] -= 120
+    pool.save(data)
+    w, nodes = create()
+    assert cloud.calls['compute.create_server'] == 3
+    assert second not in cloud.servers
+    assert not set(_['id'] for _ in nodes) & {first, second}
+
+    # leased nodes deleted without release, like by 'wa delete', leave the pool
+    w.release_nodes()
+    w, nodes = create()
+    assert all(_['pooled'] for _ in nodes)
+    w.delete_nodes()
+    assert cloud.servers == {}
+    assert pool.load() == {}
+
+    # on create failure the leased nodes go back to the pool, only the created node is deleted
+    w, nodes = create()
+    w.release_nodes()
+    ids = sorted(pool.load())
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor', name='node%02d', multi_create=True),
+        workflow=dict(node_pool=dict(ttl=60, reset='cleanup')),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+
+    def setup_server(self, *args, **kwargs):
+        raise Exception('setup failed')
+    monkeypatch.setattr(OpenStackEquipment, 'setup_server', setup_server)
+    w = Workflow(s)
+    with pytest.raises(Exception, match='setup failed'):
+        w.create_nodes()
+    assert len(cloud.servers) == 3
+    w.release_nodes()
+    assert sorted(cloud.servers) == ids
+    assert sorted(pool.load()) == ids
+    assert set(_['status'] for _ in pool.load().values()) == {'idle'}
+
+
+def test_create_nodes_continue(cloud, tmp_path):
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor', name='node%02d'),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+    alive = cloud.add_server('node00')
+    s.status['nodes'] = [[dict(id=alive.id, name='node00'), dict(id='server-gone', name='node01'), {}]]
+    Workflow(s, resume=True).create_nodes()
+    nodes = s.status['nodes'][0]
+    assert nodes[0]['id'] == alive.id
+    assert len(cloud.servers) == 3
+    assert 'server-gone' not in [_['id'] for _ in nodes]
+
+
+def test_create_batch_failure(cloud, tmp_path, monkeypatch):
+    from wasser.equip import OpenStackEquipment
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor', multi_create=True),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+    create_server = cloud.compute.create_server
+
+    def create_more(**kwargs):
+        # the cloud booted more servers than requested
+        kwargs.update(min_count=4, max_count=4)
+        return create_server(**kwargs)
+    monkeypatch.setattr(cloud.compute, 'create_server', create_more)
+    w = Workflow(s)
+    with pytest.raises(Exception, match='Expected 3 servers'):
+        w.create_nodes()
+    # the unexpected server is deleted and the others are known to the state
+    assert len(cloud.servers) == 3
+    assert sorted(_['id'] for _ in s.status['nodes'][0]) == sorted(cloud.servers)
+    w.delete_nodes()
+    assert cloud.servers == {}
+
+
+def test_create_batch_name_conflict(cloud, tmp_path):
+    s = make_state(tmp_path, dict(
+        openstack=dict(image='image', flavor='flavor', multi_create=True),
+        routines=dict(a=dict(nodes=[dict(openstack={}) for _ in range(3)])),
+    ))
+    cloud.conflict_rate = 0.5
+    Workflow(s).create_nodes()
+    nodes = s.status['nodes'][0]
+    names = [_['name'] for _ in nodes]
+    assert len(set(names)) == 3
+    foreign = [_['name'] for _ in cloud.servers.values() if _.get('foreign')]
+    assert foreign and not set(names) & set(foreign)
+    assert 'update_server' not in cloud.calls
@@ -0,0 +1,49 @@
+import threading
+
+from fakecloud import FakeCloud
+from harness import run_workflow
+from test_scale import make_spec, label_nodes
+from wasser import profiler
+from wasser.profiler import Profiler
+
+
+def busy_loop(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+def test_profiler_sample():
+    p = Profiler()
+    stopped = threading.Event()
+    t = threading.Thread(target=busy_loop, args=(stopped,), name='busy_1')
+    t.start()
+    try:
+        p.phase = 'busy'
+        for _ in range(20):
+            p.sample()
+    finally:
+        stopped.set()
+        t.join()
+    stacks = [_ for _ in p.samples['busy'] if _.startswith('busy;')]
+    assert stacks
+    assert all('busy_loop (test_profiler.py:' in _ for _ in stacks)
+    total, own, inclusive = p.top(5)
+    assert total >= sum(p.samples['busy'][_] for _ in stacks)
+    assert any(_[0].startswith('busy_loop ') for _ in inclusive)
+
+
+def test_profiling(tmp_path, monkeypatch):
+    cloud = FakeCloud(boot_time=0.1)
+    spec = label_nodes(make_spec(routines=2, nodes=3))
+    path = tmp_path / 'profile'
+    with profiler.profiling(str(path), interval=0.001) as p:
+        report = run_workflow(spec, cloud, tmp_path, monkeypatch)
+    assert report['exit_code'] == 0
+    assert profiler._profiler is None
+    assert p.thread is None
+    assert set(p.samples) <= {None, 'load', 'create', 'provision', 'routines', 'teardown'}
+    assert sum(sum(_.values()) for _ in p.samples.values()) > 0
+    for phase in p.samples:
+        lines = (path / f'{phase or "other"}.folded').read_text().splitlines()
+        assert all(_.rsplit(' ', 1)[1].isdigit() for _ in lines)
+    assert 'Top' in p.summary()
@@ -0,0 +1,98 @@
+import pytest
+
+from fakecloud import FakeCloud
+from harness import run_workflow, format_report
+
+
+def make_spec(routines=4, nodes=50, **openstack):
+    return dict(
+        openstack=dict(image='image', flavor='flavor', keyname='wasser', name='node%03d', **openstack),
+        workflow=dict(threads=routines, node_threads=16),
+        routines={f'routine{r}': dict(
+            nodes=[dict(openstack={}) for _ in range(nodes)],
+            steps=[
+                'echo first',
+                dict(name='on all nodes', command='hostname', onall='all'),
+                'echo last',
+            ],
+        ) for r in range(routines)},
+    )
+
+
+def label_nodes(spec):
+    for routine in spec['routines'].values():
+        for node in routine['nodes']:
+            node['label'] = 'all'
+    return spec
+
+
+def test_scale_200_nodes(tmp_path, monkeypatch):
+    cloud = FakeCloud(boot_time=0.5, api_latency=0.001, fip_latency=0.01)
+    spec = label_nodes(make_spec(floating='ext', multi_create=True))
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch)
+    print(format_report(report))
+    assert report['exit_code'] == 0
+    assert report['servers_left'] == 0
+    assert report['floating_ips_left'] == 0
+    # identical nodes of all routines are created with single request
+    assert report['api_calls']['compute.create_server'] == 1
+    # node names of the batch are claimed with single listing, the rest is server watcher polling
+    assert report['api_calls']['servers'] < 20
+    # provisioning, 2 single node steps and 1 step on each node
+    assert report['commands'] == 200 + 4 * 2 + 200
+    # commands are run by a single event loop, only deletes use thread per node
+    assert report['peak_threads'] < 250
+
+
+def test_scale_name_conflicts(tmp_path, monkeypatch):
+    cloud = FakeCloud(conflict_rate=0.2, seed=1)
+    spec = label_nodes(make_spec(routines=2, nodes=20))
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch, trace_memory=True)
+    print(format_report(report))
+    assert report['exit_code'] == 0
+    assert report['peak_memory'] > 0
+    assert report['api_calls']['update_server'] > 0
+    assert report['servers_left'] == 0
+
+
+@pytest.mark.parametrize('failure', [dict(error_rate=0.05), dict(fip_error_rate=0.05)])
+def test_scale_failures_cleanup(tmp_path, monkeypatch, failure):
+    cloud = FakeCloud(boot_time=0.1, seed=2, **failure)
+    spec = label_nodes(make_spec(routines=2, nodes=50, floating='ext', multi_create=True))
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch)
+    print(format_report(report))
+    assert report['exit_code'] == 1
+    assert report['commands'] == 0
+    assert report['servers_left'] == 0
+    assert report['floating_ips_left'] == 0
+
+
+def test_run_continue(tmp_path, monkeypatch):
+    from harness import FakeRemoteShell
+    cloud = FakeCloud()
+    spec = make_spec(routines=1, nodes=2, multi_create=True)
+    spec['routines']['routine0']['steps'] = ['echo first', 'check', 'echo last']
+    commands = []
+
+    async def arun(self, command, name=None, timeout=None):
+        if command == 'check' and failing:
+            raise Exception('check failed')
+        commands.append(command)
+    monkeypatch.setattr(FakeRemoteShell, 'arun', arun)
+
+    failing = True
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch, keep_failed=True)
+    assert report['exit_code'] == 1
+    # the nodes of the failed run are kept to be continued
+    assert report['servers_left'] == 2
+    assert 'echo first' in commands
+
+    failing = False
+    commands.clear()
+    report = run_workflow(spec, cloud, tmp_path, monkeypatch, resume=True)
+    assert report['exit_code'] == 0
+    # the servers are reused, and the completed steps are skipped
+    assert report['api_calls']['compute.create_server'] == 1
+    assert 'echo first' not in commands
+    assert commands[-2:] == ['check', 'echo last']
+    assert report['servers_left'] == 0
@@ -0,0 +1,298 @@
+import threading
+
+from wasser.shell import ConnectionPool
+
+
+class FakeTransport():
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeClient():
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+def test_connection_pool_reuse():
+    pool = ConnectionPool()
+    clients = []
+    def connect():
+        clients.append(FakeClient())
+        return clients[-1]
+    key = ('10.0.0.1', 'root', '~/.ssh/id_rsa')
+    threads = [threading.Thread(target=pool.get, args=(key, connect)) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(clients) == 1
+    assert clients[0].transport.keepalive == ConnectionPool.keepalive
+    assert pool.get(('10.0.0.2', 'root', '~/.ssh/id_rsa'), connect) is clients[1]
+
+
+def test_connection_pool_reconnect():
+    pool = ConnectionPool()
+    key = ('10.0.0.1', 'root', '~/.ssh/id_rsa')
+    first = pool.get(key, FakeClient)
+    # transport is closed, for example, after reboot
+    first.transport.active = False
+    second = pool.get(key, FakeClient)
+    assert second is not first
+    assert first.closed
+    third = pool.reconnect(key, FakeClient)
+    assert third is not second
+    assert second.closed
+    assert pool.get(key, FakeClient) is third
+
+
+def test_output_sink_lines(caplog):
+    import logging
+    from wasser.shell import StepOutput
+    caplog.set_level(logging.INFO)
+    output = StepOutput('>>> ', 'EEE ')
+    output.stdout.feed(b'first\nsec')
+    output.stdout.feed(b'ond\nthi')
+    output.stderr.feed(b'error\n')
+    output.close()
+    assert list(output.tail) == ['first', 'second', 'error', 'thi']
+    assert [_.getMessage() for _ in caplog.records] == ['>>> first', '>>> second', 'EEE error', '>>> thi']
+
+
+def test_local_shell_output(tmp_path, caplog):
+    import logging
+    import pytest
+    from wasser.shell import LocalShell
+    caplog.set_level(logging.INFO)
+    shell = LocalShell('root')
+    shell.log_dir = str(tmp_path)
+    shell.run('for i in $(seq 1000); do echo line $i; done; echo oops > /dev/stderr', name='print lines')
+    logs = '\n'.join(_.getMessage() for _ in caplog.records)
+    assert '>>> line 1000' in logs
+    assert 'EEE oops' in logs
+    log_files = list(tmp_path.iterdir())
+    assert len(log_files) == 1
+    assert log_files[0].name.endswith('-local-print-lines.log')
+    assert log_files[0].read_text().count('\n') == 1001
+    with pytest.raises(Exception, match='(?s)exit code 3.*Last output lines:\nline 51\n.*\nline 100$'):
+        shell.run('seq -f "line %g" 100; exit 3')
+    with pytest.raises(Exception, match='timeout'):
+        shell.run('sleep 5', timeout=0.2)
+
+
+class FakeSFTP():
+    """SFTP client stand-in, which maps remote paths into local root"""
+    def __init__(self, root):
+        self.root = root
+        self.puts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def local(self, path):
+        return str(self.root) + path
+
+    def normalize(self, path):
+        # the session starts in the home directory
+        return '/root' if path == '.' else path
+
+    def stat(self, path):
+        import os
+        return os.stat(self.local(path))
+
+    def mkdir(self, path):
+        import os
+        os.mkdir(self.local(path))
+
+    def put(self, src, dest):
+        import shutil
+        self.puts.append(dest)
+        shutil.copy(src, self.local(dest))
+
+    def chmod(self, path, mode):
+        import os
+        os.chmod(self.local(path), mode)
+
+    def utime(self, path, times):
+        import os
+        os.utime(self.local(path), times)
+
+    def open(self, path, mode='r'):
+        return open(self.local(path), mode)
+
+
+class FakeTarStream():
+    """Remote tar command stand-in, which unpacks the stream into local root"""
+    def __init__(self, root, command):
+        import io
+        self.root = root
+        self.command = command
+        self.data = io.BytesIO()
+        self.channel = self
+
+    def write(self, data):
+        self.data.write(data)
+
+    def close(self):
+        pass
+
+    def shutdown_write(self):
+        import tarfile
+        self.data.seek(0)
+        with tarfile.open(fileobj=self.data, mode='r|gz') as tar:
+            tar.extractall(self.root)
+
+    def recv_exit_status(self):
+        return 0
+
+    def read(self):
+        return b''
+
+
+class FakeSSHClient(FakeClient):
+    def __init__(self, sftp):
+        super().__init__()
+        self.sftp = sftp
+        self.commands = []
+
+    def open_sftp(self):
+        return self.sftp
+
+    def exec_command(self, command, timeout=None):
+        self.commands.append(command)
+        stream = FakeTarStream(self.sftp.root, command)
+        return stream, stream, stream
+
+
+def make_remote_shell(tmp_path, monkeypatch):
+    from wasser.shell import RemoteShell
+    remote = tmp_path / 'remote'
+    (remote / 'opt' / 'wasser').mkdir(parents=True)
+    sftp = FakeSFTP(remote)
+    shell = RemoteShell('10.0.0.1', 'root')
+    client = FakeSSHClient(sftp)
+    monkeypatch.setattr(shell, 'get_client', lambda: client)
+    return shell, sftp
+
+
+def test_copy_files_sync(tmp_path, monkeypatch):
+    import os
+    shell, sftp = make_remote_shell(tmp_path, monkeypatch)
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'a.sh').write_text('echo a')
+    (src / 'sub' / 'b.txt').write_text('b' * 100)
+    single = tmp_path / 'single.txt'
+    single.write_text('single')
+    spec = [
+        dict(**{'from': [str(src)], 'into': '/opt/wasser/data', 'mode': '0755'}),
+        dict(**{'from': [str(single)], 'into': '/opt/wasser', 'compare': 'hash'}),
+    ]
+    stats = shell.copy_files(spec)
+    assert stats == dict(sent_files=3, sent_bytes=112, skipped_files=0, skipped_bytes=0)
+    assert (sftp.root / 'opt/wasser/.manifest.json').exists()
+    assert (sftp.root / 'opt/wasser/data/src/sub/b.txt').read_text() == 'b' * 100
+    assert os.stat(sftp.root / 'opt/wasser/data/src/a.sh').st_mode & 0o777 == 0o755
+
+    stats = shell.copy_files(spec)
+    assert stats == dict(sent_files=0, sent_bytes=0, skipped_files=3, skipped_bytes=112)
+
+    (src / 'a.sh').write_text('echo changed')
+    os.utime(single, (0, 0))
+    stats = shell.copy_files(spec)
+    # single file is compared by hash, so touching it does not matter
+    assert stats == dict(sent_files=1, sent_bytes=12, skipped_files=2, skipped_bytes=106)
+    assert sftp.puts[-1] == '/opt/wasser/data/src/a.sh'
+
+
+def test_copy_files_bulk(tmp_path, monkeypatch):
+    import os
+    shell, sftp = make_remote_shell(tmp_path, monkeypatch)
+    shell.large_file_size = 1000
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(5):
+        (src / f'{i}.txt').write_text(str(i))
+    os.chmod(src / '0.txt', 0o700)
+    (src / 'large.bin').write_bytes(b'x' * 2000)
+    spec = [dict(**{'from': [str(src)], 'into': '/opt/wasser'})]
+    stats = shell.copy_files(spec)
+    assert stats['sent_files'] == 6
+    # small files are sent with single tar stream, large file with sftp
+    assert shell.get_client().commands == ['tar --no-same-owner -xzpf - -C /']
+    assert sftp.puts == ['/opt/wasser/src/large.bin']
+    assert (sftp.root / 'opt/wasser/src/4.txt').read_text() == '4'
+    assert os.stat(sftp.root / 'opt/wasser/src/0.txt').st_mode & 0o777 == 0o700
+
+    stats = shell.copy_files(spec)
+    assert stats['skipped_files'] == 6
+
+    (src / '1.txt').write_text('changed')
+    (src / '2.txt').write_text('changed')
+    shell.copy_files(spec, bulk=False)
+    assert sorted(sftp.puts) == ['/opt/wasser/src/1.txt', '/opt/wasser/src/2.txt', '/opt/wasser/src/large.bin']
+
+
+def test_copy_files_relative(tmp_path, monkeypatch):
+    import pytest
+    import socket
+    shell, sftp = make_remote_shell(tmp_path, monkeypatch)
+    (sftp.root / 'root').mkdir()
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(3):
+        (src / f'{i}.txt').write_text(str(i))
+    spec = [dict(**{'from': [str(src)], 'into': 'data'})]
+    shell.copy_files(spec)
+    # relative paths are resolved against the remote home directory
+    assert (sftp.root / 'root/data/src/2.txt').read_text() == '2'
+    assert not (sftp.root / 'data').exists()
+    shell.copy_files(spec, bulk=False)
+    assert sftp.puts == []
+
+    def stalled(self, data):
+        raise socket.timeout()
+    monkeypatch.setattr(FakeTarStream, 'write', stalled)
+    (src / '0.txt').write_text('changed')
+    (src / '1.txt').write_text('changed')
+    with pytest.raises(Exception, match='timeout'):
+        shell.copy_files(spec)
+
+
+def test_copy_files_remote_changed(tmp_path, monkeypatch):
+    import os
+    shell, sftp = make_remote_shell(tmp_path, monkeypatch)
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(3):
+        (src / f'{i}.txt').write_text(str(i))
+    spec = [dict(**{'from': [str(src)], 'into': '/opt/wasser/data'})]
+    shell.copy_files(spec, bulk=False)
+    assert shell.copy_files(spec)['skipped_files'] == 3
+
+    # the manifest outlives the remote files, e.g. after a node reset
+    os.remove(sftp.root / 'opt/wasser/data/src/0.txt')
+    (sftp.root / 'opt/wasser/data/src/1.txt').write_text('edited remotely')
+    sftp.puts.clear()
+    stats = shell.copy_files(spec, bulk=False)
+    assert stats['sent_files'] == 2
+    assert sorted(sftp.puts) == ['/opt/wasser/data/src/0.txt', '/opt/wasser/data/src/1.txt']
+    assert (sftp.root / 'opt/wasser/data/src/1.txt').read_text() == '1'
+    assert shell.copy_files(spec)['skipped_files'] == 3
@@ -1,3 +1,5 @@
+import argparse
+
 import pytest
 
 from wasser import state
@@ -143,3 +145,125 @@ def test_nodes_spec(conf, nodes):
         equip = w.get_equipment(r)
         print(f'Routine {r} Equipment:', [type(_).__name__ for _ in equip])
         assert nodes[i] == [type(_).__name__ for _ in equip]
+
+
+def test_state_save_coalescing(tmp_path, monkeypatch):
+    s = state.State()
+    s.args = argparse.Namespace(state_path=str(tmp_path / 'wasser_state'))
+    s.status['nodes'] = [[{} for _ in range(10)]]
+    writes = []
+    dump = state.json.dump
+    monkeypatch.setattr(state.json, 'dump', lambda *a, **kw: writes.append(1) or dump(*a, **kw))
+    for data in s.status['nodes'][0]:
+        node = state.NodeState(s, data)
+        node.update(username='root')
+        node.update(keyfile='key', name='wa')
+    assert writes == []
+    # server id is saved right away, so the node can be deleted after crash
+    node.update(id='server-1')
+    assert len(writes) == 1
+    node.update(ip='10.0.0.1')
+    s.flush()
+    assert len(writes) == 2
+    saved = state.State()
+    saved.load_state(s.state_path)
+    assert saved.status['nodes'][0][-1] == dict(username='root', keyfile='key', name='wa',
+                                                 id='server-1', ip='10.0.0.1')
+    assert [_.name for _ in tmp_path.iterdir()] == ['wasser_state']
+
+
+def test_override_copy_on_write():
+    src = dict(openstack=dict(name='target', flavor='small'), routines=dict(a=dict(steps=['ls'])))
+    data = dict(openstack=dict(flavor='large'), workflow=dict(threads=2))
+    res = state.override(src, data)
+    assert res == dict(openstack=dict(name='target', flavor='large'),
+                       routines=dict(a=dict(steps=['ls'])), workflow=dict(threads=2))
+    assert src['openstack']['flavor'] == 'small'
+    # only the overridden path is copied, the rest is shared
+    assert res['openstack'] is not src['openstack']
+    assert res['routines'] is src['routines']
+    assert res['workflow'] is data['workflow']
+    assert state.override(src, {}) is src
+
+
+def test_override_openstack_spec():
+    default = state.override(state.default_server_spec, {})
+    s = state.State()
+    s.override_status_specs([])
+    args = argparse.Namespace(openstack_cloud='mycloud', target_flavor=None, target_floating=None,
+                              target_image='image', target_keyfile='', target_keyname='',
+                              target_name='', target_network=None, target_username='')
+    s.override_openstack_spec(args)
+    assert s.status['spec']['openstack']['image'] == 'image'
+    assert s.status['spec']['openstack']['cloud'] == 'mycloud'
+    # the default spec shared with the status spec is intact
+    assert state.default_server_spec == default
+    assert state.default_server_spec['openstack']['image'] is None
+
+
+def test_load_spec_cache(tmp_path, monkeypatch):
+    import yaml
+    from wasser.cache import SpecCache
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.wasser.yaml').write_text(yaml.safe_dump(dict(openstack=dict(flavor='small'))))
+    spec_path = tmp_path / 'spec.yaml'
+    spec_path.write_text(yaml.safe_dump(dict(routines=dict(a=dict(steps=['ls'])))))
+    reads = []
+    read_spec = state.State.read_spec
+    monkeypatch.setattr(state.State, 'read_spec', lambda self, path: reads.append(path) or read_spec(self, path))
+
+    def load():
+        s = state.State()
+        s.args = argparse.Namespace(state_path=str(tmp_path / '.wasser_state'))
+        s.load_spec(str(spec_path))
+        return s.status['spec']
+
+    spec = load()
+    assert len(reads) == 2
+    assert spec['openstack']['flavor'] == 'small'
+    assert load() == spec
+    assert len(reads) == 2
+    # the cache is saved next to the state file
+    cache = SpecCache(str(tmp_path / '.wasser_specs'))
+    key = cache.files_key([str(tmp_path / '.wasser' / 'config.yaml'), '.wasser.yaml', str(spec_path)],
+                          state.default_server_spec)
+    assert cache.get(key) == spec
+    assert (tmp_path / '.wasser_specs').stat().st_mode & 0o777 == 0o600
+
+    spec_path.write_text(yaml.safe_dump(dict(routines=dict(b=dict(steps=['pwd'])))))
+    assert list(load()['routines']) == ['b']
+    assert len(reads) == 4
+
+
+def test_spec_cache_workflow_runs(tmp_path, monkeypatch):
+    import copy
+    import wasser
+    from fakecloud import FakeCloud
+    from harness import run_workflow
+    from test_scale import make_spec, label_nodes
+    from wasser.cache import get_spec_cache
+    specs = []
+    run = wasser.Workflow.run
+
+    def recording_run(self):
+        specs.append(copy.deepcopy(self.state.status['spec']))
+        try:
+            return run(self)
+        finally:
+            specs.append(copy.deepcopy(self.state.status['spec']))
+    monkeypatch.setattr(wasser.Workflow, 'run', recording_run)
+    reads = []
+    read_spec = state.State.read_spec
+    monkeypatch.setattr(state.State, 'read_spec', lambda self, path: reads.append(path) or read_spec(self, path))
+    cloud = FakeCloud()
+    spec = label_nodes(make_spec(routines=2, nodes=2, floating='ext'))
+    for _ in range(2):
+        assert run_workflow(spec, cloud, tmp_path, monkeypatch)['exit_code'] == 0
+    # the second run gets the cached spec, which is not changed by the runs
+    cache = get_spec_cache(str(tmp_path / '.wasser_specs'))
+    assert len(cache.data) == 1
+    assert len(reads) == 1
+    assert len(specs) == 4
+    assert all(_ == specs[0] for _ in specs[1:])
+    assert next(iter(cache.data.values()))['spec'] == specs[0]
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from fakecloud import FakeCloud
+from harness import run_workflow
+from test_scale import make_spec, label_nodes
+from wasser import timing
+from wasser.timing import Timings
+
+
+def test_timings_span():
+    t = Timings()
+    with t.span('disabled'):
+        pass
+    assert t.spans == []
+    t.enable()
+    with t.span('phase', routine='r', node='n', step=None):
+        pass
+    with pytest.raises(ValueError):
+        with t.span('phase', routine='r', node='n'):
+            raise ValueError('failed')
+    assert [_['phase'] for _ in t.spans] == ['phase', 'phase']
+    assert 'step' not in t.spans[0]
+    assert t.spans[1]['error'] == 'failed'
+    assert t.summary()['phase']['count'] == 2
+    events = [_ for _ in t.trace_events() if _['ph'] == 'X']
+    assert len(events) == 2
+    assert len(set((_['pid'], _['tid']) for _ in events)) == 1
+
+
+def test_timings_export(tmp_path, monkeypatch):
+    cloud = FakeCloud(boot_time=0.1)
+    spec = label_nodes(make_spec(routines=2, nodes=3, floating='ext'))
+    path = tmp_path / 'timings.json'
+    with timing.recording(str(path)):
+        report = run_workflow(spec, cloud, tmp_path, monkeypatch)
+    assert report['exit_code'] == 0
+    assert not timing.timings.enabled
+
+    data = json.loads(path.read_text())
+    phases = set(_['phase'] for _ in data['spans'])
+    assert phases >= {'spec_load', 'create_nodes', 'lookup', 'create_server', 'wait_active', 'rename',
+                      'floating_ip', 'provision', 'routine', 'step', 'teardown', 'delete'}
+    steps = [_ for _ in data['spans'] if _['phase'] == 'step']
+    # 2 single node steps and 1 step on each node of each routine
+    assert len(steps) == 2 * (2 + 3)
+    assert all(_['routine'] in ['routine0', 'routine1'] and _['node'] for _ in steps)
+    assert set(_['step'] for _ in steps) == {'echo first', 'on all nodes', 'echo last'}
+    assert data['summary']['provision']['count'] == 6
+
+    events = data['traceEvents']
+    processes = [_['args']['name'] for _ in events if _['name'] == 'process_name']
+    assert sorted(processes) == ['routine routine0', 'routine routine1', 'wasser']
+    lanes = [_['args']['name'] for _ in events if _['name'] == 'thread_name' and _['pid'] > 0]
+    assert len([_ for _ in lanes if _.startswith('node')]) == 6
+    complete = [_ for _ in events if _['ph'] == 'X']
+    assert len(complete) == len(data['spans'])
+    assert all(_['ts'] >= 0 and _['dur'] >= 0 for _ in complete)
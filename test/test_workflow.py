@@ -0,0 +1,460 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from wasser import state
+from wasser import Host, Routine, Workflow
+from wasser.equip import Equipment
+from wasser.shell import LocalShell, run_sync
+
+
+class RecordingWorkflow(Workflow):
+    """Workflow which does not touch any node, only records routine runs"""
+    def __init__(self, s, fail=(), delay=0.1):
+        super().__init__(s)
+        self.fail = fail
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.events = []
+
+    def provision_servers(self):
+        pass
+
+    def run_routine(self, index, name):
+        with self.lock:
+            self.events.append(('start', name))
+        time.sleep(self.delay)
+        with self.lock:
+            self.events.append(('end', name))
+        if name in self.fail:
+            raise Exception(f'{name} failed')
+
+
+def make_workflow(workflow, fail=()):
+    s = state.State()
+    s.override_status_specs([dict(
+        routines=dict(a=dict(), b=dict(), c=dict()),
+        workflow=workflow,
+    )])
+    return RecordingWorkflow(s, fail=fail)
+
+
+def test_run_parallel_routines():
+    w = make_workflow(dict(threads=3))
+    start = time.time()
+    w.run()
+    assert time.time() - start < 0.25
+    assert [_[0] for _ in w.events[:3]] == ['start'] * 3
+
+
+def test_run_after_routines():
+    w = make_workflow(dict(
+        threads=3,
+        routines=['a', dict(name='b', after='a'), dict(name='c', after=['a', 'b'])],
+    ))
+    w.run()
+    assert w.events == [
+        ('start', 'a'), ('end', 'a'),
+        ('start', 'b'), ('end', 'b'),
+        ('start', 'c'), ('end', 'c'),
+    ]
+
+
+def test_run_skips_after_failed_routine():
+    w = make_workflow(dict(
+        threads=2,
+        routines=['a', 'b', dict(name='c', after='a')],
+    ), fail=['a'])
+    with pytest.raises(Exception, match='a failed'):
+        w.run()
+    assert ('start', 'b') in w.events
+    assert ('start', 'c') not in w.events
+    assert sorted(w.errors) == [0, 2]
+
+
+@pytest.mark.parametrize(
+    'routines',
+    [
+        [dict(name='a', after='b'), dict(name='b', after='a')],
+        [dict(name='a', after='x')],
+        [dict(name='a', after='a')],
+    ]
+)
+def test_run_invalid_graph(routines):
+    w = make_workflow(dict(routines=routines))
+    with pytest.raises(Exception):
+        w.run()
+    assert w.events == []
+
+
+def test_run_interrupted(monkeypatch):
+    import wasser
+
+    class RoutineWorkflow(RecordingWorkflow):
+        def run_routine(self, index, name):
+            self.events.append(('start', name))
+            Routine([RecordingHost(name, [], delay=10)]).run(['sleep'])
+            self.events.append(('end', name))
+
+    def interrupt(*args, **kwargs):
+        time.sleep(0.2)
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(wasser, 'wait', interrupt)
+    w = make_workflow(dict(threads=1))
+    w.__class__ = RoutineWorkflow
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        w.run()
+    assert time.time() - start < 2
+    # the running routine is cancelled, the queued ones are never started
+    threads = [_ for _ in threading.enumerate() if _.name.startswith('routine')]
+    for t in threads:
+        t.join(2)
+    assert not any(_.is_alive() for _ in threads)
+    assert w.events == [('start', 'a')]
+
+
+class FakeEquipment(Equipment):
+    def __init__(self, name, fail=False, delay=0.1):
+        self.state = state.NodeState(None, dict(name=name))
+        self.fail = fail
+        self.delay = delay
+        self.created = False
+
+    def create(self):
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception(f'{self.state.data["name"]} is broken')
+        self.created = True
+
+
+def test_create_nodes_parallel():
+    s = state.State()
+    s.override_status_specs([dict(workflow=dict(node_threads=4))])
+    w = Workflow(s)
+    equipment = [FakeEquipment(f'n{_}') for _ in range(8)]
+    w.get_equipment = lambda: equipment
+    start = time.time()
+    w.create_nodes()
+    assert time.time() - start < 0.35
+    assert all(_.created for _ in equipment)
+
+
+def test_create_nodes_failure():
+    s = state.State()
+    s.override_status_specs([dict(workflow=dict(node_threads=2))])
+    w = Workflow(s)
+    equipment = [FakeEquipment('n0', fail=True, delay=0)] + [FakeEquipment(f'n{_}') for _ in range(1, 6)]
+    w.get_equipment = lambda: equipment
+    with pytest.raises(Exception, match='n0 is broken'):
+        w.create_nodes()
+    assert not all(_.created for _ in equipment[1:])
+
+
+class RecordingHost(Host):
+    def __init__(self, name, labels, delay=0.1):
+        super().__init__(name, labels=labels)
+        self.delay = delay
+        self.commands = []
+
+    async def arun(self, command, **kwargs):
+        await asyncio.sleep(self.delay)
+        if 'fail' in command:
+            raise Exception(f'{command} on {self.name}')
+        self.commands.append(command)
+
+
+def test_routine_onall_onany(monkeypatch):
+    import wasser
+    monkeypatch.setattr(wasser, 'host_load', wasser.HostLoad())
+    hosts = [
+        RecordingHost('mgr1', ['mgr']),
+        RecordingHost('mgr2', 'mgr'),
+        RecordingHost('cli1', ['cli']),
+        RecordingHost('cli2', ['cli', 'mon']),
+    ]
+    routine = Routine(hosts)
+    start = time.time()
+    routine.run([
+        dict(command='on mgr', onall='mgr'),
+        dict(command='on mgr mon', onall=['mgr', 'mon']),
+        dict(command='any cli 1', onany='cli'),
+        dict(command='any cli 2', onany='cli'),
+        'on first',
+    ])
+    # the onall steps are run concurrently
+    assert time.time() - start < 0.6
+    assert hosts[0].commands == ['on mgr', 'on mgr mon', 'on first']
+    assert hosts[1].commands == ['on mgr', 'on mgr mon']
+    # cli2 already run one command, so both onany steps go to cli1
+    assert hosts[2].commands == ['any cli 1', 'any cli 2']
+    assert hosts[3].commands == ['on mgr mon']
+    assert hosts[0].shell.tag == '[mgr1] '
+
+
+
+def test_routine_onany_shared(monkeypatch):
+    import wasser
+    monkeypatch.setattr(wasser, 'host_load', wasser.HostLoad())
+    hosts = [RecordingHost(f'n{_}', ['all'], delay=0.2) for _ in range(2)]
+    # concurrent routines share the hosts and their load
+    routines = [Routine([RecordingHost(_.name, ['all'], delay=0.2) for _ in hosts]) for _ in range(2)]
+
+    async def run_all():
+        await asyncio.gather(*[r.arun([dict(command=f'any {i}', onany='all')]) for i, r in enumerate(routines)])
+    run_sync(run_all())
+    busy = [h.name for r in routines for h in r.hosts if h.commands]
+    assert sorted(busy) == ['n0', 'n1']
+
+
+def test_routine_builtins_on_labels(monkeypatch):
+    import wasser
+    monkeypatch.setattr(wasser, 'host_load', wasser.HostLoad())
+    hosts = [RecordingHost('a', ['x'], delay=0), RecordingHost('b', ['x'], delay=0), RecordingHost('c', [], delay=0)]
+    connected = []
+    for h in hosts:
+        monkeypatch.setattr(h.shell, 'connect_client', lambda name=h.name: connected.append(name))
+    Routine(hosts).run([
+        dict(command='reboot', onall='x'),
+        dict(command='wait_host', onall='x'),
+        'reconnect',
+    ])
+    assert [_.commands for _ in hosts] == [['sudo reboot &'], ['sudo reboot &'], []]
+    assert sorted(connected) == ['a', 'a', 'b']
+
+def test_routine_onall_errors():
+    hosts = [RecordingHost(f'n{_}', ['all'], delay=0) for _ in range(3)]
+    routine = Routine(hosts)
+    with pytest.raises(Exception, match='3 of 3 hosts'):
+        routine.run([
+            dict(command='fail', onall='all'),
+            dict(command='skipped', onall='all'),
+            dict(command='cleanup', onall='all', always=True),
+        ])
+    assert all(_.commands == ['cleanup'] for _ in hosts)
+    with pytest.raises(Exception, match='No nodes found with label "x"'):
+        routine.run([dict(command='true', onany='x')])
+
+
+def test_compile_steps():
+    from wasser import get_template, render_command
+    s = state.State()
+    s.status['env'] = dict(github_url='https://github.com/aquarist-labs/wasser')
+    s.override_status_specs([dict(routines=dict(a=dict(steps=[
+        'reboot',
+        'echo {{ github_url }}',
+        dict(name='clone', command='git clone {{ github_url }}'),
+    ])))])
+    w = Workflow(s)
+    w.compile_steps()
+    assert get_template('echo {{ github_url }}') is get_template('echo {{ github_url }}')
+    assert render_command('echo {{ github_url }}', s.status['env']) == \
+        'echo https://github.com/aquarist-labs/wasser'
+
+    s.override_status_specs([dict(
+        routines=dict(a=dict(steps=[dict(name='build', command='make {{ target }}')])),
+        workflow=dict(strict_templates=True),
+    )])
+    with pytest.raises(Exception, match='Undefined variables in step "build" of routine "a": target'):
+        w.compile_steps()
+
+    s.override_status_specs([dict(routines=dict(a=dict(steps=['echo {{ broken'])))])
+    with pytest.raises(Exception, match='Cannot compile step'):
+        w.compile_steps()
+
+
+def test_routines_on_single_loop():
+    """Many routines are run concurrently by a single event loop"""
+    routines = [Routine([Host(f'local{_}')]) for _ in range(50)]
+    threads = threading.active_count()
+    async def run_all():
+        await asyncio.gather(*[r.arun(['sleep 0.3']) for r in routines])
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+    assert time.time() - start < 3
+    if not LocalShell.use_threads:
+        assert threading.active_count() - threads < len(routines)
+
+
+def test_routine_cancel():
+    routine = Routine([Host('local')])
+    async def run_cancelled():
+        task = asyncio.ensure_future(routine.arun(['sleep 10']))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_cancelled())
+    finally:
+        loop.close()
+    assert time.time() - start < 2
+
+
+@pytest.mark.parametrize('use_threads', [False, True])
+def test_local_shell(monkeypatch, use_threads):
+    monkeypatch.setattr(LocalShell, 'use_threads', use_threads)
+    shell = LocalShell(None)
+    shell.run('echo out; echo err >&2')
+    with pytest.raises(Exception, match='Received exit code 3') as e:
+        shell.run('echo out; exit 3')
+    assert str(e.value).endswith('Last output lines:\nout')
+    with pytest.raises(Exception, match='timeout 1 seconds'):
+        shell.run('sleep 10', timeout=1)
+    start = time.time()
+    with pytest.raises(asyncio.TimeoutError):
+        # the command is killed when the waiting is interrupted
+        run_sync(asyncio.wait_for(shell.arun('sleep 10'), 0.3))
+    assert time.time() - start < 2
+
+
+class ProvisionHost(RecordingHost):
+    def __init__(self, name, delay=0.2):
+        super().__init__(name, labels=[], delay=delay)
+        self.addr = '10.0.0.1'
+        self.user = 'opensuse'
+        self.copies = []
+
+    async def acopy_files(self, spec):
+        self.copies.append(spec)
+
+
+def test_provision_servers(monkeypatch):
+    import wasser
+    hosts = {}
+
+    def get_host(server, labels=None):
+        hosts[server['name']] = ProvisionHost(server['name'])
+        return hosts[server['name']]
+    monkeypatch.setattr(wasser, 'get_host', get_host)
+    s = state.State()
+    s.override_status_specs([dict(vars=dict(dependencies=['git', 'jq']))])
+    s.status['nodes'] = [[dict(name='a'), dict(name='b')], [dict(name='c')]]
+    w = Workflow(s)
+    start = time.time()
+    w.provision_servers()
+    # all nodes are provisioned concurrently with single command each
+    assert time.time() - start < 0.5
+    assert sorted(w.provision_times) == ['a', 'b', 'c']
+    for h in hosts.values():
+        assert len(h.commands) == 1
+        assert 'sudo zypper install -y git jq 2>&1' in h.commands[0].split('\n')
+        assert len(h.copies) == 1
+
+    s.status['nodes'] = [[dict(name='fail1'), dict(name='b')]]
+    with pytest.raises(Exception, match='Failed to provision 1 of 2 nodes: fail1'):
+        w.provision_servers()
+    assert len(hosts['b'].copies) == 1
+
+
+def test_provision_script_hosts(tmp_path):
+    import subprocess
+    from wasser import provision_script
+    hosts = tmp_path / 'hosts'
+    hosts.write_text('127.0.0.1\tlocalhost\n')
+    script = provision_script({}, ProvisionHost('node'))
+    line = [_ for _ in script.split('\n') if '/etc/hosts' in _][0]
+    line = line.replace('/etc/hosts', str(hosts)).replace('sudo ', '')
+    for _ in range(2):
+        subprocess.run(['bash', '-c', line], check=True, stdout=subprocess.DEVNULL)
+    assert hosts.read_text() == '127.0.0.1\tlocalhost\n10.0.0.1\tnode.suse.de\n'
+
+
+def test_routine_resume():
+    from wasser.state import NodeState
+    s = state.State()
+    hosts = [RecordingHost('mgr1', ['mgr'], delay=0), RecordingHost('mgr2', ['mgr'], delay=0)]
+    for h in hosts:
+        h.node_state = NodeState(s, {})
+    steps = [
+        'echo one',
+        dict(command='echo all', onall='mgr'),
+        'echo one',
+        dict(command='fail', name='failing'),
+        'echo last',
+    ]
+    with pytest.raises(Exception, match='fail on mgr1'):
+        Routine(hosts).run(steps)
+    assert hosts[0].commands == ['echo one', 'echo all', 'echo one']
+    assert len(hosts[0].node_state.data['steps']) == 3
+    assert hosts[1].commands == ['echo all']
+
+    # completed steps are skipped, the changed step and the rest are run
+    for h in hosts:
+        h.commands.clear()
+    steps[3] = dict(command='echo fixed', name='failing')
+    steps[1]['command'] = 'echo all changed'
+    Routine(hosts, resume=True).run(steps)
+    assert hosts[0].commands == ['echo all changed', 'echo fixed', 'echo last']
+    assert hosts[1].commands == ['echo all changed']
+
+
+def test_routine_resume_always():
+    from wasser.state import NodeState
+    s = state.State()
+    host = RecordingHost('mgr1', ['mgr'], delay=0)
+    host.node_state = NodeState(s, {})
+    steps = [
+        'echo one',
+        dict(command='fail', name='failing'),
+        dict(command='cleanup', always=True),
+    ]
+    with pytest.raises(Exception, match='fail on mgr1'):
+        Routine([host]).run(steps)
+    assert host.commands == ['echo one', 'cleanup']
+    assert list(host.node_state.data['steps'].values()) == [None]
+
+    # the cleanup step is run again on resume
+    host.commands.clear()
+    steps[1] = dict(command='echo fixed', name='failing')
+    Routine([host], resume=True).run(steps)
+    assert host.commands == ['echo fixed', 'cleanup']
+
+
+def test_state_resume(tmp_path):
+    import json
+    path = tmp_path / 'wasser_state'
+    path.write_text(json.dumps(dict(nodes=[[dict(id='1', steps={'x': 'step'}), dict(id='2', status='deleted')]])))
+    s = state.State()
+    s.resume_state(str(path))
+    assert s.status['nodes'] == [[dict(id='1', steps={'x': 'step'}), {}]]
+
+
+def test_checkout_fast(tmp_path):
+    import os
+    import subprocess
+    from wasser import get_seed_bundle, wasser_remote_dir
+    mirror = tmp_path / 'mirror'
+    subprocess.run(['git', 'init', '-q', str(mirror)], check=True)
+    subprocess.run(['git', '-C', str(mirror), 'checkout', '-q', '-b', 'main'], check=True)
+    subprocess.run(['git', '-C', str(mirror), '-c', 'user.name=a', '-c', 'user.email=a@b',
+                    'commit', '-q', '--allow-empty', '-m', 'init'], check=True)
+    host = ProvisionHost('node', delay=0)
+    Routine([host]).run([
+        dict(checkout=dict(url='https://github.com/x/y', branch='main', depth=10, filter='blob:none')),
+        dict(checkout=dict(url='https://github.com/x/y', branch='main', fast=True, seed=str(mirror))),
+    ])
+    assert host.commands[0].startswith('CHECKOUT_DEPTH=10 CHECKOUT_FILTER=blob:none ')
+    bundle = get_seed_bundle(str(mirror), 'main')
+    assert host.copies == [[{'from': [bundle], 'into': f'{wasser_remote_dir}/seed'}]]
+    assert host.commands[1].startswith(f'CHECKOUT_DEPTH=1 CHECKOUT_BUNDLE={wasser_remote_dir}/seed/')
+    heads = subprocess.run(['git', 'bundle', 'list-heads', bundle],
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert heads.strip().endswith('refs/heads/main')
+    assert get_seed_bundle(str(mirror), 'main') == bundle
+    assert not [_ for _ in os.listdir(os.path.dirname(bundle)) if _.startswith(os.path.basename(bundle) + '.')]
+
+    # the local host checks out from the bundle in place
+    local = RecordingHost('local', [], delay=0)
+    Routine([local]).run([
+        dict(checkout=dict(url='https://github.com/x/y', branch='main', fast=True, seed=str(mirror))),
+    ])
+    assert local.commands[0].startswith(f'CHECKOUT_DEPTH=1 CHECKOUT_BUNDLE={bundle} ')
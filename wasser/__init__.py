@@ -12,25 +12,41 @@ except of 'w' of course, since it is already taken by system utility.
 """
 
 import argparse
+import asyncio
+import hashlib
 import logging
 import os
 import traceback
 import time
 import signal
 import sys
+import threading
 
 import json
 
-from wasser.shell import RemoteShell, LocalShell
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from wasser.shell import RemoteShell, LocalShell, Shell, cancel_all, run_sync, wasser_remote_dir
 from wasser.state import State, NodeState
 from wasser.equip import Equipment
+from wasser.cache import get_snapshot_cache, state_file_path
+from wasser.pool import get_node_pool
+from wasser import profiler, timing
+from wasser.timing import span
 
-def main():
+def get_parser():
+    """
+    Return command line parser of all wasser commands.
+    """
     parser = argparse.ArgumentParser(
             description='wasser - workflow automation software for shell executable routines')
     parser.add_argument('-v', '--verbose', action='store_true', help='enable verbose logging')
     parser.add_argument('-q', '--quiet', action='store_true', help='subpress logging')
-    parser.add_argument('--pdb-attach', default=0, help='listen on port for pdb-attach, use with: python -m pdb_attach PID PORT')
+    parser.add_argument('--pdb-attach', default=0,
+                        help='listen on port for pdb-attach, use with: python -m pdb_attach PID PORT')
+    parser.add_argument('--profile', nargs='?', const='wasser-profile', metavar='DIR',
+                        help='profile all threads, save collapsed stacks of each phase to the directory '
+                             '(default: %(const)s) and log the top functions')
 
 
     github_parser = argparse.ArgumentParser(add_help=False)
@@ -73,6 +89,18 @@ def main():
     common_parser.add_argument('-d', '--debug',
                                             action='store_true',
                                             help='enter debug mode')
+    common_parser.add_argument('--node-threads',
+                                            type=int,
+                                            default=None,
+                                            help='maximum number of nodes handled in parallel '
+                                                 '(default: workflow.node_threads or %s)' % default_node_threads)
+    common_parser.add_argument('--no-wait-delete',
+                                            action='store_true',
+                                            help='do not wait until nodes are deleted')
+    common_parser.add_argument('--timings',
+                                            metavar='FILE',
+                                            help='save timings of each phase, routine step and node '
+                                                 'to the json file, which can be loaded as Chrome trace')
 
     subparsers = parser.add_subparsers(help="sub-command help", dest='command')
     parser_run = subparsers.add_parser('run',
@@ -87,12 +115,19 @@ def main():
     parser_run.add_argument('-i', '--interactive', action='store_true',
                                             help='run steps interactively')
     parser_run.add_argument('-c', '--continue', action='store_true',
-                                            help='continue run')
+                                            help='continue previous run, reuse its nodes and skip completed steps, '
+                                                 'the previous run must keep its nodes with --keep-failed or '
+                                                 '--keep-nodes, the nodes are kept if the continued run fails')
     parser_run.add_argument('-e', '--extra-vars',
                                             help='extra variables')
+    parser_run.add_argument('--log-dir',
+                                            help='save output of each step to a file in the directory')
     parser_run.add_argument('-k', '--keep-nodes',
                                             action='store_true',
                                             help='cleanup')
+    parser_run.add_argument('--keep-failed',
+                                            action='store_true',
+                                            help='keep nodes if the run fails, so it can be continued with --continue')
 
     parser_clean = subparsers.add_parser('create',
                                             parents=[common_parser, openstack_parser],
@@ -100,7 +135,11 @@ def main():
     parser_clean = subparsers.add_parser('delete',
                                             parents=[common_parser, openstack_parser],
                                             help='delete environment: nodes, networks, etc.')
+    return parser
 
+
+def main():
+    parser = get_parser()
     args = parser.parse_args()
 
     if args.quiet:
@@ -131,7 +170,8 @@ def main():
     if args.pdb_attach:
         import pdb_attach
         pdb_attach.listen(args.pdb_attach)
-        logging.info(f'Enabled pdb-attach module, command to attach the process: python -m pdb_attach {os.getpid()} {args.pdb_attach}')
+        logging.info(f'Enabled pdb-attach module, command to attach the process: '
+                     f'python -m pdb_attach {os.getpid()} {args.pdb_attach}')
 
     if not args.command:
         parser.print_help()
@@ -149,68 +189,129 @@ def main():
         signal.signal(signal.SIGINT, handle_signal)
         signal.signal(signal.SIGTERM, handle_signal)
 
-    if args.command == 'run':
-        do_run(args)
-    if args.command == 'create':
-        do_create(args)
-    if args.command == 'delete':
-        do_delete(args)
+    with profiler.profiling(args.profile), timing.recording(getattr(args, 'timings', None)):
+        if args.command == 'run':
+            do_run(args)
+        if args.command == 'create':
+            do_create(args)
+        if args.command == 'delete':
+            do_delete(args)
     if args.command == 'provision':
         pass
     exit(0)
 
 
-wasser_remote_dir = '/opt/wasser'
+default_node_threads = 8
 
 
 class Host():
-    def __init__(self, name, addr=None, user=None, keyfile=None):
+    def __init__(self, name, addr=None, user=None, keyfile=None, labels=None):
         self.name = name
         self.addr = addr
         self.user = user
         self.keyfile = keyfile
+        if isinstance(labels, str):
+            labels = [labels]
+        self.labels = list(labels or [])
+        # node state, where the completed steps are recorded
+        self.node_state = None
         if addr:
             self.shell = RemoteShell(addr, user, keyfile)
         else:
             self.shell = LocalShell(user)
+        self.shell.node = name
 
     def run(self, command, **kwargs):
         self.shell.run(command, **kwargs)
 
+    async def arun(self, command, **kwargs):
+        await self.shell.arun(command, **kwargs)
+
     def copy_files(self, spec):
         self.shell.copy_files(spec)
 
+    async def acopy_files(self, spec):
+        await self.shell.acopy_files(spec)
+
+
+class HostLoad():
+    """
+    Process wide number of commands running and run on each host,
+    shared by all routines, so 'onany' steps of concurrent routines
+    go to the least busy host. Hosts are keyed by address, or by name
+    if they have no address.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = {}
+        self.runs = {}
+
+    @staticmethod
+    def key(host):
+        return host.addr or host.name
+
+    def start(self, host):
+        key = self.key(host)
+        with self.lock:
+            self.busy[key] = self.busy.get(key, 0) + 1
+            self.runs[key] = self.runs.get(key, 0) + 1
+
+    def finish(self, host):
+        key = self.key(host)
+        with self.lock:
+            self.busy[key] -= 1
+
+    def least_busy(self, hosts):
+        """
+        Return the host with the fewest running commands,
+        with ties going to the host which ran fewest commands.
+        """
+        with self.lock:
+            return min(hosts, key=lambda h: (self.busy.get(self.key(h), 0), self.runs.get(self.key(h), 0)))
+
+
+host_load = HostLoad()
+
 
-def get_host(server):
+def get_host(server, labels=None):
     server_name = server['name']
     server_addr = server['ip']
     secret_file = server['keyfile']
     user_name = server['username']
-    return Host(server_name, server_addr, user_name, secret_file)
+    return Host(server_name, server_addr, user_name, secret_file, labels)
 
 
-def provision_server(state, server):
-    env = state.status.get('env')
-    server_spec = state.status['spec']
-
-    host = get_host(server)
-
-    logging.info("Provisioning target %s" % host.name)
-
+def provision_script(server_spec, host, dependencies=True):
+    """
+    Return shell script which prepares the host for running routines,
+    all provisioning commands are run with single remote call.
+    The dependencies are not installed if 'dependencies' is False.
+    """
     target_fqdn = host.name + ".suse.de"
     target_addr = host.addr
 
-    command_list = []
-    if server_spec.get('vars') and server_spec['vars'].get('dependencies'):
+    command_list = [
+        'set -e',
+        f'sudo mkdir -p {wasser_remote_dir} 2>&1',
+        f'sudo chown {host.user}: {wasser_remote_dir} 2>&1',
+        f'mkdir -p {wasser_remote_dir}/bin 2>&1',
+    ]
+    if dependencies and server_spec.get('vars') and server_spec['vars'].get('dependencies'):
         command_list += [
             'sudo zypper --no-gpg-checks ref 2>&1',
             'sudo zypper install -y %s 2>&1' % ' '.join(server_spec['vars']['dependencies']),
         ]
+    hosts_entry = target_addr + '\t' + target_fqdn
     command_list += [
-      'echo "' + target_addr + '\t' + target_fqdn + '" | sudo tee -a /etc/hosts',
+      # the hosts entry is added once, the pooled and snapshot nodes are provisioned again
+      'grep -qxF "' + hosts_entry + '" /etc/hosts || echo "' + hosts_entry + '" | sudo tee -a /etc/hosts',
       'sudo hostname ' + target_fqdn,
       'cat /etc/os-release',
       ]
+    return '\n'.join(command_list)
+
+
+def provision_copy_spec(server_spec):
     copy_spec = [{
         'from': [
             os.path.dirname(__file__) + '/snippets/clone-git-repo.sh',
@@ -222,16 +323,33 @@ def provision_server(state, server):
     if 'copy' in server_spec:
         # copy should be a list
         copy_spec += server_spec['copy']
+    return copy_spec
+
+
+async def aprovision_server(state, server, host=None):
+    """
+    Provision the server with single script run, then upload the files,
+    returns time in seconds the provisioning took.
+    The servers booted from snapshot, leased from node pool or left
+    from the previous run have the dependencies installed already.
+    """
+    server_spec = state.status['spec']
+    host = host or get_host(server)
 
+    logging.info("Provisioning target %s" % host.name)
+    start_time = time.time()
+    dependencies = not (server.get('snapshot') or server.get('pooled') or server.get('provisioned'))
+    await host.arun(provision_script(server_spec, host, dependencies), name='Provision')
     logging.info("Copying files to host...")
-    routine = Routine([host], env)
-    routine.run([f'sudo mkdir -p {wasser_remote_dir} 2>&1',
-                    f'sudo chown {host.user}: {wasser_remote_dir} 2>&1'])
-    routine.run([f'mkdir -p {wasser_remote_dir}/bin 2>&1'])
-    host.copy_files(copy_spec)
+    await host.acopy_files(provision_copy_spec(server_spec))
+    NodeState(state, server).update(provisioned=True)
+    elapsed = time.time() - start_time
+    logging.info(f'The server is provisioned in {elapsed:.1f}s and can be accessed by address: {host.addr}')
+    return elapsed
+
 
-    routine.run(command_list)
-    logging.info(f'The server is provisioned and can be accessed by address: {host.addr}')
+def provision_server(state, server):
+    return run_sync(aprovision_server(state, server))
 
 
 class Workflow():
@@ -280,6 +398,62 @@ class Workflow():
       workflow:
         threads: 2
 
+    Nodes for all routines are created in parallel, the number of nodes
+    created at a time is limited by 'node_threads', which defaults to 8
+    and can be overridden with '--node-threads' option.
+
+      workflow:
+        node_threads: 4
+
+    Step commands are jinja templates, which are compiled before nodes
+    are created, if 'strict_templates' is set, the variables used by
+    the commands must be defined in the environment.
+
+      workflow:
+        strict_templates: true
+
+    The output of each step can be saved to a separate file in the given
+    directory, which also can be set with '--log-dir' option.
+
+      workflow:
+        log_dir: logs
+
+    The nodes can be kept running between runs in a node pool, registered
+    in '.wasser_pool' file next to the state file. A run leases idle nodes
+    with the same spec instead of creating new ones, and after the run
+    the nodes are released back to the pool, the 'reset' command is run
+    on the nodes before. The nodes idle longer than 'ttl' seconds
+    are deleted on the next run.
+
+      workflow:
+        node_pool:
+          ttl: 3600
+          reset: rm -rf ~/*
+
+    Provisioned nodes can be cached as image snapshots. The steps up to
+    the last one marked with 'bake' are the bake steps, if snapshot cache
+    is enabled for all nodes of the routine, the nodes are snapshotted
+    after the bake steps, and the next runs with the same image,
+    dependencies, copy spec and bake steps boot the nodes from the
+    snapshots and skip the bake steps. Old snapshots are deleted after
+    'max_age' seconds, and only 'max_count' newest ones are kept.
+
+      openstack:
+        snapshot_cache:
+          max_age: 604800
+          max_count: 5
+
+      routines:
+        "Some Routine":
+            steps:
+              - name: install kernel
+                command: sudo zypper install -y kernel-default
+              - reboot
+              - wait_host
+              - name: check kernel
+                command: uname -r
+                bake: true
+
     Each routine can be run on several nodes. For example:
 
     routines:
@@ -301,10 +475,11 @@ class Workflow():
 
     """
 
-    def __init__(self, state, breaks=[]):
+    def __init__(self, state, breaks=[], resume=False):
         self.state = state
         self.env = state.status.get('env')
         self.breaks = breaks
+        self.resume = resume
 
     def equip(self):
         spec = self.state.status.get('spec')
@@ -315,7 +490,14 @@ class Workflow():
 
     def get_routine_hosts(self, routine_index):
         nodes_data = self.state.status.get('nodes')
-        hosts = [get_host(_) for _ in nodes_data[routine_index]]
+        routine_name = self.get_run_routines()[routine_index]
+        node_specs = self.get_routines().get(routine_name, {}).get('nodes', [])
+        hosts = []
+        for i, data in enumerate(nodes_data[routine_index]):
+            labels = node_specs[i].get('label') if i < len(node_specs) else None
+            host = get_host(data, labels)
+            host.node_state = NodeState(self.state, data)
+            hosts.append(host)
         return hosts
 
     def equip_keywords(self):
@@ -364,10 +546,42 @@ class Workflow():
 
 
     def provision_servers(self):
+        """
+        Provision all nodes concurrently, the time each node took is kept
+        in 'provision_times' by node name.
+
+        If any of the nodes failed, an exception is raised after all
+        others are finished.
+        """
         nodes_data = self.state.status['nodes']
-        for routine_nodes_data in nodes_data:
-            for _ in routine_nodes_data:
-                provision_server(self.state, _)
+        run_routines = self.get_run_routines()
+        routines = [run_routines[i] if i < len(run_routines) else None
+                        for i in range(len(nodes_data)) for _ in nodes_data[i]]
+        servers = [_ for routine_nodes_data in nodes_data for _ in routine_nodes_data]
+        hosts = [get_host(_) for _ in servers]
+        if len(hosts) > 1:
+            for h in hosts:
+                h.shell.tag = f'[{h.name}] '
+
+        async def provision(routine, server, host):
+            with span('provision', routine=routine, node=host.name):
+                return await aprovision_server(self.state, server, host)
+
+        async def provision_all():
+            return await asyncio.gather(*[provision(r, s, h) for r, s, h in zip(routines, servers, hosts)],
+                                        return_exceptions=True)
+        results = run_sync(provision_all())
+        self.provision_times = {}
+        errors = {}
+        for h, r in zip(hosts, results):
+            if isinstance(r, Exception):
+                logging.error(f'Failed to provision node {h.name}: {r}')
+                errors[h.name] = r
+            else:
+                self.provision_times[h.name] = r
+        if errors:
+            summary = '; '.join(f'{k}: {v}' for k, v in errors.items())
+            raise Exception(f'Failed to provision {len(errors)} of {len(hosts)} nodes: {summary}')
 
     def access_banner(self):
         nodes_data = self.state.status.get('nodes', [])
@@ -400,13 +614,25 @@ class Workflow():
         return spec.get('routines', {})
 
 
-    def get_equipment(self, routine_name=None):
+    def init_nodes_data(self):
+        """
+        Return list of node data lists for each run routine,
+        initialize node data in the state if it is not yet.
+        """
         nodes_data = self.state.status.get('nodes')
         run_routines = self.get_run_routines()
-        # init node states if it is not yet
         if not nodes_data:
             nodes_data = [[] for _ in run_routines]
             self.state.status['nodes'] = nodes_data
+        nodes_data += [[] for _ in range(len(run_routines) - len(nodes_data))]
+        for i in range(len(run_routines)):
+            if not nodes_data[i]:
+                nodes_data[i] = [{} for _ in self.get_node_specs(run_routines[i])]
+        return nodes_data
+
+    def get_equipment(self, routine_name=None):
+        nodes_data = self.init_nodes_data()
+        run_routines = self.get_run_routines()
         logging.debug(f'Nodes Data: {nodes_data}')
         run_equip = []
         for i in range(len(run_routines)):
@@ -414,25 +640,407 @@ class Workflow():
                 continue
             logging.debug(f'Getting equipment for routine "{run_routines[i]}"')
             specs = self.get_node_specs(run_routines[i])
-            if not nodes_data[i]:
-                nodes_data[i] = [{} for _ in specs]
+            for x in range(len(specs)):
+                # nodes are booted from provisioned image snapshot
+                image = nodes_data[i][x].get('snapshot')
+                if image and 'openstack' in specs[x]:
+                    specs[x] = dict(specs[x], openstack=dict(specs[x]['openstack'], image=image))
             equip = [Equipment.from_node_spec(
                             NodeState(self.state, nodes_data[i][x]),
                             specs[x])
                                 for x in range(len(specs))]
+            for e in equip:
+                if e:
+                    e.routine = run_routines[i]
             run_equip += equip
         return run_equip
 
+    def get_bake_steps(self, name):
+        """
+        Return the routine steps up to the last step marked with 'bake'.
+        """
+        steps = self.get_routines()[name].get('steps', [])
+        marked = [i for i, c in enumerate(steps) if isinstance(c, dict) and c.get('bake')]
+        return steps[:marked[-1] + 1] if marked else []
+
+    @staticmethod
+    def get_snapshot_spec(node_spec):
+        """
+        Return snapshot cache settings of the node spec,
+        or None if the cache is not enabled.
+        """
+        spec = (node_spec.get('openstack') or {}).get('snapshot_cache')
+        if not spec:
+            return None
+        settings = dict(max_age=7*24*3600, max_count=5)
+        if isinstance(spec, dict):
+            settings.update(spec)
+        return settings
+
+    def get_snapshot_cache(self):
+        return get_snapshot_cache(state_file_path(self.state.state_path, '.wasser_snapshots'))
+
+    def bake_fingerprint(self, node_spec, bake_steps):
+        """
+        Return hash of everything the provisioned node image depends on:
+        the image, dependencies, copy spec with the content of the copied
+        files and the bake steps, the step commands are hashed as rendered
+        with the workflow environment.
+        """
+        spec = self.state.status.get('spec')
+        openstack = node_spec.get('openstack') or {}
+        env = self.env or {}
+        steps = []
+        for c in bake_steps:
+            if isinstance(c, str) and c not in builtin_steps:
+                c = render_command(c, env)
+            elif isinstance(c, dict) and c.get('command'):
+                c = dict(c, command=render_command(c['command'], env))
+            steps.append(c)
+        data = dict(
+            cloud=openstack.get('cloud'),
+            image=openstack.get('image'),
+            userdata=openstack.get('userdata'),
+            dependencies=(spec.get('vars') or {}).get('dependencies'),
+            copy=spec.get('copy'),
+            copy_files=self.copy_files_hash(),
+            steps=steps,
+        )
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def copy_files_hash(self):
+        """
+        Return hash of the content of the files copied to the nodes,
+        the files are hashed once per workflow.
+        """
+        if getattr(self, '_copy_files_hash', None) is None:
+            h = hashlib.sha256()
+            for i in provision_copy_spec(self.state.status.get('spec') or {}):
+                for path in i['from']:
+                    for src, dest in RemoteShell.list_copy_files(RemoteShell.local_path(path), i['into']):
+                        h.update(dest.encode())
+                        h.update(RemoteShell.file_hash(src).encode() if os.path.isfile(src) else b'-')
+            self._copy_files_hash = h.hexdigest()
+        return self._copy_files_hash
+
+    def select_snapshots(self):
+        """
+        Find provisioned image snapshots for the routines with bake steps.
+
+        If all nodes of a routine have snapshot cache enabled and there are
+        snapshots for their fingerprints, the nodes are booted from the
+        snapshots and the bake steps are skipped, otherwise the fingerprints
+        are kept in the node state, so the nodes are snapshotted after the
+        bake steps are done.
+        """
+        nodes_data = self.init_nodes_data()
+        cache = self.get_snapshot_cache()
+        for i, name in enumerate(self.get_run_routines()):
+            bake_steps = self.get_bake_steps(name)
+            specs = self.get_node_specs(name)
+            if not bake_steps or not all(self.get_snapshot_spec(_) for _ in specs):
+                continue
+            if any(_.get('pooled') for _ in nodes_data[i]):
+                continue
+            images = []
+            for x, spec in enumerate(specs):
+                node_state = NodeState(self.state, nodes_data[i][x])
+                fingerprint = self.bake_fingerprint(spec, bake_steps)
+                node_state.update(fingerprint=fingerprint)
+                entry = cache.get(fingerprint)
+                equipment = Equipment.from_node_spec(node_state, spec)
+                if entry and not equipment.image_exists(entry['image_id']):
+                    logging.warning(f'Snapshot image {entry["image_id"]} is gone, forgetting it')
+                    cache.remove(fingerprint)
+                    entry = None
+                images.append(entry['image_id'] if entry else None)
+            if all(images):
+                logging.info(f'Booting nodes of routine "{name}" from snapshots: {", ".join(images)}')
+                for x in range(len(specs)):
+                    NodeState(self.state, nodes_data[i][x]).update(snapshot=images[x])
+
+    def save_snapshots(self, name):
+        """
+        Snapshot the routine nodes after the bake steps are done, one
+        snapshot per fingerprint, and evict old snapshots from the cache.
+        The snapshots are made in parallel. Failures are not fatal, the run
+        just goes on without snapshot.
+        """
+        cache = self.get_snapshot_cache()
+        equipment = {}
+        for e in [_ for _ in self.get_equipment(name) if _]:
+            fingerprint = e.state.data.get('fingerprint')
+            if not fingerprint or e.state.data.get('snapshot') or cache.get(fingerprint):
+                continue
+            equipment.setdefault(fingerprint, e)
+        if not equipment:
+            return
+
+        def save(fingerprint, e):
+            spec = self.get_snapshot_spec({'openstack': e.spec})
+            cloud = e.spec.get('cloud')
+            try:
+                image_id = e.snapshot(f'wasser-bake-{fingerprint[:12]}',
+                                      {'wasser_fingerprint': fingerprint})
+            except Exception as x:
+                logging.warning(f'Failed to snapshot node {e.state.data.get("name")}: {x}')
+                return
+            if not image_id:
+                return
+            cache.add(fingerprint, image_id, cloud=cloud)
+            for entry in cache.evict(spec['max_age'], spec['max_count'], cloud):
+                try:
+                    e.delete_image(entry['image_id'])
+                except Exception as x:
+                    logging.warning(f'Failed to delete snapshot image {entry["image_id"]}: {x}')
+
+        with ThreadPoolExecutor(max_workers=min(len(equipment), self.get_node_threads()),
+                                thread_name_prefix='snapshot') as pool:
+            for f in [pool.submit(save, k, v) for k, v in equipment.items()]:
+                f.result()
+
+    def get_node_pool_spec(self):
+        """
+        Return node pool settings of the workflow,
+        or None if the node pool is not enabled.
+        """
+        spec = self.get_workflow().get('node_pool')
+        if not spec:
+            return None
+        settings = dict(ttl=3600, lease_timeout=12*3600, reset=None)
+        if isinstance(spec, dict):
+            settings.update(spec)
+        return settings
+
+    def get_node_pool(self):
+        return get_node_pool(state_file_path(self.state.state_path, '.wasser_pool'))
+
+    def node_spec_hash(self, node_spec):
+        """
+        Return hash of the node spec and the provisioning spec,
+        the nodes with the same hash can replace each other.
+        """
+        spec = self.state.status.get('spec')
+        data = dict(
+            node=node_spec,
+            dependencies=(spec.get('vars') or {}).get('dependencies'),
+            copy=spec.get('copy'),
+        )
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def reap_nodes(self):
+        """
+        Delete pooled nodes which are idle longer than 'ttl' seconds
+        or leased longer than 'lease_timeout' seconds.
+        """
+        pool_spec = self.get_node_pool_spec()
+        for entry in self.get_node_pool().reap(pool_spec['ttl'], pool_spec['lease_timeout']):
+            logging.info(f'Reaping pooled node {entry["node"].get("name")}')
+            e = Equipment.from_node_spec(NodeState(self.state, entry['node']), entry['spec'])
+            try:
+                if e:
+                    e.delete(wait=False)
+            except Exception as x:
+                logging.warning(f'Failed to delete pooled node {entry["node"].get("name")}: {x}')
+
+    def lease_nodes(self):
+        """
+        Lease idle nodes with matching spec hash from the node pool for
+        the nodes which are not created yet, the leased nodes are marked
+        with 'pooled' spec hash in the node state.
+        """
+        pool = self.get_node_pool()
+        self.reap_nodes()
+        nodes_data = self.init_nodes_data()
+        for i, name in enumerate(self.get_run_routines()):
+            specs = self.get_node_specs(name)
+            for x, spec in enumerate(specs):
+                if nodes_data[i][x].get('id'):
+                    continue
+                spec_hash = self.node_spec_hash(spec)
+                while True:
+                    entry = pool.lease(spec_hash)
+                    if not entry:
+                        break
+                    node = entry['node']
+                    e = Equipment.from_node_spec(NodeState(self.state, dict(node)), spec)
+                    if e and e.is_alive():
+                        logging.info(f'Leased node {node.get("name")} from node pool')
+                        NodeState(self.state, nodes_data[i][x]).update(**node, pooled=spec_hash)
+                        break
+                    logging.warning(f'Pooled node {node.get("name")} is gone, removing it from the pool')
+                    pool.remove(node['id'])
+
+    def release_nodes(self, wait=True):
+        """
+        Release the nodes to the node pool after the run, the 'reset'
+        command, if any, is run on the nodes before, and the copy manifest
+        is dropped, since the reset may remove the copied files.
+
+        The nodes of the failed routines and the nodes which failed to
+        reset are deleted. If the run did not reach the routines, like when
+        some nodes failed to create, only the leased nodes are released and
+        the nodes created by this run are deleted.
+        """
+        pool_spec = self.get_node_pool_spec()
+        pool = self.get_node_pool()
+        errors = getattr(self, 'errors', None)
+        nodes_data = self.init_nodes_data()
+        release = []
+        for i, name in enumerate(self.get_run_routines()):
+            if errors is not None and i in errors:
+                continue
+            specs = self.get_node_specs(name)
+            release += [(nodes_data[i][x], specs[x]) for x in range(len(specs))
+                            if nodes_data[i][x].get('id') and not nodes_data[i][x].get('status')
+                                and (errors is not None or nodes_data[i][x].get('pooled'))]
+        if release:
+            hosts = [get_host(_[0]) for _ in release]
+            manifest_path = f'{wasser_remote_dir}/{RemoteShell.manifest_name}'
+
+            async def reset(h):
+                if pool_spec['reset']:
+                    await h.arun(pool_spec['reset'], name='Reset node')
+                await h.arun(f'rm -f {manifest_path}', name='Drop copy manifest')
+
+            async def reset_all():
+                return await asyncio.gather(*[reset(h) for h in hosts], return_exceptions=True)
+            results = run_sync(reset_all())
+            for h, r in zip(hosts, results):
+                if isinstance(r, Exception):
+                    logging.error(f'Failed to reset node {h.name}: {r}')
+            release = [_ for _, r in zip(release, results) if not isinstance(r, Exception)]
+        for node, spec in release:
+            pooled = {k: v for k, v in node.items()
+                        if k not in ['status', 'pooled', 'fingerprint', 'snapshot', 'steps']}
+            pool.release(pooled, self.node_spec_hash(spec), spec)
+            NodeState(self.state, node).update(status='released')
+            logging.info(f'Released node {node.get("name")} to node pool')
+        self.delete_nodes(wait=wait)
+
+    def forget_pooled_nodes(self):
+        """
+        Remove the leased nodes, which are not released back, from the node
+        pool, since they are going to be deleted.
+        """
+        nodes = [_ for routine_nodes in self.state.status.get('nodes') or [] for _ in routine_nodes]
+        leased = [_ for _ in nodes if _.get('pooled') and _.get('id') and _.get('status') != 'released']
+        if not leased:
+            return
+        pool = self.get_node_pool()
+        for node in leased:
+            logging.debug(f'Removing node {node.get("name")} from node pool')
+            pool.remove(node['id'])
+
+    def strict_templates(self):
+        return bool(self.get_workflow().get('strict_templates', False))
+
+    def compile_steps(self):
+        """
+        Compile step commands of all routines to be run.
+        """
+        routines = self.get_routines()
+        compile_commands({_: routines.get(_) for _ in self.get_run_routines()},
+                         self.env or {}, self.strict_templates())
+
+    def get_node_threads(self):
+        """
+        Return maximum number of nodes to be handled in parallel,
+        the command line option has priority over the workflow spec.
+        """
+        args = getattr(self.state, 'args', None)
+        threads = getattr(args, 'node_threads', None)
+        if not threads:
+            workflow = self.get_workflow()
+            threads = workflow.get('node_threads', default_node_threads)
+        return max(1, int(threads))
 
     def create_nodes(self):
-        for e in self.get_equipment():
-            logging.debug(f'Creating equipment {e}')
-            e.create()
+        """
+        Create all nodes of the run routines using up to 'node_threads'
+        workers in parallel.
+
+        Nodes with identical specs are grouped and created together
+        when the equipment supports it, see Equipment.batch_key.
 
-    def delete_nodes(self):
-        for e in self.get_equipment():
-            logging.debug(f'Deleting equipment {e}')
-            e.delete()
+        If any of the nodes failed to create, the nodes which are not
+        started yet are cancelled, and an exception is raised after
+        the others are finished, so the caller can cleanup the nodes
+        which did come up.
+        """
+        if self.get_node_pool_spec():
+            self.lease_nodes()
+        self.select_snapshots()
+        equipment = []
+        for e in [_ for _ in self.get_equipment() if _ and not _.state.data.get('pooled')]:
+            if e.state.data.get('id'):
+                # the node is left from the previous run
+                if e.is_alive():
+                    logging.info(f'Reusing node {e.state.data.get("name")}')
+                    continue
+                logging.warning(f'Node {e.state.data.get("name")} is gone, creating new one')
+                with self.state.lock:
+                    e.state.data.clear()
+            equipment.append(e)
+        groups = {}
+        for e in equipment:
+            key = e.batch_key()
+            groups.setdefault((type(e), key) if key else id(e), []).append(e)
+        errors = []
+        threads = self.get_node_threads()
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='create') as pool:
+            futures = {}
+            for group in groups.values():
+                logging.debug(f'Creating equipment {group}')
+                if len(group) > 1:
+                    futures[pool.submit(type(group[0]).create_batch, group, threads)] = group
+                else:
+                    futures[pool.submit(group[0].create)] = group
+            for f in as_completed(futures):
+                if f.cancelled():
+                    continue
+                try:
+                    f.result()
+                except Exception as x:
+                    names = ', '.join(str(_.state.data.get('name')) for _ in futures[f])
+                    logging.error(f'Failed to create nodes {names}: {x}')
+                    errors.append((futures[f], x))
+                    for _ in futures:
+                        _.cancel()
+        self.state.flush()
+        if errors:
+            failed = sum(len(_[0]) for _ in errors)
+            raise Exception(f'Failed to create {failed} of {len(equipment)} nodes, '
+                            f'first error: {errors[0][1]}')
+
+    def delete_nodes(self, wait=True):
+        """
+        Delete all nodes in parallel, at most 'node threads' nodes at once,
+        see get_node_threads(), and, if 'wait' is True, return when all
+        nodes are confirmed to be deleted.
+        """
+        self.forget_pooled_nodes()
+        equipment = [_ for _ in self.get_equipment() if _]
+        if not equipment:
+            return
+        def delete(e):
+            with span('delete', routine=e.routine, node=e.state.data.get('name')):
+                e.delete(wait=wait)
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(len(equipment), self.get_node_threads()),
+                                thread_name_prefix='delete') as pool:
+            futures = {pool.submit(delete, e): e for e in equipment}
+            for f in as_completed(futures):
+                try:
+                    f.result()
+                except Exception as x:
+                    logging.error(f'Failed to delete node {futures[f].state.data.get("name")}: {x}')
+                    errors.append(x)
+        self.state.flush()
+        if errors:
+            raise Exception(f'Failed to delete {len(errors)} of {len(equipment)} nodes, '
+                            f'first error: {errors[0]}')
 
     def get_run_routines(self):
         """Return list of names of run routines"""
@@ -445,50 +1053,385 @@ class Workflow():
  						for _ in workflow_routines]
         return names
 
-    def run(self):
+    def get_routine_graph(self):
         """
-        Build routine workflow tree and run it through.
+        Return list of (name, after) pairs for each workflow routine
+        in the run order, where 'after' is a set of names of routines
+        which must be finished before the routine is started.
         """
         server_spec = self.state.status.get('spec')
         workflow = server_spec.get('workflow', {})
         routines = server_spec.get('routines', {})
         workflow_routines = workflow.get('routines', [{'name': _} for _ in routines.keys()])
-        parallel_routines = workflow.get('threads', 1)
-
-        self.provision_servers()
-
-        for i in range(len(workflow_routines)):
-            r = workflow_routines[i]
+        graph = []
+        for r in workflow_routines:
             if isinstance(r, str):
                 name = r
+                after = []
             elif isinstance(r, dict) and 'name' in r:
                 name = r.get('name')
+                after = r.get('after') or []
             else:
                 raise Exception(
                     f'Unexpected error while processing routing in workflow: {r}')
-            logging.info(f"Using routine '{name}'...")
-            if name in routines:
-                steps = routines[name].get('steps', [])
-                hosts = self.get_routine_hosts(i)
-                routine = Routine(hosts, self.env, self.breaks)
-                routine.run(steps)
-            else:
+            if name not in routines:
                 raise Exception(
                     f'Unknown routine "{name}"')
+            if isinstance(after, str):
+                after = [after]
+            graph.append((name, set(after)))
+        names = [_[0] for _ in graph]
+        for name, after in graph:
+            unknown = [_ for _ in after if _ not in names]
+            if unknown:
+                raise Exception(
+                    f'Routine "{name}" is supposed to run after unknown routines: {", ".join(unknown)}')
+            if name in after:
+                raise Exception(f'Routine "{name}" cannot run after itself')
+        return graph
+
+    def run_routine(self, index, name):
+        routines = self.state.status.get('spec').get('routines', {})
+        logging.info(f"Using routine '{name}'...")
+        steps = routines[name].get('steps', [])
+        hosts = self.get_routine_hosts(index)
+        routine = Routine(hosts, self.env, self.breaks, self.strict_templates(), self.resume, name=name)
+        bake_steps = self.get_bake_steps(name)
+        nodes_data = self.state.status['nodes'][index]
+        if bake_steps and all(_.get('snapshot') for _ in nodes_data):
+            logging.info(f'Skipping {len(bake_steps)} bake steps of routine "{name}", '
+                         f'nodes are booted from snapshots')
+            steps = steps[len(bake_steps):]
+        elif bake_steps and all(_.get('fingerprint') for _ in nodes_data) and not self.breaks:
+            steps = steps[len(bake_steps):]
+            try:
+                routine.run(bake_steps)
+            except Exception:
+                routine.run([_ for _ in steps if isinstance(_, dict) and _.get('always')])
+                raise
+            self.save_snapshots(name)
+        routine.run(steps)
+
+    def run(self):
+        """
+        Build routine workflow tree and run it through.
+
+        Routines without pending 'after' dependencies are started
+        in the workflow order using up to 'workflow.threads' workers,
+        the dependent routines are started as soon as all routines
+        they are waiting for are finished.
+        If a routine fails, the routines depending on it are skipped,
+        while independent routines are still run to the end.
+        If the run is interrupted, the routines not started yet are
+        cancelled, the commands of the running routines are killed,
+        and the workers are not waited for.
+        """
+        server_spec = self.state.status.get('spec')
+        workflow = server_spec.get('workflow', {})
+        parallel_routines = int(workflow.get('threads', 1) or 1)
+        graph = self.get_routine_graph()
+
+        with profiler.phase('provision'):
+            self.provision_servers()
+
+        # routine indexes mapped to names of routines they are waiting for
+        pending = {i: graph[i][1] for i in range(len(graph))}
+        self.errors = {}
+        running = {}
+        interrupted = False
+        pool = ThreadPoolExecutor(max_workers=parallel_routines, thread_name_prefix='routine')
+        try:
+            with profiler.phase('routines'):
+                self.run_graph(pool, graph, pending, running)
+        except (KeyboardInterrupt, SystemExit):
+            interrupted = True
+            logging.info(f'Interrupted, cancelling {len(running)} routines')
+            for f in running:
+                f.cancel()
+            cancel_all()
+            raise
+        finally:
+            pool.shutdown(wait=not interrupted)
+
+        if self.errors:
+            summary = '; '.join(f'{graph[i][0]}: {e}' for i, e in sorted(self.errors.items()))
+            raise Exception(f'Failed routines: {summary}')
+
+    def run_graph(self, pool, graph, pending, running):
+        """
+        Submit the pending routines to the pool as soon as the routines
+        they are waiting for are finished, until all of them are done.
+        """
+        while pending or running:
+            # completed routines are the ones which are done for sure,
+            # so a name is completed if there is no routine with
+            # the name left pending or running
+            active = set(graph[i][0] for i in list(pending) + list(running.values()))
+            failed = set(graph[i][0] for i in self.errors)
+            for i in sorted(pending):
+                name, after = graph[i]
+                if after & active:
+                    continue
+                del pending[i]
+                if after & failed:
+                    logging.warning(f'Skipping routine "{name}" because it depends on failed '
+                                    f'routines: {", ".join(sorted(after & failed))}')
+                    self.errors[i] = Exception(f'Skipped after failure of {", ".join(sorted(after & failed))}')
+                    break
+                running[pool.submit(self.run_routine, i, name)] = i
+            else:
+                if not running:
+                    names = [graph[i][0] for i in pending]
+                    raise Exception(f'Cyclic "after" dependency between routines: {", ".join(names)}')
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    i = running.pop(f)
+                    e = f.exception()
+                    if e:
+                        logging.error(f'Routine "{graph[i][0]}" failed: {e}')
+                        self.errors[i] = e
+                    else:
+                        logging.info(f'Routine "{graph[i][0]}" finished')
+
+
+checkout_command = ("{% if checkout_depth %}CHECKOUT_DEPTH={{ checkout_depth }} {% endif %}"
+                    "{% if checkout_filter %}CHECKOUT_FILTER={{ checkout_filter }} {% endif %}"
+                    "{% if checkout_bundle %}CHECKOUT_BUNDLE={{ checkout_bundle }} {% endif %}"
+                    f"{wasser_remote_dir}/bin/clone-git-repo.sh "
+                    "{{ github_dir }} {{ github_url }} {{ github_branch }}")
+builtin_steps = ['reboot', 'wait_host', 'reconnect', 'checkout']
+
+_jinja_envs = {}
+_templates = {}
+_templates_lock = threading.Lock()
+_seed_bundles = {}
+_seed_bundles_lock = threading.Lock()
+
+
+def get_seed_bundle(seed: str, ref: str = None) -> str:
+    """
+    Return path to git bundle to seed the checkout from, the 'seed' is
+    either a bundle file or a local mirror of the repo, in the latter case
+    the bundle of the 'ref' branch is created, or of all branches if the
+    mirror does not have it. The bundles are created once per process,
+    and replace the bundle file atomically, so the runs sharing the temp
+    directory never see a partially written bundle.
+    """
+    import subprocess
+    import tempfile
+    seed = os.path.abspath(os.path.expanduser(seed))
+    if os.path.isfile(seed):
+        return seed
+    if not os.path.isdir(seed):
+        raise Exception(f'Cannot find checkout seed {seed}')
+    key = (seed, ref)
+    with _seed_bundles_lock:
+        if key in _seed_bundles:
+            return _seed_bundles[key]
+        refs = ['--branches']
+        if ref:
+            found = subprocess.run(['git', '-C', seed, 'show-ref', '--verify', '-q', f'refs/heads/{ref}'])
+            if found.returncode == 0:
+                refs = [f'refs/heads/{ref}']
+        digest = hashlib.sha256(f'{seed}:{ref}'.encode()).hexdigest()[:12]
+        path = os.path.join(tempfile.gettempdir(), f'wasser-seed-{digest}.bundle')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        logging.info(f'Creating git bundle {path} from {seed}')
+        try:
+            subprocess.run(['git', '-C', seed, 'bundle', 'create', tmp_path] + refs,
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        _seed_bundles[key] = path
+        return path
+
+
+def get_template(source: str, strict: bool = False):
+    """
+    Return compiled jinja template for the source, each source is compiled
+    only once, if 'strict' is True undefined variables raise an error.
+    """
+    key = (source, strict)
+    template = _templates.get(key)
+    if template is None:
+        import jinja2
+        with _templates_lock:
+            if strict not in _jinja_envs:
+                undefined = jinja2.StrictUndefined if strict else jinja2.Undefined
+                _jinja_envs[strict] = jinja2.Environment(undefined=undefined)
+            template = _jinja_envs[strict].from_string(source)
+            _templates[key] = template
+    return template
+
+
+def get_step_commands(steps):
+    """
+    Return list of (name, command) for the steps with shell commands.
+    """
+    commands = []
+    for c in steps:
+        if isinstance(c, str) and c not in builtin_steps:
+            commands.append((c.split('\n')[0], c))
+        elif isinstance(c, dict) and c.get('command'):
+            commands.append((c.get('name', c['command'].split('\n')[0]), c['command']))
+    return commands
 
 
-def render_command(command:str , env=os.environ) -> str:
-    import jinja2
-    return jinja2.Template(command).render(env)
+def compile_commands(routines, env={}, strict=False):
+    """
+    Compile the step commands of all routines, so template errors are found
+    before any node is created. In strict mode the variables used by the
+    commands are checked to be defined in the environment.
+    """
+    import jinja2.meta
+    for routine_name, routine in routines.items():
+        for step_name, command in get_step_commands((routine or {}).get('steps', [])):
+            try:
+                template = get_template(command, strict)
+            except jinja2.TemplateSyntaxError as e:
+                raise Exception(f'Cannot compile step "{step_name}" of routine "{routine_name}": {e}')
+            if strict:
+                env_ = _jinja_envs[strict]
+                names = jinja2.meta.find_undeclared_variables(env_.parse(command))
+                undefined = sorted(_ for _ in names if _ not in env and _ not in env_.globals)
+                if undefined:
+                    raise Exception(f'Undefined variables in step "{step_name}" of routine '
+                                    f'"{routine_name}": {", ".join(undefined)}')
+    get_template(checkout_command)
+
+
+def render_command(command:str , env=os.environ, strict=False) -> str:
+    return get_template(command, strict).render(env)
 
 class Routine():
 
-    def __init__(self, nodes, env=[], breaks=[]):
+    def __init__(self, nodes, env=[], breaks=[], strict=False, resume=False, name=None):
+        self.name = name
+        self.hosts = nodes
         self.host = nodes[0]
         self.env = env
         self.breakpoints = breaks
+        self.strict = strict
+        # skip the steps completed by the previous run
+        self.resume = resume
+        # number of times each command is run, to tell repeated commands apart
+        self.step_counts = {}
+        # hosts by label index
+        self.labels = {}
+        for h in nodes:
+            for label in h.labels:
+                self.labels.setdefault(label, []).append(h)
+        self.lock = threading.Lock()
+        if len(nodes) > 1:
+            for h in nodes:
+                h.shell.tag = f'[{h.name}] '
+
+    def get_label_hosts(self, labels):
+        """
+        Return hosts having any of the given labels.
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        hosts = []
+        for label in labels:
+            if label not in self.labels:
+                raise Exception(f'No nodes found with label "{label}"')
+            hosts += [_ for _ in self.labels[label] if _ not in hosts]
+        return hosts
+
+    def step_key(self, command):
+        """
+        Return checkpoint key of the rendered step command, which is the
+        command hash and the number of times the command was run before.
+        """
+        digest = hashlib.sha256(command.encode()).hexdigest()[:16]
+        with self.lock:
+            count = self.step_counts.get(digest, 0)
+            self.step_counts[digest] = count + 1
+        return f'{digest}-{count}'
+
+    def is_completed(self, host, key):
+        node_state = getattr(host, 'node_state', None)
+        return bool(self.resume and key and node_state
+                        and key in (node_state.data.get('steps') or {}))
+
+    def complete(self, host, key, name):
+        node_state = getattr(host, 'node_state', None)
+        if not key or not node_state:
+            return
+        with node_state.state.lock:
+            steps = dict(node_state.data.get('steps') or {})
+            steps[key] = name
+            node_state.update(steps=steps)
+
+    async def arun_on_host(self, host, command, key=None, **kwargs):
+        host_load.start(host)
+        step = kwargs.get('name') or command.split('\n')[0]
+        try:
+            with span('step', routine=self.name, node=host.name, step=step):
+                await host.arun(command, **kwargs)
+        finally:
+            host_load.finish(host)
+        self.complete(host, key, kwargs.get('name'))
+
+    async def arun_step(self, command, onall=None, onany=None, key=None, **kwargs):
+        """
+        Run the step command on the hosts with 'onall' labels concurrently,
+        or on the least busy host with 'onany' labels, see HostLoad,
+        otherwise on the first routine host.
+
+        When the routine is resumed, the step is skipped on the hosts
+        which completed the step with the same 'key' already.
+        """
+        if onall:
+            hosts = self.get_label_hosts(onall)
+        elif onany:
+            hosts = self.get_label_hosts(onany)
+        else:
+            hosts = [self.host]
+        done = [h for h in hosts if self.is_completed(h, key)]
+        if (onany and done) or (done and len(done) == len(hosts)):
+            name = kwargs.get('name') or command.split('\n')[0]
+            logging.info(f"Skipping completed step '{name}'")
+            return
+        if onall:
+            hosts = [h for h in hosts if h not in done]
+            results = await asyncio.gather(*[self.arun_on_host(h, command, key, **kwargs) for h in hosts],
+                                           return_exceptions=True)
+            errors = {}
+            for h, e in zip(hosts, results):
+                if isinstance(e, Exception):
+                    logging.error(f'Step failed on host {h.name}: {e}')
+                    errors[h.name] = e
+            if errors:
+                summary = '; '.join(f'{k}: {v}' for k, v in errors.items())
+                raise Exception(f'Step failed on {len(errors)} of {len(hosts)} hosts: {summary}')
+        elif onany:
+            await self.arun_on_host(host_load.least_busy(hosts), command, key, **kwargs)
+        else:
+            await self.arun_on_host(self.host, command, key, **kwargs)
+
+    async def aconnect(self, onall=None, onany=None):
+        """
+        Reconnect the hosts with 'onall' or 'onany' labels concurrently,
+        otherwise the first routine host, waiting until they are online.
+        """
+        labels = onall or onany
+        hosts = self.get_label_hosts(labels) if labels else [self.host]
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, h.shell.connect_client) for h in hosts])
 
     def run(self, steps):
+        """
+        Run routine steps in the shell event loop and wait until they are done,
+        see arun() for the steps description.
+        """
+        with span('routine', routine=self.name):
+            run_sync(self.arun(steps))
+
+    async def arun(self, steps):
         """
         Run routine step by step.
 
@@ -507,25 +1450,52 @@ class Routine():
         In case of dict, it has following format:
         :name:      str, name of the step, used for the reference.
         :always:    bool, always run if True, defaults to False.
+        :bake:      bool, the step and all steps before are cached with
+                    node snapshot, see Workflow.
 
         If the dict has 'command' keyword it is treated as a shell
         script, additional keywords supported:
 
         :env:       dict, extra environment variables.
+        :onall:     str or list, run on all hosts with the labels concurrently.
+        :onany:     str or list, run on the least busy host with the labels.
+
+        The internal commands can be given as the dict 'command' too, then
+        'reboot' is run on the hosts selected by 'onall' or 'onany', and
+        'wait_host' and 'reconnect' wait for all hosts with the labels.
 
         If the dict has 'checkout' it has subkeys:
 
         :url:       github repo to clone
         :dir:       destination directory
         :branch:    branch name or reference, for example, main or refs/pull/X/merge
+        :fast:      fetch only the requested ref with depth 1
+        :depth:     fetch only the requested ref with given number of commits
+        :filter:    fetch only the requested ref with partial clone filter,
+                    for example, blob:none
+        :seed:      local git bundle or repo mirror, which is pushed to the node
+                    to seed the checkout, so only missing objects are fetched,
+                    the local host uses the bundle in place
+
+        The completed steps are recorded in the node state by the hash of
+        the rendered command, if the routine is resumed, the steps completed
+        by the previous run are skipped, and the changed steps are run again.
+        The 'always' steps are not recorded and are run on every resume.
+
+        All commands are run by the current event loop, so many routines
+        can be run concurrently by a single thread, commands are killed
+        when the routine task is cancelled.
         """
+        loop = asyncio.get_event_loop()
         host = self.host
-        client = host.shell.get_client()
+        client = await loop.run_in_executor(None, host.shell.get_client)
         errors = []
         for c in steps:
             name = None
             always = False
             timeout = None
+            onall = None
+            onany = None
             if isinstance(c, str):
                 if c in self.breakpoints:
                     logging.info(f"Breakpoint at step '{c}'")
@@ -533,11 +1503,8 @@ class Routine():
                 if c == 'reboot':
                     name = 'rebooting node'
                     command = 'sudo reboot &'
-                elif c == 'wait_host':
-                    client = host.shell.connect_client()
-                    continue
-                elif c == 'reconnect':
-                    client = host.shell.connect_client()
+                elif c in ['wait_host', 'reconnect']:
+                    await self.aconnect()
                     continue
                 elif c == 'checkout':
                     name = 'clone github repo'
@@ -547,12 +1514,9 @@ class Routine():
                       github_url = 'https://github.com/aquarist-labs/aquarium',
                       github_dir = '.',
                     )
-                    command = render_command(
-                       f"{wasser_remote_dir}/bin/clone-git-repo.sh "
-                       "{{ github_dir }} {{ github_url }} {{ github_branch }}",
-                          env=e)
+                    command = render_command(checkout_command, env=e)
                 else:
-                    command = render_command(c, self.env)
+                    command = render_command(c, self.env, self.strict)
             if isinstance(c, dict):
                 if 'checkout' in c:
                     checkout = c.get('checkout')
@@ -568,7 +1532,7 @@ class Routine():
                         # if there is no github url we input it interactively
                         while not github_url:
                             print("No GitHub URL provided in config, please enter:")
-                            github_url = sys.stdin.readline().rstrip()
+                            github_url = (await loop.run_in_executor(None, sys.stdin.readline)).rstrip()
 
                         if github_url:
                             e.update(github_url=github_url)
@@ -577,20 +1541,36 @@ class Routine():
                         e.update(github_dir=github_dir)
                     if github_branch:
                         e.update(github_branch=github_branch)
+                    e.update(
+                        checkout_depth=checkout.get('depth') or (1 if checkout.get('fast') else None),
+                        checkout_filter=checkout.get('filter'),
+                    )
+                    if checkout.get('seed'):
+                        bundle = await loop.run_in_executor(
+                            None, get_seed_bundle, checkout['seed'], e.get('github_branch'))
+                        if host.addr:
+                            await host.acopy_files([{'from': [bundle], 'into': f'{wasser_remote_dir}/seed'}])
+                            bundle = f'{wasser_remote_dir}/seed/{os.path.basename(bundle)}'
+                        e.update(checkout_bundle=bundle)
                     c.get('name', 'clone github repo')
-                    command = render_command(
-                       f"{wasser_remote_dir}/bin/clone-git-repo.sh "
-                       "{{ github_dir }} {{ github_url }} {{ github_branch }}",
-                          env=e)
+                    command = render_command(checkout_command, env=e)
                 elif 'wait_seconds' in c:
                     seconds = int(c.get('wait_seconds') or 5)
                     logging.info(f'Waiting {seconds} seconds...')
-                    time.sleep(seconds)
+                    await asyncio.sleep(seconds)
                     continue
+                elif c.get('command') in ['wait_host', 'reconnect']:
+                    await self.aconnect(c.get('onall'), c.get('onany'))
+                    continue
+                elif c.get('command') == 'reboot':
+                    command = 'sudo reboot &'
+                    name = c.get('name', 'rebooting node')
                 else:
-                    command = render_command(c.get('command'), self.env)
+                    command = render_command(c.get('command'), self.env, self.strict)
                     name = c.get('name', None)
                 always = c.get('always', False)
+                onall = c.get('onall')
+                onany = c.get('onany')
             try:
                 if name in self.breakpoints:
                     logging.info(f"Breakpoint at step '{name}'")
@@ -598,7 +1578,10 @@ class Routine():
                 if errors and not always:
                     logging.debug(f'Skipping command: {name}\n{command}')
                 else:
-                    host.run(command, name=name, timeout=timeout)
+                    # always steps, like cleanups, are never checkpointed, so they are run on resume too
+                    key = None if always else self.step_key(command)
+                    await self.arun_step(command, onall=onall, onany=onany, key=key,
+                                         name=name, timeout=timeout)
             except Exception as e:
                 logging.error(e)
                 errors.append(e)
@@ -612,24 +1595,41 @@ def do_provision(args):
 
 def do_create(args):
 
-    state = State().with_args(args)
-    workflow = Workflow(state, breaks=args.breakpoint)
+    with profiler.phase('load'):
+        state = State().with_args(args)
+    workflow = Workflow(state, breaks=getattr(args, 'breakpoint', []),
+                        resume=getattr(args, 'continue', False))
+    workflow.compile_steps()
+    Shell.log_dir = getattr(args, 'log_dir', None) or workflow.get_workflow().get('log_dir')
     try:
-        workflow.create_nodes()
+        with span('create_nodes'), profiler.phase('create'):
+            workflow.create_nodes()
     except:
         logging.error("Failed to create nodes")
         traceback.print_exc()
-        if not args.debug and not args.keep_nodes:
+        if not args.debug and not getattr(args, 'keep_nodes', False) and not keep_failed(args):
             logging.info("Cleanup...")
-            workflow.delete_nodes()
+            with span('teardown'), profiler.phase('teardown'):
+                if workflow.get_node_pool_spec():
+                    workflow.release_nodes(wait=not args.no_wait_delete)
+                else:
+                    workflow.delete_nodes(wait=not args.no_wait_delete)
         exit(1)
     return workflow
 
 
+def keep_failed(args):
+    """
+    Return True if the nodes of the failed run are kept to be continued,
+    which is the case for --keep-failed and for continued runs.
+    """
+    return bool(getattr(args, 'keep_failed', False) or getattr(args, 'continue', False))
+
+
 def do_delete(args):
     state = State().load(args)
     workflow = Workflow(state)
-    workflow.delete_nodes()
+    workflow.delete_nodes(wait=not args.no_wait_delete)
 
 def do_run(args):
     workflow = do_create(args)
@@ -639,11 +1639,18 @@ def do_run(args):
     except:
         traceback.print_exc()
         error_code = 1
-    if args.keep_nodes:
+    workflow.state.flush()
+    if args.keep_nodes or (error_code and keep_failed(args)):
+        if error_code and not args.keep_nodes:
+            logging.info("Keeping nodes of the failed run, continue it with 'run --continue'")
         banner = workflow.access_banner()
         if banner:
             logging.info(banner)
+    elif workflow.get_node_pool_spec():
+        with span('teardown'), profiler.phase('teardown'):
+            workflow.release_nodes(wait=not args.no_wait_delete)
     else:
-        do_delete(args)
+        with span('teardown'), profiler.phase('teardown'):
+            do_delete(args)
     if error_code:
         exit(error_code)
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class JsonFileCache():
+    """
+    Thread safe dictionary, which is persisted to a json file
+    if the path is provided, the file is replaced atomically,
+    and if 'mode' is set, the file gets the mode permissions.
+    """
+    mode = None
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = {}
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return self.data
+        if not os.path.exists(self.path):
+            self.data = {}
+            return self.data
+        try:
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring broken cache file {self.path}: {e}')
+            self.data = {}
+        return self.data
+
+    def opener(self, path, flags):
+        if self.mode is None:
+            return os.open(path, flags)
+        fd = os.open(path, flags, self.mode)
+        # the mode of existing file is not changed by open
+        os.fchmod(fd, self.mode)
+        return fd
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', opener=self.opener) as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+
+
+class LookupCache(JsonFileCache):
+    """
+    Thread safe name to value cache with expiration time,
+    which is persisted to a json file if the path is provided.
+
+        cache = LookupCache('.wasser_cache', ttl=3600)
+        image = cache.get('mycloud', 'image', 'Ubuntu 20.10')
+        if not image:
+            image = dict(id=..., name=...)
+            cache.set('mycloud', 'image', 'Ubuntu 20.10', image)
+
+    Values must be json serializable. The 'ttl' can be given to get() and
+    set() as well, so users with different ttl can share the cache.
+    """
+    def __init__(self, path=None, ttl=3600):
+        self.ttl = ttl
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(*keys):
+        return '/'.join(str(_) for _ in keys)
+
+    def get(self, *keys, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl:
+            return None
+        key = self.make_key(*keys)
+        with self.lock:
+            entry = self.data.get(key)
+            if not entry or time.time() - entry['time'] > ttl:
+                return None
+            return entry['value']
+
+    def set(self, *keys_and_value, ttl=None):
+        *keys, value = keys_and_value
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl:
+            return
+        with self.lock:
+            self.data[self.make_key(*keys)] = dict(time=time.time(), value=value)
+            self.save()
+
+    def forget(self, *keys):
+        with self.lock:
+            if self.data.pop(self.make_key(*keys), None) is not None:
+                self.save()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_shared(cls, path):
+    """
+    Return instance of the JsonFileCache subclass shared by all users
+    of the same path.
+    """
+    key = os.path.abspath(path) if path else None
+    with _caches_lock:
+        cache = _caches.get((cls, key))
+        if not cache:
+            cache = cls(key)
+            _caches[(cls, key)] = cache
+        return cache
+
+
+def state_file_path(state_path, name):
+    """
+    Return path of the file with the name in the directory of the state
+    file, or None if there is no state file.
+    """
+    if not state_path:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(state_path)), name)
+
+
+def get_lookup_cache(path):
+    """
+    Return lookup cache shared by all users of the same path,
+    the users pass their own ttl to get() and set().
+    """
+    return get_shared(LookupCache, path)
+
+
+class SnapshotCache(JsonFileCache):
+    """
+    Registry of node snapshot images by provisioning fingerprint,
+    which is persisted to a json file if the path is provided.
+
+        cache = SnapshotCache('.wasser_snapshots')
+        cache.add(fingerprint, image_id, cloud='mycloud')
+        entry = cache.get(fingerprint)
+        for entry in cache.evict(max_age=7*24*3600, max_count=5):
+            delete_image(entry['image_id'])
+    """
+    def get(self, fingerprint):
+        with self.lock:
+            return self.data.get(fingerprint)
+
+    def add(self, fingerprint, image_id, **kwargs):
+        with self.lock:
+            self.data[fingerprint] = dict(fingerprint=fingerprint, image_id=image_id,
+                                          time=time.time(), **kwargs)
+            self.save()
+
+    def remove(self, fingerprint):
+        with self.lock:
+            if self.data.pop(fingerprint, None) is not None:
+                self.save()
+
+    def evict(self, max_age=None, max_count=None, cloud=None):
+        """
+        Remove the entries older than 'max_age' seconds and the oldest
+        entries above 'max_count', only the entries of the given cloud
+        are considered, return list of removed entries.
+        """
+        now = time.time()
+        with self.lock:
+            entries = sorted((_ for _ in self.data.values() if _.get('cloud') == cloud),
+                             key=lambda _: _['time'], reverse=True)
+            evicted = [e for i, e in enumerate(entries)
+                            if (max_age is not None and now - e['time'] > max_age)
+                                or (max_count is not None and i >= max_count)]
+            for e in evicted:
+                del self.data[e['fingerprint']]
+            if evicted:
+                self.save()
+            return evicted
+
+
+def get_snapshot_cache(path):
+    """
+    Return snapshot cache shared by all users of the same path.
+    """
+    return get_shared(SnapshotCache, path)
+
+
+class SpecCache(JsonFileCache):
+    """
+    Cache of merged specs by the spec files they are merged from,
+    which is persisted to a json file if the path is provided.
+
+        cache = SpecCache('.wasser_specs')
+        key = cache.files_key(paths)
+        spec = cache.get(key)
+        if spec is None:
+            spec = merge(paths)
+            cache.set(key, spec)
+
+    The key changes whenever any of the files is created, removed,
+    or modified, only the latest 'max_entries' specs are kept. The specs
+    include the user config, so the file is readable by the owner only.
+    """
+    max_entries = 8
+    mode = 0o600
+
+    @staticmethod
+    def files_key(paths, *extra):
+        """
+        Return key made of the file paths, their modification times and
+        sizes, and the extra json serializable values the spec depends on.
+        """
+        files = []
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                files.append([path])
+                continue
+            files.append([path, st.st_mtime_ns, st.st_size])
+        data = json.dumps([files, extra], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            return entry['spec'] if entry else None
+
+    def set(self, key, spec):
+        """
+        Cache the spec, unless it cannot be saved as json unchanged,
+        for example, if it has dates or non-string keys.
+        """
+        if self.path:
+            try:
+                if json.loads(json.dumps(spec)) != spec:
+                    raise ValueError('spec is changed by json round trip')
+            except (TypeError, ValueError) as e:
+                logging.debug(f'Not caching spec: {e}')
+                return
+        with self.lock:
+            self.data[key] = dict(time=time.time(), spec=spec)
+            for k in sorted(self.data, key=lambda _: self.data[_]['time'])[:-self.max_entries]:
+                del self.data[k]
+            self.save()
+
+
+def get_spec_cache(path):
+    """
+    Return spec cache shared by all users of the same path.
+    """
+    return get_shared(SpecCache, path)
@@ -1,20 +1,333 @@
+import base64
+import json
 import logging
 import openstack
 import os
+import re
+import socket
+import threading
 import time
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict
+from wasser.cache import get_lookup_cache, state_file_path
 from wasser.state import NodeState, State
+from wasser.timing import span
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_cloud_connection(cloud, debug=False):
+    """
+    Return openstack connection for the cloud, the connection is opened
+    once and shared by all equipments using the same cloud.
+    """
+    with _connections_lock:
+        conn = _connections.get(cloud)
+        if conn:
+            return conn
+        if debug:
+            openstack.enable_logging(debug=True)
+        else:
+            openstack.enable_logging(debug=False)
+            logging.getLogger("paramiko").setLevel(logging.WARNING)
+        conn = openstack.connect(cloud)
+        _connections[cloud] = conn
+        return conn
+
+
+class ServerWatcher():
+    """
+    Watches for the servers to become active using single server listing
+    per tick for all pending servers of the connection.
+
+    The polling interval starts with 'min_wait' seconds and grows by
+    'factor' up to 'max_wait' seconds, and it is reset every time a new
+    server is added. Waiting threads are notified as soon as the server
+    status is changed to ACTIVE or ERROR.
+    """
+    def __init__(self, conn, min_wait=2, max_wait=15, factor=1.5):
+        self.conn = conn
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.factor = factor
+        self.interval = min_wait
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.thread = None
+
+    def wait(self, server_id, timeout=8*60):
+        """
+        Wait until server is active and return it.
+        """
+        return self.result(server_id, self.add(server_id), timeout)
+
+    def add(self, server_id):
+        """
+        Start watching the server, return the waiter for result(),
+        so many servers can be watched at once.
+        """
+        waiter = dict(event=threading.Event(), server=None, error=None, status=None, missing=0,
+                      time=time.time())
+        with self.lock:
+            self.pending[server_id] = waiter
+            self.interval = self.min_wait
+            if not self.thread:
+                self.thread = threading.Thread(target=self.poll, name='server-watcher', daemon=True)
+                self.thread.start()
+        return waiter
+
+    def result(self, server_id, waiter, timeout):
+        """
+        Wait until the watched server is active, but not longer than
+        'timeout' seconds since it was added, and return it.
+        """
+        if not waiter['event'].wait(max(0, waiter['time'] + timeout - time.time())):
+            with self.lock:
+                self.pending.pop(server_id, None)
+            raise Exception(f"Timeout occured, was not possible to make server '{server_id}' active "
+                            f"in {timeout} seconds, last status: {waiter['status']}")
+        if waiter['error']:
+            raise waiter['error']
+        return waiter['server']
+
+    def notify(self, server_id, server=None, error=None):
+        with self.lock:
+            waiter = self.pending.pop(server_id, None)
+        if waiter:
+            waiter['server'] = server
+            waiter['error'] = error
+            waiter['event'].set()
+
+    def fault_message(self, server):
+        fault = getattr(server, 'fault', None)
+        if not fault:
+            # the server listing does not always contain fault details
+            fault = self.conn.get_server_by_id(server.id).get('fault')
+        return (fault or {}).get('message')
+
+    def check(self, server_id, waiter, server):
+        if server is None:
+            # the server might not yet appear in the listing, but if it is
+            # missing for several ticks, it is probably deleted
+            waiter['missing'] += 1
+            if waiter['missing'] > 3:
+                self.notify(server_id, error=Exception(f"Server '{server_id}' is not found"))
+            return
+        if server.status != waiter['status']:
+            logging.info(f"Server {server.name} status is: {server.status}")
+            waiter['status'] = server.status
+        if server.status == 'ACTIVE':
+            self.notify(server_id, server=server)
+        elif server.status == 'ERROR':
+            message = self.fault_message(server)
+            if message:
+                error = Exception("Server creation unexpectedly failed with message: %s" % message)
+            else:
+                error = Exception("Unknown failure while creating server: %s" % server)
+            self.notify(server_id, error=error)
+
+    def poll(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                pending = dict(self.pending)
+                wait = self.interval
+                self.interval = min(self.max_wait, self.interval * self.factor)
+            time.sleep(wait)
+            try:
+                servers = {_.id: _ for _ in self.conn.compute.servers()}
+            except Exception as e:
+                logging.warning(f'Failed to list servers: {e}')
+                continue
+            logging.debug(f'Checking status of {len(pending)} servers')
+            for server_id, waiter in pending.items():
+                try:
+                    self.check(server_id, waiter, servers.get(server_id))
+                except Exception as e:
+                    self.notify(server_id, error=e)
+
+
+_watchers = {}
+
+
+def get_server_watcher(conn):
+    """
+    Return server watcher shared by all equipments using the connection.
+    """
+    with _connections_lock:
+        watcher = _watchers.get(id(conn))
+        if not watcher or watcher.conn is not conn:
+            watcher = ServerWatcher(conn)
+            _watchers[id(conn)] = watcher
+        return watcher
+
+
+class NameAllocator():
+    """
+    Allocates server names for the name template without renaming servers
+    and without host wide locks.
+
+    Existing server names are listed once, and the free names are handed
+    out to the equipments of this process. Since other processes can pick
+    the same name meanwhile, each server is created with the claim in its
+    metadata, and when the server is active, the servers with the same
+    name are checked: the server without a claim or with the earliest
+    claim keeps the name, the others pick the next free name.
+
+    Servers booted with a multi-create request keep their generated names,
+    their node names are held in 'name_key' metadata instead, and are
+    claimed for the whole batch at once, see claim_batch().
+    """
+    claim_key = 'wasser_claim'
+    name_key = 'wasser_name'
+    # maximum index tried for the name template
+    max_index = 10000
+
+    def __init__(self, conn, template):
+        self.conn = conn
+        self.template = template
+        self.lock = threading.Lock()
+        self.taken = None
+
+    def make_claim(self):
+        return f'{time.time():.6f}/{socket.gethostname()}/{os.getpid()}'
+
+    @classmethod
+    def server_names(cls, server):
+        """Return names the server is known by"""
+        names = {server.name}
+        name = (server.metadata or {}).get(cls.name_key)
+        if name:
+            names.add(name)
+        return names
+
+    @staticmethod
+    def claim_order(server_id, claim):
+        if not claim:
+            return (0.0, server_id)
+        return (float(claim.split('/')[0]), server_id)
+
+    def allocate(self):
+        with self.lock:
+            if self.taken is None:
+                self.taken = set(n for _ in self.conn.compute.servers() for n in self.server_names(_))
+            for n in range(self.max_index):
+                name = OpenStackEquipment.make_server_name(self.template, n)
+                if name not in self.taken:
+                    self.taken.add(name)
+                    return name
+        raise Exception(f"Can't allocate name for template '{self.template}'")
+
+    def is_claimed(self, servers, server, claim, name):
+        """Return True if the server keeps the name among the listed servers"""
+        order = self.claim_order(server.id, claim)
+        same = [_ for _ in servers if name in self.server_names(_) and _.id != server.id]
+        return all(order < self.claim_order(_.id, (_.metadata or {}).get(self.claim_key)) for _ in same)
+
+    def claim(self, server, claim, tries=10):
+        """
+        Make sure the server is the only one with its name, otherwise
+        move the server to the next free name, return the final name.
+        """
+        name = server.name
+        for _ in range(tries):
+            servers = self.conn.compute.servers(name=f'^{re.escape(name)}$')
+            if self.is_claimed(servers, server, claim, name):
+                return name
+            logging.info(f"Server name {name} is claimed by another server, picking another name")
+            name = self.allocate()
+            self.conn.compute.update_server(server.id, name=name)
+        raise Exception(f"Cannot claim name for server '{server.id}'")
+
+    def claim_batch(self, servers, claim, names, tries=10):
+        """
+        Claim the names held in the metadata of the servers of a batch,
+        which all have the same claim, return the final names.
+
+        The names are checked against single listing of all servers per
+        try, the servers are never renamed, the servers which lose their
+        names get the next free names in the metadata.
+        """
+        names = dict(zip([_.id for _ in servers], names))
+        pending = list(servers)
+        for _ in range(tries):
+            listed = list(self.conn.compute.servers())
+            lost = [_ for _ in pending if not self.is_claimed(listed, _, claim, names[_.id])]
+            for server in lost:
+                logging.info(f"Server name {names[server.id]} is claimed by another server, picking another name")
+                names[server.id] = self.allocate()
+                self.conn.compute.set_server_metadata(server.id, **{self.name_key: names[server.id]})
+            if not lost:
+                return [names[_.id] for _ in servers]
+            pending = lost
+        raise Exception(f"Cannot claim names for servers {', '.join(_.id for _ in pending)}")
+
+
+_allocators = {}
+
+
+def get_name_allocator(conn, template):
+    """
+    Return name allocator shared by all equipments using the connection
+    and the name template.
+    """
+    with _connections_lock:
+        key = (id(conn), template)
+        allocator = _allocators.get(key)
+        if not allocator or allocator.conn is not conn:
+            allocator = NameAllocator(conn, template)
+            _allocators[key] = allocator
+        return allocator
 
 
 class Equipment():
+    # name of the routine the node belongs to, used to tag timings
+    routine = None
+
     def __init__(self):
         pass
 
     def create(self):
         pass
 
-    def delete(self):
+    def delete(self, wait=True):
+        pass
+
+    def batch_key(self):
+        """
+        Return hashable key of equipments, which can be created together
+        with create_batch, or None if the equipment is created on its own.
+        """
+        return None
+
+    @staticmethod
+    def create_batch(equipments, threads=1):
+        for e in equipments:
+            e.create()
+
+    def snapshot(self, name, metadata=None):
+        """
+        Make image of the node and return its id,
+        or None if snapshots are not supported.
+        """
+        return None
+
+    def image_exists(self, image_id):
+        return False
+
+    def is_alive(self):
+        """
+        Return True if the node is up and can be reused.
+        """
+        return False
+
+    def delete_image(self, image_id):
         pass
 
     @staticmethod
@@ -52,53 +365,111 @@ class OpenStackEquipment(Equipment):
     def get_connect(self):
         if self.conn:
             return self.conn
+        self.conn = get_cloud_connection(self.spec.get('cloud'), self.state.state.debug)
+        return self.conn
 
+    def get_cache(self):
+        """
+        Return resource lookup cache, which is stored next to the state file,
+        and shared by all equipments, see lookup() for the entries expiration.
+        """
+        args = getattr(self.state.state, 'args', None)
+        return get_lookup_cache(state_file_path(getattr(args, 'state_path', None), '.wasser_cache'))
+
+    def lookup(self, kind, name, find):
+        """
+        Return dict with 'id' and 'name' of the resource of given kind,
+        the 'find' function is called only if the resource is not cached.
+        The cache entries expire after 'cache_ttl' seconds of the equipment
+        spec, 0 disables cache.
+        """
+        cache = self.get_cache()
         cloud = self.spec.get('cloud')
-        if self.state.state.debug:
-            openstack.enable_logging(debug=True)
-        else:
-            openstack.enable_logging(debug=False)
-            logging.getLogger("paramiko").setLevel(logging.WARNING)
-        self.conn = openstack.connect(cloud)
-        return self.conn
+        ttl = self.spec.get('cache_ttl', 3600)
+        value = cache.get(cloud, kind, name, ttl=ttl)
+        if value:
+            logging.debug(f'Found cached {kind} {name}: {value}')
+            return value
+        res = find(name)
+        if not res:
+            return None
+        value = dict(id=res.id, name=res.name)
+        cache.set(cloud, kind, name, value, ttl=ttl)
+        return value
+
+    def forget_lookups(self):
+        cache = self.get_cache()
+        cloud = self.spec.get('cloud')
+        lookups = dict(
+            image=self.spec.get('image'),
+            flavor=self.spec.get('flavor'),
+            keypair=self.spec.get('keyname'),
+            network=self.spec.get('network'),
+        )
+        for kind, name in lookups.items():
+            cache.forget(cloud, kind, name)
 
 
     def create(self):
         logging.debug(f'Create OpenStack equipment with node state {self.state}')
         self.create_server(self.state)
 
-    def delete(self):
-        self.delete_server(self.state)
-
-    def create_server(self, node_state: NodeState):
-        """OpenStack create_server wrapper"""
+    def delete(self, wait=True):
+        self.delete_server(self.state, wait=wait)
 
+    def snapshot(self, name, metadata=None):
         conn = self.get_connect()
-        c = self.conn.compute
-        server_list = c.servers()
-        logging.info("Found existing servers: %s" % ", ".join([i.name for i in server_list]))
+        logging.info(f'Creating snapshot {name} of server {self.state.data.get("name")}...')
+        image = conn.create_image_snapshot(name, self.state.data['id'], wait=True,
+                                           timeout=self.spec.get('snapshot_timeout', 30*60),
+                                           **(metadata or {}))
+        logging.info(f'Created snapshot image: {image.id}')
+        return image.id
+
+    def image_exists(self, image_id):
+        return self.get_connect().get_image(image_id) is not None
+
+    def is_alive(self):
+        target_id = self.state.data.get('id')
+        if not target_id:
+            return False
+        try:
+            server = self.get_connect().compute.get_server(target_id)
+        except openstack.exceptions.NotFoundException:
+            return False
+        return server.status == 'ACTIVE'
+
+    def delete_image(self, image_id):
+        logging.info(f'Deleting snapshot image {image_id}')
+        self.get_connect().delete_image(image_id)
+
+    def resolve_resources(self, conn):
+        """
+        Look up image, flavor, keypair and network of the server spec
+        and read userdata, return them in a dictionary.
+        """
         image_name = self.spec.get('image', None)
         if not image_name:
-            raise Executable("image name is not specified")
+            raise Exception("image name is not specified")
         logging.info(f"Looking up image {image_name}...")
-        image = self.conn.get_image(image_name)
+        image = self.lookup('image', image_name, conn.get_image)
         if not image:
             raise Exception(f"Cannot find image {image_name}")
-        logging.info(f"Found image with id: {image.id}")
+        logging.info(f"Found image with id: {image['id']}")
         flavor_name = self.spec.get('flavor', None)
         if not flavor_name:
-            raise Executable("image name is not specified")
-        flavor = conn.get_flavor(flavor_name)
+            raise Exception("flavor name is not specified")
+        flavor = self.lookup('flavor', flavor_name, conn.get_flavor)
         if not flavor:
             raise Exception(f"Cannot find flavor {flavor_name}")
-        logging.info(f"Found flavor: {flavor.id}")
+        logging.info(f"Found flavor: {flavor['id']}")
         keyname = self.spec.get('keyname', None)
-        keypair = conn.compute.find_keypair(keyname)
+        keypair = self.lookup('keypair', keyname, conn.compute.find_keypair)
         if not keypair:
             raise Exception(f"Cannot find keypair '{keyname}'")
-        logging.info("Image:   %s" % image.name)
-        logging.info("Flavor:  %s" % flavor.name)
-        logging.info("Keypair: %s" % keypair.name)
+        logging.info("Image:   %s" % image['name'])
+        logging.info("Flavor:  %s" % flavor['name'])
+        logging.info("Keypair: %s" % keypair['name'])
         userdata = None
         userdata_path = self.spec.get('userdata', None)
         if userdata_path:
@@ -110,39 +481,65 @@ class OpenStackEquipment(Equipment):
             with open(userdata_path, 'r') as f:
                 userdata=f.read()
         logging.debug("Creating target using flavor %s" % flavor)
-        logging.debug("Image=%s" % image.name)
+        logging.debug("Image=%s" % image['name'])
         logging.debug("Data:\n%s" % userdata)
-        c = conn.compute
 
+        network = None
+        target_network = self.spec.get('network')
+        if target_network:
+            network = self.lookup('network', target_network, conn.network.find_network)
+            if not network:
+                raise Exception(f"Cannot find network '{target_network}'")
+        return dict(image=image, flavor=flavor, keypair=keypair, network=network, userdata=userdata)
+
+    def get_name_allocator(self, conn):
+        """
+        Return name allocator if the server name is a template, otherwise None.
+        """
         # if the target is not kind a template, just use it as server name
+        target_mask = self.spec.get('name')
+        if target_mask != self.make_server_name(target_mask, 0):
+            return get_name_allocator(conn, target_mask)
+        return None
+
+    def create_server(self, node_state: NodeState):
+        """OpenStack create_server wrapper"""
+
+        conn = self.get_connect()
+        with span('lookup', routine=self.routine):
+            res = self.resolve_resources(conn)
+
         target_mask = self.spec.get('name')
         username = self.spec.get('username', 'root')
         keyfile = self.spec.get('keyfile', '~/.ssh/id_rsa')
         node_state.update(username=username)
         node_state.update(keyfile=keyfile)
-        rename_server = (target_mask != self.make_server_name(target_mask, 0))
-        if rename_server:
-            target_name = 'wasser'
+        allocator = self.get_name_allocator(conn)
+        if allocator:
+            target_name = allocator.allocate()
         else:
             target_name = target_mask
         node_state.update(name=target_name)
 
         params  = dict(
             name=target_name,
-            image=image.id,
-            flavor=flavor.id,
-            key_name=keypair.name,
-            userdata=userdata,
+            image=res['image']['id'],
+            flavor=res['flavor']['id'],
+            key_name=res['keypair']['name'],
+            userdata=res['userdata'],
         )
+        claim = None
+        if allocator:
+            claim = allocator.make_claim()
+            params['meta'] = {NameAllocator.claim_key: claim}
 
-        target_network = self.spec.get('network')
-        target_floating = self.spec.get('floating')
-
-        if target_network:
-            params['network'] = target_network
+        if res['network']:
+            # passing network id with nics avoids network lookups on every create
+            params['nics'] = [{'net-id': res['network']['id']}]
 
         try:
-            target = conn.create_server(**params)
+            with span('create_server', routine=self.routine, node=target_name):
+                target = conn.create_server(**params)
         #Traceback (most recent call last):
         #  File "/home/jenkins/wasser/v/lib/python3.6/site-packages/openstack/cloud/_utils.py", line 425, in shade_exceptions
         #    yield
@@ -153,6 +550,8 @@ class OpenStackEquipment(Equipment):
         # which is mapped to another:
         #   openstack.exceptions.SDKException: Error in creating instance
         except Exception as e:
+            # the cached resources might be gone meanwhile, so look them up next time
+            self.forget_lookups()
             if "Error in creating instance" in str(e):
                 logging.error(f'Failed to create server due to openstack bug')
                 logging.warning(f'Going to cleanup server after a second')
@@ -170,35 +569,28 @@ class OpenStackEquipment(Equipment):
         logging.info("Created target: %s" % target.id)
         node_state.update(id=target.id)
         logging.debug(target)
+        self.setup_server(node_state, target, allocator, claim)
 
+    def setup_server(self, node_state: NodeState, target, allocator=None, claim=None, name=None):
+        """
+        Wait for the created server to become active, claim its name,
+        attach floating ip, if required, and save node address.
+        The 'name' is given, if the node name is held in server metadata
+        and is already claimed.
+        """
+        conn = self.get_connect()
+        target_id = target.id
+        target_floating = self.spec.get('floating')
         fip_id = None
-        if rename_server:
-            # for some big nodes sometimes rename does not happen
-            # and a pause is required
-            grace_wait = 5
-            logging.info("Graceful wait %s sec before rename..." % grace_wait)
-            time.sleep(grace_wait)
-            self.set_name(target.id, lockname=target_mask)
-
-        timeout = 8 * 60
-        wait = 10
-        start_time = time.time()
-        while target.status != 'ACTIVE':
-          logging.debug("Target status is: %s" % target.status)
-          if target.status == 'ERROR':
-            # only get_server_by_id can return 'fault' for a server
-            x=conn.get_server_by_id(target_id)
-            if 'fault' in x and 'message' in x['fault']:
-                raise Exception("Server creation unexpectedly failed with message: %s" % x['fault']['message'])
-            else:
-                raise Exception("Unknown failure while creating server: %s" % x)
-          if timeout > (time.time() - start_time):
-            logging.info(f'Server {target.name} is not active. Waiting {wait} seconds...')
-            time.sleep(wait)
-          else:
-            logging.error("Timeout occured, was not possible to make server active")
-            break
-          target=conn.compute.get_server(target_id)
+        tags = dict(routine=self.routine, node=node_state.data.get('name'))
+        if target.status != 'ACTIVE':
+            with span('wait_active', **tags):
+                target = get_server_watcher(conn).wait(target_id, timeout=8 * 60)
+
+        target_name = name or target.name
+        if allocator:
+            with span('rename', **tags):
+                target_name = allocator.claim(target, claim)
 
         for i,v in target.addresses.items():
             logging.info(i)
@@ -208,32 +600,191 @@ class OpenStackEquipment(Equipment):
             for x in nets if x['version'] == 4][0]
         logging.info(ipv4)
         if target_floating:
-            faddr = conn.create_floating_ip(
-                    network=target_floating,
-                    server=target,
-                    fixed_address=ipv4,
-                    wait=True,
-                    )
+            with span('floating_ip', **tags):
+                faddr = conn.create_floating_ip(
+                        network=target_floating,
+                        server=target,
+                        fixed_address=ipv4,
+                        wait=True,
+                        )
             ipv4 = faddr['floating_ip_address']
             fip_id = faddr['id']
             node_state.update(fip_id=fip_id)
 
-        node_state.update(ip=ipv4, name=target.name)
+        node_state.update(ip=ipv4, name=target_name)
 
+    def batch_key(self):
+        """
+        Return the key to group the equipments with identical server spec,
+        which can be created with single request, or None if 'multi_create'
+        is not enabled in the spec. The batch servers keep generated names,
+        so the templated names are only held in the server metadata.
+        """
+        if not self.spec.get('multi_create', False):
+            return None
+        return json.dumps(self.spec, sort_keys=True, default=str)
 
-    def delete_server(self, node_state):
+    @staticmethod
+    def create_batch(equipments, threads=1):
+        """
+        Create servers for all equipments with single multi-create request,
+        the servers are set up by up to 'threads' workers in parallel.
+
+        All equipments are supposed to have the same batch key. Nova boots
+        the servers with generated names '<name>-<count>', so the servers
+        are boot with unique batch name and mapped back to the equipments
+        in the count order. The servers are not renamed, the node names
+        are claimed with server metadata, see NameAllocator.
+
+        The server ids are saved right after the servers are listed, so
+        all booted servers are deleted with the nodes on failure, the
+        servers which cannot be mapped to the equipments are deleted
+        right away.
+        """
+        first = equipments[0]
+        conn = first.get_connect()
+        # identical nodes of several routines can be created together
+        routines = set(_.routine for _ in equipments)
+        routine = routines.pop() if len(routines) == 1 else None
+        with span('lookup', routine=routine):
+            res = first.resolve_resources(conn)
+        count = len(equipments)
+        username = first.spec.get('username', 'root')
+        keyfile = first.spec.get('keyfile', '~/.ssh/id_rsa')
+        allocator = first.get_name_allocator(conn)
+        names = []
+        for e in equipments:
+            name = allocator.allocate() if allocator else first.spec.get('name')
+            names.append(name)
+            e.state.update(username=username, keyfile=keyfile, name=name)
+
+        batch_name = f'wasser-{uuid.uuid4().hex[:8]}'
+        params = dict(
+            name=batch_name,
+            image_id=res['image']['id'],
+            flavor_id=res['flavor']['id'],
+            key_name=res['keypair']['name'],
+            min_count=count,
+            max_count=count,
+        )
+        claim = None
+        if allocator:
+            claim = allocator.make_claim()
+            params['metadata'] = {NameAllocator.claim_key: claim}
+        if res['userdata']:
+            params['user_data'] = base64.b64encode(res['userdata'].encode()).decode()
+        if res['network']:
+            params['networks'] = [{'uuid': res['network']['id']}]
+        logging.info(f"Creating {count} servers with single request as '{batch_name}'")
+        try:
+            with span('create_server', routine=routine, batch=batch_name, count=count):
+                conn.compute.create_server(**params)
+            servers = [_ for _ in conn.compute.servers(name=f'^{batch_name}-')
+                            if _.name.startswith(f'{batch_name}-')]
+        except Exception:
+            first.forget_lookups()
+            raise
+        servers.sort(key=lambda _: int(_.name.rsplit('-', 1)[-1]))
+        for e, server in zip(equipments, servers):
+            logging.info(f"Created target: {server.id}")
+            e.state.update(id=server.id)
+        if len(servers) != count:
+            for server in servers[count:]:
+                logging.info(f"Deleting unexpected server {server.name}: {server.id}")
+                conn.compute.delete_server(server.id, ignore_missing=True)
+            raise Exception(f"Expected {count} servers named '{batch_name}-*', found {len(servers)}")
+
+        # all servers are watched at once, and set up in parallel as they become active
+        watcher = get_server_watcher(conn)
+        waiters = {_.id: watcher.add(_.id) for _ in servers if _.status != 'ACTIVE'}
+
+        def rename(e, target, name):
+            with span('rename', routine=e.routine, node=name):
+                conn.compute.set_server_metadata(target.id, **{NameAllocator.name_key: name})
+
+        def setup(e, target, name):
+            if target.id in waiters:
+                with span('wait_active', routine=e.routine, node=name):
+                    target = watcher.result(target.id, waiters[target.id], 8 * 60)
+            e.setup_server(e.state, target, name=name)
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='setup') as pool:
+            list(pool.map(rename, equipments, servers, names))
+            if allocator:
+                with span('claim', routine=routine, batch=batch_name, count=count):
+                    names = allocator.claim_batch(servers, claim, names)
+                for e, name in zip(equipments, names):
+                    e.state.update(name=name)
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='setup') as pool:
+            futures = {pool.submit(setup, e, t, n): e for e, t, n in zip(equipments, servers, names)}
+            for f in as_completed(futures):
+                try:
+                    f.result()
+                except Exception as x:
+                    logging.error(f'Failed to create node {futures[f].state.data.get("name")}: {x}')
+                    errors.append(x)
+        if errors:
+            raise errors[0]
+
+    def delete_server(self, node_state, wait=True, timeout=5*60):
+        """
+        Delete the server and release its floating ip, and if 'wait'
+        is True, wait until the server is gone.
+
+        The delete progress is recorded in the node state 'status',
+        which is 'deleting' when delete is requested and 'deleted'
+        when the server is confirmed to be removed. If the delete request
+        fails, the floating ip is still released, and the error is raised
+        without waiting.
+        """
         logging.debug(f'Delete node {node_state}')
-        conn = self.get_connect()
         target_id = node_state.data.get('id')
         fip_id = node_state.data.get('fip_id')
+        if not target_id:
+            logging.debug(f'Skipping node without server id: {node_state.data}')
+            return
+        if node_state.data.get('status') == 'deleted':
+            logging.debug(f"Server with id '{target_id}' is already deleted")
+            return
+        if node_state.data.get('status') == 'released':
+            logging.debug(f"Server with id '{target_id}' is released to node pool")
+            return
+        conn = self.get_connect()
         logging.info(f"Delete server with id '{target_id}'")
+        error = None
         try:
-            target=conn.compute.get_server(target_id)
-            conn.compute.delete_server(target.id)
+            conn.compute.delete_server(target_id, ignore_missing=True)
+            node_state.update(status='deleting')
         except Exception as e:
             logging.warning(e)
+            error = e
         if fip_id:
-            conn.delete_floating_ip(fip_id)
+            try:
+                conn.delete_floating_ip(fip_id)
+                node_state.update(fip_id=None)
+            except Exception as e:
+                logging.warning(e)
+        if error:
+            raise Exception(f"Failed to delete server '{target_id}': {error}")
+        if wait:
+            self.wait_server_deleted(node_state, timeout)
+
+    def wait_server_deleted(self, node_state, timeout=5*60, wait=2):
+        conn = self.get_connect()
+        target_id = node_state.data.get('id')
+        start_time = time.time()
+        while True:
+            try:
+                conn.compute.get_server(target_id)
+            except openstack.exceptions.NotFoundException:
+                logging.info(f"Server with id '{target_id}' is deleted")
+                node_state.update(status='deleted')
+                return
+            if timeout < (time.time() - start_time):
+                raise Exception(f"Timeout occured while waiting for server '{target_id}' to be deleted")
+            time.sleep(wait)
 
     @staticmethod
     def make_server_name(template, index):
@@ -252,62 +803,3 @@ class OpenStackEquipment(Equipment):
         except:
           target = template
         return target
-
-    def set_server_name(self, server_id, template):
-        """
-        Go through the range of possible names, skip the name if present
-        or set it the server with  given id.
-        """
-        logging.info("Update name for server %s" % server_id)
-        server_list = self.conn.compute.servers()
-        existing_servers = [i.name for i in server_list]
-        for n in range(99):
-            target = self.make_server_name(template, n)
-            if not target in existing_servers:
-                logging.info("Setting server name to %s" % target)
-                #self.conn.compute.update_server(server_id, name=target)
-                #s = self.conn.update_server(server_id, name=target)
-                tries=20
-                while tries > 0:
-                    self.conn.compute.update_server(server_id, name=target)
-                    time.sleep(10) # wait count to 10
-                    s = self.conn.get_server_by_id(server_id)
-                    if s.name and s.name == target:
-                        break
-                    else:
-                        logging.info("Server name is '%s', should be '%s'" %(s.name, target))
-                    tries -= 1
-                    logging.info("Left %s tries to rename the server" % tries)
-                else:
-                    raise SystemExit("Cannot set name to '%s' for server '%s'" % (target, server_id))
-                return target
-        logging.error("Can't allocate name")
-        logging.info("TODO: Add wait loop for name allocation")
-
-    def set_name(self, server_id, lockname='wasser_set_name.lock'):
-        """
-        Set name for server id using
-        """
-        template = self.spec.get('name')
-        import fcntl
-        lockfile = '/tmp/' + lockname
-        lock_timeout = 5 * 60
-        lock_wait = 2
-        logging.debug("Trying to lock file for process " + str(os.getpid()))
-        while True:
-                try:
-                        lock = open(lockfile, 'w')
-                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                        logging.debug(f"File locked for process {os.getpid()}")
-                        res = self.set_server_name(server_id, template)
-                        fcntl.flock(lock, fcntl.LOCK_UN)
-                        logging.debug(f'Unlocking for {os.getpid()}')
-                        break
-                except IOError as err:
-                        # print "Can't lock: ", err
-                        if lock_timeout > 0:
-                                lock_timeout -= lock_wait
-                                logging.debug("Process", os.getpid(), "waits", lock_wait, "seconds...")
-                                time.sleep(lock_wait)
-                        else:
-                                raise SystemExit('Unable to obtain file lock: %s' % lockfile)
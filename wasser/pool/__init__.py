@@ -0,0 +1,106 @@
+import contextlib
+import fcntl
+import os
+import socket
+import time
+
+from wasser.cache import JsonFileCache, get_shared
+
+
+class NodePool(JsonFileCache):
+    """
+    Registry of the nodes kept running between runs, persisted to a json
+    file if the path is provided.
+
+    Idle nodes are tagged with the hash of their spec, a run leases
+    the idle nodes with matching hash before creating new ones, and
+    releases them back to the pool when it is done.
+
+        pool = NodePool('.wasser_pool')
+        entry = pool.lease(spec_hash)
+        if entry:
+            node = entry['node']
+        ...
+        pool.release(node, spec_hash, spec)
+
+    The file is reloaded and locked while it is modified, so concurrent
+    runs on the same host do not lease the same node.
+    """
+    def save(self, data=None):
+        with self.lock:
+            if data is not None:
+                self.data = data
+            super().save()
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        if not self.path:
+            yield
+            return
+        with open(f'{self.path}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def modify(self, func):
+        """
+        Call 'func' with the pool data under the file lock,
+        save the data and return the result of the call.
+        """
+        with self.lock, self.file_lock():
+            result = func(self.load())
+            self.save()
+            return result
+
+    @staticmethod
+    def owner():
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def lease(self, spec_hash):
+        """
+        Mark the oldest idle node with the spec hash as leased,
+        return its entry or None if there is no such node.
+        """
+        def lease(data):
+            idle = sorted((_ for _ in data.values() if _['status'] == 'idle' and _['hash'] == spec_hash),
+                          key=lambda _: _['time'])
+            if not idle:
+                return None
+            entry = idle[0]
+            entry.update(status='leased', time=time.time(), owner=self.owner())
+            return dict(entry)
+        return self.modify(lease)
+
+    def release(self, node, spec_hash, spec):
+        """
+        Put the node into the pool as idle node.
+        """
+        def release(data):
+            data[node['id']] = dict(node=node, hash=spec_hash, spec=spec,
+                                    status='idle', time=time.time(), owner=None)
+        self.modify(release)
+
+    def remove(self, node_id):
+        self.modify(lambda data: data.pop(node_id, None))
+
+    def reap(self, ttl, lease_timeout):
+        """
+        Remove idle nodes which are not used for 'ttl' seconds, and the
+        nodes leased more than 'lease_timeout' seconds ago, which is the
+        case when the run is crashed, return list of removed entries.
+        """
+        def reap(data):
+            now = time.time()
+            expired = [k for k, v in data.items()
+                        if now - v['time'] > (ttl if v['status'] == 'idle' else lease_timeout)]
+            return [data.pop(_) for _ in expired]
+        return self.modify(reap)
+
+
+def get_node_pool(path):
+    """
+    Return node pool shared by all users of the same path.
+    """
+    return get_shared(NodePool, path)
@@ -0,0 +1,188 @@
+import collections
+import contextlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+
+class Profiler():
+    """
+    Sampling profiler of all threads of the process.
+
+    The stacks of all threads are sampled every 'interval' seconds by
+    a separate thread, so the profiled code is not slowed down, except
+    for the sampler itself holding the interpreter lock for a moment.
+    Only the threads which are running at the moment are sampled, when
+    the thread states are available (linux /proc), so the threads
+    waiting for commands, locks or cloud API responses are not counted
+    and the samples show where the CPU time is spent.
+
+    The samples are grouped by the run phase, which is set with phase(),
+    and are saved to a directory in collapsed stack format, one file per
+    phase, which can be turned into flamegraph with flamegraph.pl,
+    speedscope or similar tools:
+
+        thread;outer_function (file:line);inner_function (file:line) count
+    """
+    # thread bootstrap frames, which are at the bottom of every thread stack,
+    # are not listed in the top functions by inclusive samples
+    bootstrap_frames = re.compile(r' \((threading|concurrent/futures/thread)\.py:\d+\)$')
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.phase = None
+        # phase mapped to counter of collapsed stacks
+        self.samples = collections.defaultdict(collections.Counter)
+        self.labels = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_time = None
+        self.wall_time = 0
+
+    def start(self):
+        self.stopped.clear()
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.sample_loop, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.wall_time = time.time() - self.start_time
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    @staticmethod
+    def is_running(thread):
+        """
+        Return False if the thread is known to be sleeping.
+        """
+        try:
+            with open(f'/proc/self/task/{thread.native_id}/stat', 'rb') as f:
+                stat = f.read()
+        except (OSError, AttributeError, TypeError):
+            return True
+        # the state follows the command name, which is in parentheses
+        return stat[stat.rindex(b')') + 2:][:1] == b'R'
+
+    @staticmethod
+    def thread_name(thread):
+        # pool threads of the same kind are merged, for example, create_0 and create_1
+        return re.sub(r'[_-]\d+', '', thread.name) if thread else 'unknown'
+
+    def frame_label(self, code):
+        label = self.labels.get(code)
+        if not label:
+            path = code.co_filename
+            prefixes = [_ for _ in sys.path if _ and path.startswith(_ + os.sep)]
+            if prefixes:
+                path = os.path.relpath(path, max(prefixes, key=len))
+            label = f'{code.co_name} ({path}:{code.co_firstlineno})'
+            self.labels[code] = label
+        return label
+
+    def sample(self):
+        threads = {_.ident: _ for _ in threading.enumerate()}
+        own = threading.get_ident()
+        counter = self.samples[self.phase]
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            thread = threads.get(ident)
+            if thread and not self.is_running(thread):
+                continue
+            stack = []
+            while frame:
+                stack.append(self.frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(self.thread_name(thread))
+            counter[';'.join(reversed(stack))] += 1
+
+    def save(self, path):
+        """
+        Save collapsed stacks of each phase to the directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        for phase, counter in self.samples.items():
+            with open(os.path.join(path, f'{phase or "other"}.folded'), 'w') as f:
+                for stack, count in counter.most_common():
+                    f.write(f'{stack} {count}\n')
+
+    def top(self, count=10):
+        """
+        Return total number of samples, and lists of the top functions
+        by own and by inclusive number of samples with their counts.
+        """
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        total = 0
+        for counter in self.samples.values():
+            for stack, n in counter.items():
+                frames = stack.split(';')[1:]
+                total += n
+                if frames:
+                    own[frames[-1]] += n
+                for f in set(frames):
+                    if not self.bootstrap_frames.search(f):
+                        inclusive[f] += n
+        return total, own.most_common(count), inclusive.most_common(count)
+
+    def summary(self, count=10):
+        total, own, inclusive = self.top(count)
+        phases = ', '.join(f'{phase or "other"}={sum(c.values())}' for phase, c in self.samples.items())
+        lines = [f'Profile: {total} samples of running threads in {self.wall_time:.1f}s '
+                 f'with {self.interval * 1000:.0f}ms interval ({phases})']
+        for title, top in [('own', own), ('inclusive', inclusive)]:
+            lines.append(f'Top {len(top)} functions by {title} samples:')
+            lines += [f'  {n / total * 100:5.1f}% {n:6} {f}' for f, n in top]
+        return '\n'.join(lines)
+
+
+_profiler = None
+
+
+@contextlib.contextmanager
+def profiling(path, interval=0.01):
+    """
+    Profile all threads while in the context, save per phase collapsed
+    stacks to the directory and log the top functions at the end,
+    nothing is profiled if the path is not provided.
+    """
+    global _profiler
+    if not path:
+        yield None
+        return
+    _profiler = Profiler(interval)
+    _profiler.start()
+    try:
+        yield _profiler
+    finally:
+        profiler, _profiler = _profiler, None
+        profiler.stop()
+        profiler.save(path)
+        logging.info(profiler.summary())
+        logging.info(f'Saved profile to {path}')
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Set the run phase the profile samples are grouped by.
+    """
+    profiler = _profiler
+    if not profiler:
+        yield
+        return
+    previous = profiler.phase
+    profiler.phase = name
+    try:
+        yield
+    finally:
+        profiler.phase = previous
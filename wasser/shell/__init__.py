@@ -1,164 +1,783 @@
+import asyncio
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
 import os
 import paramiko
+import posixpath
+import re
+import signal
 import socket
+import sys
+import tarfile
 import time
 import threading
 
+from concurrent.futures import ThreadPoolExecutor
+
+from wasser.timing import span
+
+# directory on the nodes for wasser scripts and uploaded data
+wasser_remote_dir = '/opt/wasser'
+
+
+class OutputSink():
+    """
+    Receives chunks of a command output stream, splits them into lines
+    and logs all complete lines of a chunk with single logging call.
+
+    Incomplete line is kept until the next chunk, but not longer than
+    'max_line' bytes. If 'output' is provided, the raw chunks are written
+    into the output log file and the lines are added to its tail.
+    """
+    max_line = 64 * 1024
+
+    def __init__(self, prefix, output=None):
+        self.prefix = prefix
+        self.output = output
+        self.partial = b''
+
+    def feed(self, data: bytes):
+        if self.output:
+            self.output.write(data)
+        if self.partial:
+            data = self.partial + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.partial = data
+            if len(self.partial) > self.max_line:
+                self.emit(self.partial)
+                self.partial = b''
+            return
+        self.partial = data[end + 1:]
+        self.emit(data[:end])
+
+    def emit(self, data: bytes):
+        lines = data.decode(errors='replace').split('\n')
+        if self.output:
+            self.output.tail.extend(lines)
+        logging.info('\n'.join(self.prefix + _.rstrip() for _ in lines))
+
+    def close(self):
+        if self.partial:
+            self.emit(self.partial)
+            self.partial = b''
+
+
+class StepOutput():
+    """
+    Output of a single command: stdout and stderr sinks sharing the tail
+    of last 'tail_lines' lines for error reports and the step log file.
+    """
+    tail_lines = 50
+
+    def __init__(self, stdout_prefix, stderr_prefix, logpath=None):
+        self.tail = collections.deque(maxlen=self.tail_lines)
+        self.lock = threading.Lock()
+        self.logfile = open(logpath, 'wb') if logpath else None
+        self.stdout = OutputSink(stdout_prefix, self)
+        self.stderr = OutputSink(stderr_prefix, self)
+
+    def write(self, data: bytes):
+        if self.logfile:
+            with self.lock:
+                self.logfile.write(data)
+
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
+        if self.logfile:
+            self.logfile.close()
+
+    def last_lines(self):
+        return '\n'.join(self.tail)
+
+
+chunk_size = 64 * 1024
+
+
+async def read_stream(stream, sink):
+    """Read asyncio stream in large chunks into the output sink"""
+    while True:
+        data = await stream.read(chunk_size)
+        if not data:
+            break
+        sink.feed(data)
+
+
+def read_file(f, sink):
+    """Read file object in large chunks into the output sink"""
+    with f:
+        while True:
+            data = f.read1(chunk_size) if hasattr(f, 'read1') else f.read(chunk_size)
+            if not data:
+                break
+            sink.feed(data)
+
+
+class AsyncChannel():
+    """
+    Asyncio wrapper for paramiko channel, the channel output is read
+    by the event loop, when the channel file descriptor is readable.
+    """
+    def __init__(self, channel, stdout_sink, stderr_sink):
+        self.channel = channel
+        self.stdout = stdout_sink
+        self.stderr = stderr_sink
+
+    def read_ready(self):
+        """Read available data, return True when the channel is finished"""
+        c = self.channel
+        while c.recv_ready():
+            self.stdout.feed(c.recv(chunk_size))
+        while c.recv_stderr_ready():
+            self.stderr.feed(c.recv_stderr(chunk_size))
+        return (c.eof_received or c.closed) and not c.recv_ready() and not c.recv_stderr_ready()
+
+    async def read(self):
+        """Read the channel output until end of file"""
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        fd = self.channel.fileno()
+        def on_readable():
+            try:
+                finished = self.read_ready()
+            except Exception as e:
+                logging.error(f'Failed to read command output: {e}')
+                finished = True
+            if finished and not done.done():
+                done.set_result(None)
+        loop.add_reader(fd, on_readable)
+        try:
+            await done
+        finally:
+            loop.remove_reader(fd)
+
+    async def exit_status(self):
+        if self.channel.exit_status_ready():
+            return self.channel.recv_exit_status()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.channel.recv_exit_status)
+
+    def close(self):
+        self.channel.close()
+
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_shell_loop():
+    """
+    Return process wide event loop running in its own thread, which
+    runs commands for the sync shell API, so output of all commands
+    is handled by a single thread.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if not _loop:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='shell-loop', daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coro):
+    """
+    Run coroutine in the shell loop and wait for the result,
+    the coroutine is cancelled if the waiting is interrupted.
+    """
+    loop = get_shell_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError('Cannot run coroutine synchronously from the shell loop')
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def cancel_all():
+    """
+    Cancel all tasks of the shell loop, so the commands are killed
+    and the threads waiting in run_sync() are released.
+    """
+    loop = get_shell_loop()
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+    def cancel():
+        for task in all_tasks(loop):
+            task.cancel()
+    loop.call_soon_threadsafe(cancel)
+
 
 class Shell():
     cmdlog_prefix = '+++ '
     stdout_prefix = '>>> '
     stderr_prefix = 'EEE '
-
-    @staticmethod
-    def log_info(std, prefix):
-        while True:
-            line = std.readline()
-            if not line:
-                break
-            if isinstance(line, bytes):
-                logging.info(prefix + line.decode().rstrip())
-            else:
-                logging.info(prefix + line.rstrip())
+    # host tag prepended to the output lines, when several hosts are used
+    tag = ''
+    # node name of the host, used to tag timings
+    node = None
+    # directory for the step log files, if not set, output is only logged
+    log_dir = None
+    log_count = itertools.count(1)
 
     def log_cmd(self, command: str, name: str = None):
         if name:
-            logging.info(f"=== {name}")
+            logging.info(f"{self.tag}=== {name}")
         for i in command.split('\n'):
-            logging.info(f'{self.cmdlog_prefix} {i}')
+            logging.info(f'{self.tag}{self.cmdlog_prefix} {i}')
 
-    def start_logging_stderr(self, stream):
-        t = threading.Thread(target=self.log_info, args=(stream, self.stderr_prefix))
-        t.start()
-        return t
+    def open_output(self, name: str = None):
+        """
+        Return StepOutput for the next command, the output is saved to
+        a numbered log file if 'log_dir' is set.
+        """
+        logpath = None
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+            step = re.sub(r'[^A-Za-z0-9_.-]+', '-', name or 'command').strip('-')
+            logpath = os.path.join(self.log_dir,
+                                   f'{next(self.log_count):04d}-{self.hostname}-{step}.log')
+        return StepOutput(self.tag + self.stdout_prefix,
+                          self.tag + self.stderr_prefix, logpath)
 
-    def start_logging_stdout(self, stream):
-        t = threading.Thread(target=self.log_info, args=(stream, self.stdout_prefix))
-        t.start()
-        return t
+    @staticmethod
+    def exit_code_error(exit_code, command, output):
+        message = f"Received exit code {exit_code} while running command: {command}"
+        if output.tail:
+            message += f"\nLast output lines:\n{output.last_lines()}"
+        return Exception(message)
 
     def run(self, command: str, name: str = None, timeout: int = None) -> None:
+        run_sync(self.arun(command, name, timeout))
+
+    async def arun(self, command: str, name: str = None, timeout: int = None) -> None:
+        pass
+
+    def copy_files(self, copy_spec):
         pass
 
+    async def acopy_files(self, copy_spec):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.copy_files, copy_spec)
+
 
 import subprocess
 
 class LocalShell(Shell):
+    # before python 3.8 asyncio subprocesses need a child watcher attached
+    # to the loop, which can be done only from the main thread, while the
+    # shell loop has its own thread, so the processes are waited in threads
+    use_threads = sys.version_info < (3, 8)
+
     def __init__(self, user: str):
         self.hostname = 'local'
         self.username = user or os.environ.get('USER')
 
 
+    def get_client(self):
+        # local commands do not need any client
+        return None
+
+    def connect_client(self):
+        return None
+
     def copy_files(self, copy_spec):
         logging.warning('copy files is not supported yet for local host')
 
 
-    def run(self, command: str, name: str = None, timeout: int = None) -> None:
+    async def arun(self, command: str, name: str = None, timeout: int = None) -> None:
         self.log_cmd(command, name)
 
+        output = self.open_output(name)
+        if self.use_threads:
+            try:
+                exit_code = await self.arun_thread(command, output, timeout)
+            finally:
+                output.close()
+            if exit_code:
+                raise self.exit_code_error(exit_code, command, output)
+            logging.info(f"{self.tag}||| exit code: {exit_code}")
+            return
+        # own process group allows to kill all command processes on timeout
+        p = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE,
+                                                           start_new_session=True)
+        readers = asyncio.gather(read_stream(p.stdout, output.stdout),
+                                 read_stream(p.stderr, output.stderr))
+        try:
+            exit_code = await asyncio.wait_for(p.wait(), timeout)
+            await readers
+        except asyncio.TimeoutError:
+            self.kill(p)
+            await p.wait()
+            await readers
+            raise Exception(f'Command failed because of timeout {timeout} seconds')
+        except asyncio.CancelledError:
+            self.kill(p)
+            readers.cancel()
+            raise
+        finally:
+            output.close()
+
+        if exit_code:
+            raise self.exit_code_error(exit_code, command, output)
+        logging.info(f"{self.tag}||| exit code: {exit_code}")
+
+    async def arun_thread(self, command, output, timeout=None):
+        """
+        Run command with subprocess.Popen and wait for it and read its
+        output in the loop executor, return the command exit code.
+        """
+        loop = asyncio.get_event_loop()
         p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                                  stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, start_new_session=True)
+        waiter = loop.run_in_executor(None, self.wait_process, p, output)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            self.kill(p)
+            await waiter
+            raise Exception(f'Command failed because of timeout {timeout} seconds')
+        except asyncio.CancelledError:
+            self.kill(p)
+            raise
 
-        stdout_thread = self.start_logging_stdout(p.stdout)
-        stderr_thread = self.start_logging_stderr(p.stderr)
+    @staticmethod
+    def wait_process(p, output):
+        stderr = threading.Thread(target=read_file, args=(p.stderr, output.stderr), daemon=True)
+        stderr.start()
+        read_file(p.stdout, output.stdout)
+        stderr.join()
+        return p.wait()
 
-        exit_code = p.wait(timeout=timeout)
+    @staticmethod
+    def kill(p):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class ConnectionPool():
+    """
+    Process wide pool of ssh clients keyed by address, user and identity,
+    so all shells of the same host share single transport.
+
+    Each transport sends keepalive packets every 'keepalive' seconds,
+    and the number of channels opened at once on a transport is limited
+    by 'max_channels', which should not exceed sshd MaxSessions.
+    """
+    keepalive = 30
+    max_channels = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.locks = {}
+        self.channels = {}
+
+    def key_lock(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+                self.channels[key] = threading.BoundedSemaphore(self.max_channels)
+            return self.locks[key]
+
+    def channel_slot(self, key):
+        """Return semaphore limiting channels opened on the key transport"""
+        self.key_lock(key)
+        return self.channels[key]
 
-        stdout_thread.join()
-        stderr_thread.join()
+    @staticmethod
+    def is_active(client):
+        transport = client.get_transport() if client else None
+        return bool(transport and transport.is_active())
+
+    def get(self, key, connect):
+        """
+        Return active pooled client for the key, if there is no such,
+        call 'connect' to make a new one.
+        """
+        with self.key_lock(key):
+            client = self.clients.get(key)
+            if self.is_active(client):
+                return client
+            return self._replace(key, connect)
+
+    def reconnect(self, key, connect):
+        """
+        Drop pooled client for the key and make a new one using 'connect'.
+        """
+        with self.key_lock(key):
+            return self._replace(key, connect)
+
+    def _replace(self, key, connect):
+        old = self.clients.pop(key, None)
+        if old:
+            old.close()
+        client = connect()
+        client.get_transport().set_keepalive(self.keepalive)
+        self.clients[key] = client
+        return client
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for c in clients:
+            c.close()
 
-        if exit_code:
-            raise Exception(f"Received exit code {exit_code} while running command: {command}")
-        logging.info(f"||| exit code: {exit_code}")
+
+ssh_pool = ConnectionPool()
 
 
 class RemoteShell(Shell):
+    # uploaded files manifest, kept in wasser remote directory
+    manifest_name = '.manifest.json'
+    # upload files with tar stream by default
+    bulk_copy = True
+    # files of this size and larger are uploaded with separate sftp sessions
+    large_file_size = 16 * 1024 * 1024
+    sftp_sessions = 4
+    # seconds the tar stream upload can be stalled
+    upload_timeout = 10 * 60
+
     def __init__(self, name='localhost', user='root', identity=None):
         self.client = None
         self.username = user
         self.hostname = name
         self.identity = os.path.expanduser(identity or '~/.ssh/id_rsa')
+        self.pool_key = (self.hostname, self.username, self.identity)
 
-    def connect_client(self, wait=10, timeout=300):
+    def open_client(self, wait=10, timeout=300):
         """
-            returns ssh client object
+            returns new ssh client object
         """
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         start_time = time.time()
         logging.info(f"Connecting to host [{self.hostname}]")
-        while True:
-            try:
-                client.connect(self.hostname, username=self.username, key_filename=self.identity)
-                logging.info("Connected to the host " + self.hostname)
-                break
-            except (paramiko.ssh_exception.NoValidConnectionsError,
-                    paramiko.ssh_exception.SSHException,
-                    socket.error) as e:
-                logging.debug("Exception occured: " + str(e))
-                if timeout < (time.time() - start_time):
-                    logging.error("Timeout occured")
-                    raise e
-                else:
-                    logging.info(f"Waiting {wait} seconds...")
-                    time.sleep(wait)
-        self.client = client
+        with span('ssh_connect', node=self.node or self.hostname):
+            while True:
+                try:
+                    client.connect(self.hostname, username=self.username, key_filename=self.identity)
+                    logging.info("Connected to the host " + self.hostname)
+                    break
+                except (paramiko.ssh_exception.NoValidConnectionsError,
+                        paramiko.ssh_exception.SSHException,
+                        socket.error) as e:
+                    logging.debug("Exception occured: " + str(e))
+                    if timeout < (time.time() - start_time):
+                        logging.error("Timeout occured")
+                        raise e
+                    else:
+                        logging.info(f"Waiting {wait} seconds...")
+                        time.sleep(wait)
         return client
 
+    def connect_client(self, wait=10, timeout=300):
+        """
+            reconnects pooled ssh client and returns it
+        """
+        self.client = ssh_pool.reconnect(self.pool_key,
+                                         lambda: self.open_client(wait, timeout))
+        return self.client
+
     def get_client(self):
-        if self.client:
-            return self.client
-        else:
-            return self.connect_client()
+        """
+            returns pooled ssh client, reconnects if the transport is closed
+        """
+        self.client = ssh_pool.get(self.pool_key, self.open_client)
+        return self.client
 
-    def copy_files(self, copy_spec):
+    def copy_files(self, copy_spec, bulk=None):
+        """
+        Upload files according to the copy spec, which is a list of dicts:
+
+        :from:      list of local files or directories.
+        :into:      remote directory.
+        :mode:      optional str, octal mode for the uploaded files.
+        :sync:      bool, upload only changed files, defaults to True.
+        :compare:   'mtime' to compare file size and modification time,
+                    or 'hash' to compare content hash, defaults to 'mtime'.
+
+        Directories are uploaded recursively, relative 'into' directories
+        are resolved against the remote home directory. Uploaded files are
+        recorded in the remote manifest, and in sync mode the files which
+        are not changed since the last upload are skipped, as long as the
+        remote file still has the uploaded size and modification time.
+
+        If 'bulk' is True, which is the default, the files are packed into
+        single compressed tar stream and unpacked remotely, while the files
+        larger than 'large_file_size' are uploaded with parallel sftp sessions.
+        Returns dict with number of files and bytes sent and skipped.
+        """
         logging.debug(f"Copy spec: {copy_spec}")
+        stats = dict(sent_files=0, sent_bytes=0, skipped_files=0, skipped_bytes=0)
+        if not copy_spec:
+            return stats
+        if bulk is None:
+            bulk = self.bulk_copy
         client = self.get_client()
-        if copy_spec:
-            with client.open_sftp() as sftp:
-                for i in copy_spec:
-                    for path in i['from']:
-                        if not path.startswith('/'):
-                            if not os.path.isfile(path):
-                                base = os.path.dirname(__file__)
-                                if base:
-                                    path = base + '/' + path
-                        path = os.path.abspath(path)
-                        logging.info('Upload file %s' % path)
-                        name = os.path.basename(path)
-                        dest = i['into'].rstrip('/') + '/' + name
-                        sftp.put(path, dest)
-                        for x in ['mode', 'chmod']:
-                            if x in i:
-                                sftp.chmod(dest, int(i[x], 8))
+        uploads = []
+        with self.open_sftp(client) as sftp:
+            manifest = self.read_manifest(sftp)
+            home = None
+            if any(not _['into'].startswith('/') for _ in copy_spec):
+                home = sftp.normalize('.')
+            for i in copy_spec:
+                mode = next((int(i[x], 8) for x in ['mode', 'chmod'] if x in i), None)
+                compare = i.get('compare', 'mtime') if i.get('sync', True) else None
+                into = i['into'] if i['into'].startswith('/') else posixpath.join(home, i['into'])
+                for path in i['from']:
+                    for src, dest in self.list_copy_files(self.local_path(path), into):
+                        entry = self.changed_file(manifest, src, dest, mode, compare, sftp)
+                        if entry:
+                            uploads.append((src, dest, mode, entry))
+                        else:
+                            stats['skipped_files'] += 1
+                            stats['skipped_bytes'] += os.path.getsize(src)
+        # each upload session takes its own channel slot, so the manifest
+        # session is not kept open meanwhile
+        if bulk:
+            large = [_ for _ in uploads if _[3]['size'] >= self.large_file_size]
+            small = [_ for _ in uploads if _[3]['size'] < self.large_file_size]
+            if len(small) > 1:
+                self.upload_tar(small)
+            else:
+                large += small
+            self.upload_parallel(client, large)
+        elif uploads:
+            with self.open_sftp(client) as sftp:
+                dirs = set()
+                for src, dest, mode, entry in uploads:
+                    self.make_remote_dirs(sftp, os.path.dirname(dest), dirs)
+                    self.upload_file(sftp, src, dest, mode)
+        for src, dest, mode, entry in uploads:
+            manifest[dest] = entry
+            stats['sent_files'] += 1
+            stats['sent_bytes'] += entry['size']
+        if uploads:
+            with self.open_sftp(client) as sftp:
+                self.write_manifest(sftp, manifest)
+        logging.info(f"Uploaded {stats['sent_files']} files ({stats['sent_bytes']} bytes), "
+                     f"skipped {stats['skipped_files']} unchanged files ({stats['skipped_bytes']} bytes)")
+        return stats
+
+    @contextlib.contextmanager
+    def open_sftp(self, client):
+        """Open sftp session within the channel slot of the host"""
+        with ssh_pool.channel_slot(self.pool_key), client.open_sftp() as sftp:
+            yield sftp
 
+    @staticmethod
+    def log_throughput(method, files, size, start_time):
+        seconds = max(time.time() - start_time, 0.001)
+        logging.info(f'Sent {files} files, {size} bytes in {seconds:.1f}s '
+                     f'({size / seconds / 1024 / 1024:.2f} MiB/s) using {method}')
 
-    def run(self, command: str, name: str = None, timeout: int = None) -> None:
-        self.log_cmd(command, name)
+    def upload_file(self, sftp, src, dest, mode):
+        logging.info('Upload file %s' % src)
+        start_time = time.time()
+        st = os.stat(src)
+        sftp.put(src, dest)
+        # keep the modification time like tar does, so the manifest can be checked
+        sftp.utime(dest, (st.st_atime, st.st_mtime))
+        if mode is not None:
+            sftp.chmod(dest, mode)
+        self.log_throughput('sftp', 1, os.path.getsize(src), start_time)
+
+    def upload_parallel(self, client, uploads):
+        """
+        Upload files concurrently, each file with its own sftp session,
+        paramiko sftp pipelines writes within a session.
+        """
+        if not uploads:
+            return
+        def upload(item):
+            src, dest, mode, entry = item
+            with self.open_sftp(client) as sftp:
+                self.make_remote_dirs(sftp, os.path.dirname(dest), set())
+                self.upload_file(sftp, src, dest, mode)
+        workers = min(len(uploads), self.sftp_sessions)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sftp') as pool:
+            for f in [pool.submit(upload, _) for _ in uploads]:
+                f.result()
+
+    def upload_tar(self, uploads):
+        """
+        Pack files into compressed tar stream and unpack it remotely with
+        single command, file modes are preserved or set from the copy spec.
+        The remote paths are absolute, and the upload fails if the stream
+        is stalled for 'upload_timeout' seconds.
+        """
+        start_time = time.time()
+        size = sum(_[3]['size'] for _ in uploads)
+        logging.info(f'Upload {len(uploads)} files ({size} bytes) with tar stream')
+        with ssh_pool.channel_slot(self.pool_key):
+            stdin, stdout, stderr = self.exec_command('tar --no-same-owner -xzpf - -C /', self.upload_timeout)
+            try:
+                with tarfile.open(fileobj=stdin, mode='w|gz') as tar:
+                    for src, dest, mode, entry in uploads:
+                        info = tar.gettarinfo(src, arcname=dest.lstrip('/'))
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = ''
+                        if mode is not None:
+                            info.mode = mode
+                        with open(src, 'rb') as f:
+                            tar.addfile(info, f)
+                stdin.channel.shutdown_write()
+                error = stderr.read().decode(errors='replace').strip()
+            except socket.timeout:
+                stdin.channel.close()
+                raise Exception(f'Failed to unpack files on {self.hostname} because of timeout '
+                                f'{self.upload_timeout} seconds')
+            exit_code = stdout.channel.recv_exit_status()
+        if exit_code:
+            raise Exception(f'Failed to unpack files on {self.hostname}, exit code {exit_code}: {error}')
+        self.log_throughput('tar stream', len(uploads), size, start_time)
 
-        client = self.get_client()
-        stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+    def changed_file(self, manifest, src, dest, mode, compare, sftp=None):
+        """
+        Return manifest entry for the file if the file needs to be uploaded,
+        otherwise None. The entry keeps the 'remote' size and modification
+        time, which the uploaded file must still have to be skipped.
+        """
+        st = os.stat(src)
+        entry = dict(size=st.st_size, mtime=int(st.st_mtime), mode=mode)
+        if compare == 'hash':
+            entry = dict(size=st.st_size, sha256=self.file_hash(src), mode=mode)
+        old = manifest.get(dest)
+        if compare and old and all(old.get(k) == v for k, v in entry.items()):
+            if sftp is None or self.remote_file_matches(sftp, dest, old.get('remote')):
+                logging.debug(f'Skip unchanged file {src}')
+                return None
+            logging.info(f'Remote file {dest} is changed or missing')
+        entry['remote'] = dict(size=st.st_size, mtime=int(st.st_mtime))
+        return entry
+
+    @staticmethod
+    def remote_file_matches(sftp, path, remote):
+        if not remote:
+            return False
+        try:
+            st = sftp.stat(path)
+        except IOError:
+            return False
+        return st.st_size == remote['size'] and int(st.st_mtime) == remote['mtime']
+
+    @staticmethod
+    def local_path(path):
+        if not path.startswith('/'):
+            if not os.path.exists(path):
+                base = os.path.dirname(__file__)
+                if base:
+                    path = base + '/' + path
+        return os.path.abspath(path)
 
-        stdout_thread = self.start_logging_stdout(stdout)
-        stderr_thread = self.start_logging_stderr(stderr)
+    @staticmethod
+    def list_copy_files(path, into):
+        """
+        Return list of (local, remote) file path pairs for the local path,
+        which can be a file or a directory.
+        """
+        into = into.rstrip('/')
+        name = os.path.basename(path.rstrip('/'))
+        if not os.path.isdir(path):
+            return [(path, f'{into}/{name}')]
+        files = []
+        for root, _, names in os.walk(path):
+            rel = os.path.relpath(root, path)
+            dest_dir = f'{into}/{name}' if rel == '.' else f'{into}/{name}/{rel}'
+            files += [(os.path.join(root, _), f'{dest_dir}/{_}') for _ in sorted(names)]
+        return files
 
-        stdout_thread.join()
-        stderr_thread.join()
+    @staticmethod
+    def make_remote_dirs(sftp, path, dirs):
+        """Create remote directory and its parents, unless they are in 'dirs'"""
+        if not path or path == '/' or path in dirs:
+            return
+        try:
+            sftp.stat(path)
+        except IOError:
+            RemoteShell.make_remote_dirs(sftp, os.path.dirname(path), dirs)
+            sftp.mkdir(path)
+        dirs.add(path)
 
-        failed = False
-        if stdout_thread.is_alive():
-            logging.error('stdout {stdout_thread} is alive')
-            failed = True
+    @staticmethod
+    def file_hash(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @property
+    def manifest_path(self):
+        return f'{wasser_remote_dir}/{self.manifest_name}'
+
+    def read_manifest(self, sftp):
+        try:
+            with sftp.open(self.manifest_path, 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError) as e:
+            logging.debug(f'Cannot read remote manifest {self.manifest_path}: {e}')
+            return {}
+
+    def write_manifest(self, sftp, manifest):
+        try:
+            with sftp.open(self.manifest_path, 'w') as f:
+                f.write(json.dumps(manifest))
+        except IOError as e:
+            logging.warning(f'Cannot write remote manifest {self.manifest_path}: {e}')
+
+
+    async def arun(self, command: str, name: str = None, timeout: int = None) -> None:
+        self.log_cmd(command, name)
 
-        if stderr_thread.is_alive():
-            logging.error('stderr {stderr_thread} is alive')
-            failed = True
+        loop = asyncio.get_event_loop()
+        slot = ssh_pool.channel_slot(self.pool_key)
+        # the slot is polled, so the waiting can be cancelled at any time
+        while not slot.acquire(blocking=False):
+            await asyncio.sleep(0.1)
+        try:
+            stdin, stdout, stderr = await loop.run_in_executor(None, self.exec_command, command, timeout)
+            output = self.open_output(name)
+            channel = AsyncChannel(stdout.channel, output.stdout, output.stderr)
+            try:
+                await asyncio.wait_for(channel.read(), timeout)
+            except asyncio.TimeoutError:
+                channel.close()
+                raise Exception(f'Command failed because of timeout {timeout} seconds')
+            except asyncio.CancelledError:
+                channel.close()
+                raise
+            finally:
+                output.close()
+            exit_code = await channel.exit_status()
+        finally:
+            slot.release()
 
-        # in case of timeout the recv_exit_status will block on status_even.wait
-        if failed:
-            raise Exception(f'Command failed because probable timeout {timeout} seconds')
-        exit_code = stdout.channel.recv_exit_status()
         if exit_code:
-            raise Exception(f"Received exit code {exit_code} while running command: {command}")
-        logging.info(f"||| exit code: {exit_code}")
+            raise self.exit_code_error(exit_code, command, output)
+        logging.info(f"{self.tag}||| exit code: {exit_code}")
+
+    def exec_command(self, command: str, timeout: int = None):
+        client = self.get_client()
+        try:
+            return client.exec_command(command, timeout=timeout)
+        except (paramiko.ssh_exception.SSHException, EOFError, socket.error) as e:
+            # the transport can be broken while the host is rebooted,
+            # so reconnect and retry once
+            logging.info(f"Reconnecting to host [{self.hostname}] due to: {e}")
+            client = self.connect_client()
+            return client.exec_command(command, timeout=timeout)
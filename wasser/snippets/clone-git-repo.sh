@@ -1,5 +1,11 @@
 #!/bin/bash -ex
 # jenkins style sha1 pull request checkout
+#
+# Fast checkout mode is enabled when any of the following is set:
+#   CHECKOUT_DEPTH  - fetch only given number of commits of the requested ref
+#   CHECKOUT_FILTER - partial clone filter, for example, blob:none
+#   CHECKOUT_BUNDLE - git bundle to seed the repo objects from,
+#                     so only missing objects are fetched from the repo
 
 REPO_PATH=${1:-"."}
 REPO_URL=${2:-"https://github.com/suse/ceph"}
@@ -10,17 +16,44 @@ git init $REPO_PATH
 
 pushd $REPO_PATH
 
+# Check if branch has GitHub form refs/pull/*/merge or refs/pull/*/head
+isGHREFPULL="^refs\/pull\/"
+# Check if branch has form origin/pr/*/merge specific
+# for Jenkins GitHub PullRequest Builder Plugin
+isJGHPRBP="^origin\/pr\/"
+
+if [[ -n "$CHECKOUT_DEPTH$CHECKOUT_FILTER$CHECKOUT_BUNDLE" ]] ; then
+    if [[ -n "$CHECKOUT_BUNDLE" ]] ; then
+        echo Seed objects from $CHECKOUT_BUNDLE
+        git fetch --no-tags $CHECKOUT_BUNDLE '+refs/*:refs/seed/*'
+    fi
+    FETCH_OPTS=""
+    [[ -n "$CHECKOUT_DEPTH" ]] && FETCH_OPTS="$FETCH_OPTS --depth=$CHECKOUT_DEPTH"
+    [[ -n "$CHECKOUT_FILTER" ]] && FETCH_OPTS="$FETCH_OPTS --filter=$CHECKOUT_FILTER"
+    git config remote.origin.url $REPO_URL
+    if [[ "$REPO_BRANCH" =~ $isJGHPRBP ]] ; then
+        PR=${REPO_BRANCH#origin/pr/}
+        REF=refs/pull/$PR
+    else
+        REF=$REPO_BRANCH
+    fi
+    echo Fetch $REF from $REPO_URL
+    git fetch --no-tags --progress $FETCH_OPTS origin $REF
+    if [[ "$REPO_BRANCH" =~ $isJGHPRBP || "$REPO_BRANCH" =~ $isGHREFPULL ]] ; then
+        git checkout -f --detach FETCH_HEAD
+    else
+        git checkout -f -B $REPO_BRANCH FETCH_HEAD
+    fi
+    popd
+    exit 0
+fi
+
 echo Fetch upstream changes from $REPO_URL
 git fetch --tags --progress $REPO_URL +refs/heads/*:refs/remotes/origin/*
 git config remote.origin.url $REPO_URL
 git config --add remote.origin.fetch +refs/heads/*:refs/remotes/origin/*
 git config remote.origin.url $REPO_URL
 
-# Check if branch has GitHub form refs/pull/*/merge or refs/pull/*/head
-isGHREFPULL="^refs\/pull\/"
-# Check if branch has form origin/pr/*/merge specific
-# for Jenkins GitHub PullRequest Builder Plugin
-isJGHPRBP="^origin\/pr\/"
 if [[ "$REPO_BRANCH" =~ $isJGHPRBP ]] ; then
     git fetch --tags --progress $REPO_URL +refs/pull/*:refs/remotes/origin/pr/*
     rev=$(git rev-parse refs/remotes/$REPO_BRANCH^{commit})
@@ -39,4 +72,3 @@ else
 fi
 
 popd
-
@@ -2,11 +2,16 @@ import logging
 import os
 import json
 import yaml
+import atexit
 import copy
+import threading
 
 from pathlib import Path
 from typing import Dict
 
+from wasser.cache import get_spec_cache, state_file_path
+from wasser.timing import span
+
 default_server_spec = {
     'openstack': {
         'name':     'wa%02d',
@@ -27,19 +32,19 @@ def override(src, data):
     """
     Returns dict based on src dict overridden with the data.
 
+    The merge is copy-on-write: only the dicts on the paths overridden
+    by the data are copied, everything else is shared with src and data,
+    so neither the result nor its values should be modified in place,
+    override the result again instead.
     """
-    res = copy.deepcopy(src)
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key in res:
-                if isinstance(res[key], dict):
-                    res[key] = override(res[key], value)
-                else:
-                    res[key] = copy.deepcopy(value)
-            elif isinstance(value, dict):
-                res[key] = copy.deepcopy(value)
-            else:
-                res[key] = value
+    if not isinstance(data, dict) or not data:
+        return src
+    res = dict(src)
+    for key, value in data.items():
+        if isinstance(res.get(key), dict):
+            res[key] = override(res[key], value)
+        else:
+            res[key] = value
     return res
 
 status_default_data =  {
@@ -56,9 +61,25 @@ status_default_data =  {
 
 
 class State():
+    """
+    Wasser status, which is stored in the state file.
+
+    The status is saved to disk by the state store manner: save() only
+    marks the status as changed and the changes made within 'save_delay'
+    seconds are written at once. The state file is written to a temporary
+    file and renamed, so it is always consistent, even if the process is
+    killed in the middle. Use flush() to write pending changes immediately,
+    for example, at the end of a phase.
+    """
     status = None
     debug = False
+    save_delay = 0.5
     def __init__(self, status=None):
+        # nodes can be updated from several threads at once
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.timer = None
+        self.flush_at_exit = False
         if status:
             self.status = copy.deepcopy(status)
             logging.debug(self.status)
@@ -73,18 +94,43 @@ class State():
         self.args = args
         self.debug = args.debug
         if hasattr(args, 'path') and args.path:
-            self.load_spec(args.path)
-            self.override_openstack_spec(self.args)
+            with span('spec_load'):
+                self.load_spec(args.path)
+                self.override_openstack_spec(self.args)
 
             self.status['env'].update(
                 github_url=args.github_url,
                 github_branch=args.github_branch,
             )
+            if getattr(args, 'continue', False):
+                self.resume_state(args.state_path)
         else:
             self.load_state(args.state_path)
         logging.debug(f'State: {self.status}')
         return self
 
+    def resume_state(self, path):
+        """
+        Take the nodes and their completed steps from the state file
+        of the previous run, the deleted nodes are going to be recreated.
+        """
+        if not path or not os.path.exists(path):
+            logging.warning(f'No state file {path} to continue from, starting over')
+            return
+        with open(path, 'r') as f:
+            nodes = json.load(f).get('nodes') or []
+        gone = 0
+        for routine_nodes in nodes:
+            for i, node in enumerate(routine_nodes):
+                if node.get('status') in ['deleting', 'deleted', 'released']:
+                    routine_nodes[i] = {}
+                    gone += 1
+        if gone and gone == sum(len(_) for _ in nodes):
+            logging.warning(f'All nodes of the previous run are deleted, nothing is skipped, '
+                            f'use --keep-failed to keep the nodes of failed runs')
+        self.status['nodes'] = nodes
+        logging.info(f'Continue with nodes from {path}')
+
     def load(self, args):
         self.args = args
         self.debug = args.debug
@@ -108,12 +154,11 @@ class State():
 
     @staticmethod
     def _override_openstack_spec(spec, args):
-        def override_key(obj, key, default=None):
-            if default:
-                obj[key] = default
-
-        _spec = spec.get('openstack', {})
-
+        """
+        Return the spec with openstack settings overridden by the command
+        line arguments, the spec itself is not modified, since it shares
+        its values with the default spec and the spec cache.
+        """
         openstack_params = {
             'cloud':     args.openstack_cloud,
             'flavor':    args.target_flavor,
@@ -125,13 +170,10 @@ class State():
             'network':   args.target_network,
             'username':  args.target_username,
         }
-        for k, v in openstack_params.items():
-            override_key(_spec, k, v)
-        spec['openstack'] = _spec
-        return _spec
+        return override(spec, dict(openstack={k: v for k, v in openstack_params.items() if v}))
 
     def override_openstack_spec(self, args):
-        self._override_openstack_spec(self.status.get('spec'), args)
+        self.status['spec'] = self._override_openstack_spec(self.status.get('spec'), args)
 
     def read_spec_files(self, paths):
         for path in paths:
@@ -140,16 +182,34 @@ class State():
                 yield self.read_spec(path)
 
             
+    def get_spec_cache(self):
+        """
+        Return merged spec cache, which is stored next to the state file.
+        """
+        return get_spec_cache(state_file_path(self.state_path, '.wasser_specs'))
+
     def load_spec(self, spec_path):
+        """
+        Merge the user config, the directory config and the spec file,
+        the merged spec is cached by the file modification times, so
+        the files are read again only if any of them is changed.
+        """
         spec_paths = [
             os.path.expanduser('~/.wasser/config.yaml'),
             '.wasser.yaml',
             spec_path
         ]
-        
+        cache = self.get_spec_cache()
+        key = cache.files_key(spec_paths, default_server_spec)
+        spec = cache.get(key)
+        if spec is not None:
+            logging.debug(f'Using cached spec of {spec_path}')
+            self.status['spec'] = spec
+            return
         specs = self.read_spec_files(spec_paths)
         logging.debug(f'Overriding status...')
         self.override_status_specs(specs)
+        cache.set(key, self.status['spec'])
 
 
     def override_status_specs(self, specs):
@@ -165,13 +225,55 @@ class State():
             self.status = json.load(f)
             logging.debug(self.status)
 
-    def save(self):
-        logging.debug("Saving status to '%s'" % self.args.state_path)
-        with open(self.args.state_path, 'w') as f:
-            json.dump(self.status, f, indent=2)
+    @property
+    def state_path(self):
+        args = getattr(self, 'args', None)
+        return getattr(args, 'state_path', None)
+
+    def save(self, flush=False):
+        """
+        Schedule saving status to the state file, or save it right away
+        if 'flush' is True.
+        """
+        if not self.state_path:
+            return
+        with self.lock:
+            self.dirty = True
+            if flush:
+                self.flush()
+            elif not self.timer:
+                if not self.flush_at_exit:
+                    atexit.register(self.flush)
+                    self.flush_at_exit = True
+                self.timer = threading.Timer(self.save_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Write pending status changes to the state file atomically.
+        """
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty or not self.state_path:
+                return
+            path = self.state_path
+            logging.debug("Saving status to '%s'" % path)
+            tmp_path = f'{path}.{os.getpid()}.{id(self)}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.status, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.dirty = False
 
 
 class NodeState():
+    # keys which are saved immediately, because they are required
+    # to cleanup the node resources, if wasser is crashed
+    durable_keys = ['id', 'fip_id']
     # node data reference object
     data: Dict = None
     # wasser root state
@@ -184,7 +286,8 @@ class NodeState():
                     **kwargs):
         if kwargs:
             logging.debug(kwargs)
-        for k,v in kwargs.items():
-            logging.debug('override %s with %s' % (k,v))
-            self.data[k] = v
-        self.state.save()
+        with self.state.lock:
+            for k,v in kwargs.items():
+                logging.debug('override %s with %s' % (k,v))
+                self.data[k] = v
+            self.state.save(flush=any(_ in self.durable_keys for _ in kwargs))
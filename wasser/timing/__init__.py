@@ -0,0 +1,156 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Timings():
+    """
+    Recorder of the time spent in each phase of the run, for example:
+
+        with timings.span('create_server', routine='deploy', node='node01'):
+            ...
+
+    Each span is recorded with its phase name, start and end time, the
+    thread it is run by, and the tags, like routine, node and step names.
+    The spans are recorded only if the recorder is enabled, otherwise
+    span() costs nothing but a function call.
+
+    The recorded spans are exported to json file, which is a valid Chrome
+    trace-event file at the same time, so it can be loaded into a trace
+    viewer like chrome://tracing or https://ui.perfetto.dev, where each
+    routine is shown as a process and each node as a thread.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+            self.spans = []
+
+    def disable(self):
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def span(self, phase, **tags):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            self.record(phase, start, time.time(), error=error, **tags)
+
+    def record(self, phase, start, end, error=None, **tags):
+        span = dict(phase=phase, start=start, end=end, duration=end - start,
+                    thread=threading.current_thread().name)
+        span.update({k: v for k, v in tags.items() if v is not None})
+        if error:
+            span['error'] = error
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        Return count, total and maximum duration of each phase.
+        """
+        res = {}
+        with self.lock:
+            spans = list(self.spans)
+        for s in spans:
+            p = res.setdefault(s['phase'], dict(count=0, total=0.0, max=0.0))
+            p['count'] += 1
+            p['total'] += s['duration']
+            p['max'] = max(p['max'], s['duration'])
+        return res
+
+    def trace_events(self):
+        """
+        Return spans as Chrome trace complete events, routines are mapped
+        to processes and nodes to threads, the spans without node are
+        shown in the lane of the thread which run them.
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda _: _['start'])
+        if not spans:
+            return []
+        origin = spans[0]['start']
+        pids = {None: 0}
+        tids = {}
+        events = [dict(name='process_name', ph='M', pid=0, tid=0, args=dict(name='wasser'))]
+        for s in spans:
+            routine = s.get('routine')
+            if routine not in pids:
+                pids[routine] = len(pids)
+                events.append(dict(name='process_name', ph='M', pid=pids[routine], tid=0,
+                                   args=dict(name=f'routine {routine}')))
+            lane = s.get('node') or s['thread']
+            key = (routine, lane)
+            if key not in tids:
+                tids[key] = len(tids) + 1
+                events.append(dict(name='thread_name', ph='M', pid=pids[routine], tid=tids[key],
+                                   args=dict(name=lane)))
+            name = s['phase'] if not s.get('step') else f"{s['phase']}: {s['step']}"
+            events.append(dict(
+                name=name, cat=s['phase'], ph='X',
+                ts=round((s['start'] - origin) * 1e6),
+                dur=round(s['duration'] * 1e6),
+                pid=pids[routine], tid=tids[key],
+                args={k: v for k, v in s.items() if k not in ['start', 'end', 'duration']},
+            ))
+        return events
+
+    def export(self, path):
+        """
+        Save the spans, phase summary and trace events to the json file.
+        """
+        with self.lock:
+            spans = list(self.spans)
+        data = dict(
+            spans=spans,
+            summary=self.summary(),
+            traceEvents=self.trace_events(),
+            displayTimeUnit='ms',
+        )
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1, default=str)
+        os.replace(tmp_path, path)
+        logging.info(f'Saved {len(spans)} timings to {path}')
+
+
+timings = Timings()
+
+
+def span(phase, **tags):
+    """
+    Return context manager which records the phase time with the tags.
+    """
+    return timings.span(phase, **tags)
+
+
+@contextlib.contextmanager
+def recording(path):
+    """
+    Record timings while in the context and export them to the file
+    at the end, nothing is recorded if the path is not provided.
+    """
+    if not path:
+        yield timings
+        return
+    timings.enable()
+    try:
+        yield timings
+    finally:
+        timings.disable()
+        timings.export(path)